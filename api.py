@@ -0,0 +1,277 @@
+"""Versioned JSON API for Warbler's timelines and profiles.
+
+    GET /api/v1/timeline                  the logged-in user's home timeline
+    GET /api/v1/users/<id>                a profile
+    GET /api/v1/users/<id>/messages       a user's messages, newest first
+    GET /api/v1/users/<id>/followers      who follows them, by user id
+    GET /api/v1/users/<id>/following      who they follow, by user id
+
+Lists come ``?limit=`` items at a time (up to ``API_MAX_PAGE_SIZE``) as
+``{"items": [...], "next": cursor}``; pass ``?cursor=`` to get the page
+after it. ``next`` is null on the last page. ``?fields=`` picks the fields
+of each item. A message's author fields are named ``user.<field>``, and
+come back nested under ``"user"``.
+
+Only the columns of the requested fields are selected, and each result
+tuple is serialized directly, without building ORM objects. Lists are
+streamed out as rows arrive from the database.
+"""
+
+import json
+from datetime import datetime
+
+from flask import Blueprint, Response, abort, current_app, g, jsonify, request, stream_with_context
+from sqlalchemy import tuple_
+
+import timeline
+from models import db, Follows, Message, TimelineEntry, User, PUBLIC_USER_FIELDS
+from pagination import decode_cursor, encode_cursor
+
+blueprint = Blueprint('api', __name__, url_prefix='/api/v1')
+
+USER_FIELDS = {name: getattr(User, name) for name in PUBLIC_USER_FIELDS}
+
+MESSAGE_FIELDS = {
+    'id': Message.id,
+    'text': Message.text,
+    'timestamp': Message.timestamp,
+    'user_id': Message.user_id,
+}
+MESSAGE_FIELDS.update({f"user.{name}": column
+                       for name, column in USER_FIELDS.items()})
+
+DEFAULT_USER_FIELDS = ('id', 'username', 'image_url', 'bio')
+DEFAULT_MESSAGE_FIELDS = ('id', 'text', 'timestamp',
+                          'user.id', 'user.username', 'user.image_url')
+
+# rows fetched from the database cursor at a time while streaming a list
+STREAM_BATCH = 500
+
+
+@blueprint.before_request
+def require_login():
+    if g.user is None:
+        abort(401)
+
+
+def json_error(error):
+    return jsonify({"error": error.description}), error.code
+
+
+# by status code, since app-wide handlers for a code (the HTML 404 page)
+# take precedence over a blueprint's handler for HTTPException
+for code in (400, 401, 403, 404, 405):
+    blueprint.register_error_handler(code, json_error)
+
+
+##############################################################################
+# Serialization
+
+
+def requested_fields(available, default):
+    """Field names from ``?fields=``, checked against `available`."""
+
+    fields = request.args.get('fields')
+    if not fields:
+        return default
+
+    fields = tuple(name.strip() for name in fields.split(','))
+    unknown = [name for name in fields if name not in available]
+    if unknown:
+        abort(400, f"Unknown fields: {', '.join(unknown)}. "
+                   f"Choose from: {', '.join(available)}.")
+    return fields
+
+
+def json_value(value):
+    if isinstance(value, datetime):
+        return value.isoformat()
+    raise TypeError(f"{type(value).__name__} is not JSON serializable")
+
+
+def serializer(fields):
+    """Function turning a row of `fields`' values into compact JSON text."""
+
+    paths = [name.split('.') for name in fields]
+    encode = json.JSONEncoder(separators=(',', ':'), default=json_value).encode
+
+    def serialize(row):
+        item = {}
+        for path, value in zip(paths, row):
+            target = item
+            for key in path[:-1]:
+                target = target.setdefault(key, {})
+            target[path[-1]] = value
+        return encode(item)
+    return serialize
+
+
+def page_size():
+    """``?limit=``, or the HTML pages' page size; 400 if out of range."""
+
+    limit = request.args.get('limit', current_app.config.get('MESSAGES_PER_PAGE', 20))
+    try:
+        limit = int(limit)
+    except ValueError:
+        abort(400, "limit must be a number.")
+    if not 1 <= limit <= current_app.config.get('API_MAX_PAGE_SIZE', 1000):
+        abort(400, "limit out of range.")
+    return limit
+
+
+def stream_list(query, fields, cursor_for):
+    """Streamed ``{"items": [...], "next": ...}`` response for one page.
+
+    `query` selects the columns of `fields` followed by the key columns it is
+    ordered by. `cursor_for` turns the key values of a page's last row into
+    the cursor of the next page.
+    """
+
+    limit = page_size()
+    serialize = serializer(fields)
+    width = len(fields)
+    rows = query.limit(limit + 1).yield_per(STREAM_BATCH)
+
+    def generate():
+        yield '{"items":['
+        next_cursor = None
+        last = None
+        for n, row in enumerate(rows):
+            if n == limit:
+                next_cursor = cursor_for(*last[width:])
+                break
+            yield (',' if n else '') + serialize(row[:width])
+            last = row
+        yield '],"next":' + json.dumps(next_cursor) + '}'
+
+    return Response(stream_with_context(generate()), mimetype='application/json')
+
+
+##############################################################################
+# Lists
+
+
+def message_list(query, fields, timestamp_col, id_col):
+    """Stream a page of `query`'s messages, newest first on (timestamp, id)."""
+
+    cursor = request.args.get('cursor')
+    if cursor:
+        query = query.filter(
+            tuple_(timestamp_col, id_col) < tuple_(*decode_cursor(cursor)))
+
+    query = (query
+             .add_columns(timestamp_col, id_col)
+             .order_by(timestamp_col.desc(), id_col.desc()))
+    return stream_list(query, fields, encode_cursor)
+
+
+def user_list(query, fields, id_col):
+    """Stream a page of `query`'s users, in order of `id_col`."""
+
+    cursor = request.args.get('cursor')
+    if cursor:
+        try:
+            query = query.filter(id_col > int(cursor))
+        except ValueError:
+            abort(400, "Invalid cursor.")
+
+    query = query.add_columns(id_col).order_by(id_col)
+    return stream_list(query, fields, str)
+
+
+def select_messages(fields, source=Message, active_authors=False):
+    """Query of `fields`' columns, from `source` joined to the messages'
+    authors if any author fields were asked for, or if `active_authors`
+    leaves out the messages of deleted accounts."""
+
+    query = db.session.query(*[MESSAGE_FIELDS[name] for name in fields])
+    query = query.select_from(source)
+    if source is not Message:
+        query = query.join(Message, Message.id == TimelineEntry.message_id)
+    if active_authors or any(name.startswith('user.') for name in fields):
+        query = query.join(User, User.id == Message.user_id)
+    if active_authors:
+        query = query.filter(User.deleted_at.is_(None))
+    return query
+
+
+def check_user(user_id):
+    """404 unless there's a user `user_id` whose account wasn't deleted."""
+
+    if User.active().filter(User.id == user_id).first() is None:
+        abort(404, "No such user.")
+
+
+@blueprint.route('/timeline')
+def home_timeline():
+    """The logged-in user's home timeline."""
+
+    fields = requested_fields(MESSAGE_FIELDS, DEFAULT_MESSAGE_FIELDS)
+
+    if timeline.enabled():
+        query = (select_messages(fields, TimelineEntry, active_authors=True)
+                 .filter(TimelineEntry.user_id == g.user.id))
+        return message_list(query, fields,
+                            TimelineEntry.timestamp, TimelineEntry.message_id)
+
+    followed_user_ids = (db.session
+                         .query(Follows.user_being_followed_id)
+                         .filter(Follows.user_following_id == g.user.id))
+    query = (select_messages(fields, active_authors=True)
+             .filter(Message.user_id.in_(followed_user_ids)
+                     | (Message.user_id == g.user.id)))
+    return message_list(query, fields, Message.timestamp, Message.id)
+
+
+@blueprint.route('/users/<int:user_id>')
+def user_profile(user_id):
+    """One user's public fields."""
+
+    fields = requested_fields(USER_FIELDS, PUBLIC_USER_FIELDS)
+    row = (db.session
+           .query(*[USER_FIELDS[name] for name in fields])
+           .filter(User.id == user_id, User.deleted_at.is_(None))
+           .first())
+    if row is None:
+        abort(404, "No such user.")
+    return Response(serializer(fields)(row), mimetype='application/json')
+
+
+@blueprint.route('/users/<int:user_id>/messages')
+def user_messages(user_id):
+    """A user's messages, newest first."""
+
+    check_user(user_id)
+    fields = requested_fields(MESSAGE_FIELDS, DEFAULT_MESSAGE_FIELDS)
+    query = select_messages(fields).filter(Message.user_id == user_id)
+    return message_list(query, fields, Message.timestamp, Message.id)
+
+
+@blueprint.route('/users/<int:user_id>/followers')
+def user_followers(user_id):
+    """Users following `user_id`."""
+
+    check_user(user_id)
+    fields = requested_fields(USER_FIELDS, DEFAULT_USER_FIELDS)
+    query = (db.session
+             .query(*[USER_FIELDS[name] for name in fields])
+             .select_from(Follows)
+             .join(User, User.id == Follows.user_following_id)
+             .filter(Follows.user_being_followed_id == user_id,
+                     User.deleted_at.is_(None)))
+    return user_list(query, fields, Follows.user_following_id)
+
+
+@blueprint.route('/users/<int:user_id>/following')
+def user_following(user_id):
+    """Users `user_id` follows."""
+
+    check_user(user_id)
+    fields = requested_fields(USER_FIELDS, DEFAULT_USER_FIELDS)
+    query = (db.session
+             .query(*[USER_FIELDS[name] for name in fields])
+             .select_from(Follows)
+             .join(User, User.id == Follows.user_being_followed_id)
+             .filter(Follows.user_following_id == user_id,
+                     User.deleted_at.is_(None)))
+    return user_list(query, fields, Follows.user_being_followed_id)
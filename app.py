@@ -1,11 +1,34 @@
 import os
+from datetime import datetime
 
-from flask import Flask, render_template, request, flash, redirect, session, g, url_for, jsonify
+import click
+from flask import Flask, render_template, request, flash, redirect, session, g, url_for, jsonify, abort
 # from flask_debugtoolbar import DebugToolbarExtension
+from sqlalchemy import exists
 from sqlalchemy.exc import IntegrityError, InvalidRequestError
+from sqlalchemy.orm import aliased
 from functools import wraps
 from forms import UserAddForm, UserEditForm, LoginForm, MessageForm, EditPasswordForm
-from models import db, connect_db, User, Message, DirectMessage
+from models import db, connect_db, User, Message, DirectMessage, ConversationMember, Follows, Likes, Suggestion, TimelineEntry
+from pagination import Page, paginate, paginate_by_id
+import api
+import caching
+import counters
+import deletion
+import dms
+import explain
+import fragments
+import identity
+import jobs
+import loader
+import migrations
+import passwords
+import querystats
+import replicas
+import search
+import suggestions
+import timeline
+import trending
 
 CURR_USER_KEY = "curr_user"
 
@@ -20,10 +43,86 @@ app.config['SQLALCHEMY_TRACK_MODIFICATIONS'] = False
 app.config['SQLALCHEMY_ECHO'] = False
 # app.config['DEBUG_TB_INTERCEPT_REDIRECTS'] = False
 app.config['SECRET_KEY'] = os.environ.get('SECRET_KEY', "it's a secret")
+# Fan messages out into per-user timeline_entries on write, so the homepage
+# is a single indexed range scan (run `flask rebuild-timelines` after
+# switching this on for an existing database).
+app.config['MATERIALIZED_TIMELINES'] = (
+    os.environ.get('MATERIALIZED_TIMELINES') == '1')
+app.config['TIMELINE_LENGTH'] = int(os.environ.get('TIMELINE_LENGTH', 800))
+app.config['MESSAGES_PER_PAGE'] = int(os.environ.get('MESSAGES_PER_PAGE', 20))
+app.config['SEARCH_PER_PAGE'] = int(os.environ.get('SEARCH_PER_PAGE', 24))
+app.config['SEARCH_MAX_PAGES'] = int(os.environ.get('SEARCH_MAX_PAGES', 50))
+app.config['CURRENT_USER_CACHE_SIZE'] = int(os.environ.get('CURRENT_USER_CACHE_SIZE', 10000))
+app.config['CURRENT_USER_CACHE_TTL'] = int(os.environ.get('CURRENT_USER_CACHE_TTL', 60))
+app.config['FRAGMENT_CACHE_SIZE'] = int(os.environ.get('FRAGMENT_CACHE_SIZE', 10000))
+# Most users one batch follow request may follow.
+app.config['FOLLOW_BATCH_SIZE'] = int(os.environ.get('FOLLOW_BATCH_SIZE', 500))
+# Largest ?limit= a JSON API list accepts.
+app.config['API_MAX_PAGE_SIZE'] = int(os.environ.get('API_MAX_PAGE_SIZE', 1000))
+# bcrypt cost for new hashes; older hashes are upgraded on login.
+app.config['BCRYPT_LOG_ROUNDS'] = int(os.environ.get('BCRYPT_LOG_ROUNDS', 12))
+# Processes hashing passwords for each app worker (0 hashes inline), and how
+# many more calls may wait for them before logins are turned away with a 503.
+app.config['PASSWORD_POOL_WORKERS'] = int(os.environ.get('PASSWORD_POOL_WORKERS', os.cpu_count() or 1))
+app.config['PASSWORD_POOL_QUEUE'] = int(os.environ.get('PASSWORD_POOL_QUEUE', 4 * app.config['PASSWORD_POOL_WORKERS']))
+# Count and time each request's SQL; report it in X-Query-* headers and a
+# log line, flagging statements run QUERY_REPEAT_THRESHOLD+ times (N+1s).
+app.config['QUERY_STATS'] = os.environ.get('QUERY_STATS') == '1'
+app.config['QUERY_REPEAT_THRESHOLD'] = int(os.environ.get('QUERY_REPEAT_THRESHOLD', 3))
+# Read replicas of the primary database (space-separated URLs). GETs of
+# views marked @replicas.read_only read from one of them, except for
+# REPLICA_STICKY_SECONDS after the same client's last write.
+app.config['REPLICA_URIS'] = os.environ.get('DATABASE_REPLICA_URLS', '').split()
+app.config['REPLICA_STICKY_SECONDS'] = int(os.environ.get('REPLICA_STICKY_SECONDS', 5))
+# Each database's connection pool: connections kept open, extra ones opened
+# under load, seconds to wait for a free one and seconds before one is
+# replaced. Unset leaves SQLAlchemy's defaults.
+for setting in ('POOL_SIZE', 'MAX_OVERFLOW', 'POOL_TIMEOUT', 'POOL_RECYCLE'):
+    if f'DB_{setting}' in os.environ:
+        app.config[f'SQLALCHEMY_{setting}'] = int(os.environ[f'DB_{setting}'])
+# Background jobs (see jobs.py): worker threads per app process (0 leaves
+# them to `flask run-jobs`), attempts and retry backoff, seconds before a
+# job left running is taken over, seconds between checks for due retries,
+# and seconds finished jobs are kept. JOBS_INLINE runs each job in the
+# request that enqueues it instead, e.g. for tests.
+app.config['JOB_WORKERS'] = int(os.environ.get('JOB_WORKERS', 2))
+app.config['JOBS_INLINE'] = os.environ.get('JOBS_INLINE') == '1'
+app.config['JOB_MAX_ATTEMPTS'] = int(os.environ.get('JOB_MAX_ATTEMPTS', 5))
+app.config['JOB_RETRY_DELAY'] = int(os.environ.get('JOB_RETRY_DELAY', 5))
+app.config['JOB_MAX_RETRY_DELAY'] = int(os.environ.get('JOB_MAX_RETRY_DELAY', 3600))
+app.config['JOB_TIMEOUT'] = int(os.environ.get('JOB_TIMEOUT', 300))
+app.config['JOB_POLL_INTERVAL'] = float(os.environ.get('JOB_POLL_INTERVAL', 1))
+app.config['JOB_RETENTION'] = int(os.environ.get('JOB_RETENTION', 86400))
+# Rows each batch of a deleted account's purge deletes (see deletion.py).
+app.config['USER_PURGE_BATCH'] = int(os.environ.get('USER_PURGE_BATCH', 1000))
+# Who-to-follow suggestions kept per user, and users recomputed per
+# statement by `flask refresh-suggestions` (see suggestions.py).
+app.config['SUGGESTIONS_PER_USER'] = int(os.environ.get('SUGGESTIONS_PER_USER', 20))
+app.config['SUGGESTIONS_BATCH'] = int(os.environ.get('SUGGESTIONS_BATCH', 1000))
+# Trending messages: a like's weight halves every TRENDING_HALF_LIFE seconds,
+# messages older than TRENDING_WINDOW seconds drop out, and scores are
+# rebased every TRENDING_CHECKPOINT_INTERVAL seconds. Each process caches
+# the top TRENDING_SIZE ids for TRENDING_CACHE_TTL seconds.
+app.config['TRENDING_HALF_LIFE'] = int(os.environ.get('TRENDING_HALF_LIFE', 21600))
+app.config['TRENDING_WINDOW'] = int(os.environ.get('TRENDING_WINDOW', 172800))
+app.config['TRENDING_CHECKPOINT_INTERVAL'] = int(os.environ.get('TRENDING_CHECKPOINT_INTERVAL', 3600))
+app.config['TRENDING_SIZE'] = int(os.environ.get('TRENDING_SIZE', 50))
+app.config['TRENDING_CACHE_TTL'] = int(os.environ.get('TRENDING_CACHE_TTL', 10))
+# Serve process-local cache/DB statistics as JSON at /_stats.
+app.config['EXPOSE_STATS'] = os.environ.get('EXPOSE_STATS') == '1'
 # toolbar = DebugToolbarExtension(app)
 
+replicas.init_app(app)
 connect_db(app)
-db.create_all()
+# The schema is created and upgraded by `flask db-upgrade`, not on import.
+search.detect(db.engine)
+identity.configure(app)
+fragments.configure(app)
+passwords.configure(app)
+trending.configure(app)
+querystats.init_app(app)
+caching.init_app(app)
+app.register_blueprint(api.blueprint)
 
 def login_required(f):
     @wraps(f)
@@ -34,16 +133,98 @@ def login_required(f):
         return f(*args, **kwargs)
     return decorated_function
 
+def prime_follow_state(users):
+    """Look up, in one query, which of `users` the logged-in user follows.
+
+    Answers are memoized on `g` for the rest of the request, where templates
+    read them through `viewer_follows`.
+    """
+
+    if g.user is None:
+        return
+
+    known = g.setdefault('follow_state', {})
+    missing = {user.id for user in users} - known.keys()
+    if missing:
+        followed = g.user.following_among(missing)
+        known.update({user_id: user_id in followed for user_id in missing})
+
+def like_state(rows):
+    """Which messages on this page the logged-in user liked, and like counts.
+
+    `rows` are Messages or (Message, User) rows, as the list views page them.
+    """
+
+    message_ids = [getattr(row, 'Message', row).id for row in rows]
+    viewer_id = g.user.id if g.user else None
+    return Likes.state_for(viewer_id, message_ids)
+
+def viewer_validators(user):
+    """Versions of what a page about `user` shows that depend on the viewer:
+    their navbar identity, which messages they liked and whether they
+    follow `user`."""
+
+    if g.user is None:
+        return None
+    viewer = g.user.load()
+    return (viewer.id, viewer.version, viewer.likes_count, viewer.likes_version,
+            viewer_follows(user))
+
+# What a user card (macros.render_user_card) shows.
+CARD_COLUMNS = (User.id, User.username, User.image_url, User.header_image_url,
+                User.bio, User.version)
+
+def follow_cards(other_id_col, user_id_col, user_id):
+    """A page of cards for the users on the other end of `user_id`'s follows.
+
+    `user_id_col` is the Follows column holding `user_id`, `other_id_col`
+    the one holding the users to show. Rows carry just the card's columns
+    and whether the logged-in user follows each one, which primes
+    `viewer_follows` for the page.
+    """
+
+    viewer = aliased(Follows)
+    viewer_follows_row = (exists()
+                          .where(viewer.user_being_followed_id == User.id)
+                          .where(viewer.user_following_id == g.user.id))
+    page = paginate_by_id(db.session
+                          .query(*CARD_COLUMNS, viewer_follows_row.label('followed'))
+                          .select_from(Follows)
+                          .join(User, User.id == other_id_col)
+                          .filter(user_id_col == user_id, User.deleted_at.is_(None)),
+                          other_id_col, app.config['SEARCH_PER_PAGE'])
+    g.setdefault('follow_state', {}).update({row.id: row.followed for row in page.items})
+    return page
+
+def get_user_or_404(user_id):
+    """The user `user_id`; 404 if there's none, or their account was deleted."""
+
+    return User.active().filter(User.id == user_id).first_or_404()
+
+@app.template_global()
+def viewer_follows(user):
+    """Does the logged-in user follow `user`?"""
+
+    prime_follow_state([user])
+    return g.get('follow_state', {}).get(user.id, False)
+
 ##############################################################################
 # User signup/login/logout
 
 
 @app.before_request
 def add_user_to_g():
-    """If we're logged in, add curr user to Flask global."""
+    """If we're logged in, add curr user to Flask global.
 
-    if CURR_USER_KEY in session:
-        g.user = User.query.get_or_404(session[CURR_USER_KEY])
+    g.user is a CurrentUser built from the cached identity; the full row is
+    only fetched if the view needs more than that.
+    """
+
+    if CURR_USER_KEY in session and request.endpoint != 'static':
+        current = identity.load_identity(session[CURR_USER_KEY])
+        if current is None:
+            abort(404)
+        g.user = identity.CurrentUser(current)
     else:
         g.user = None
 
@@ -99,6 +280,8 @@ def login():
         user = User.authenticate(form.username.data,
                                  form.password.data)
         if user:
+            # authenticate() may have upgraded an outdated password hash
+            db.session.commit()
             do_login(user)
             flash(f"Hello, {user.username}!", "success")
             return redirect(url_for('homepage'))
@@ -119,84 +302,122 @@ def logout():
 # General user routes:
 
 @app.route('/users')
+@replicas.read_only
 def list_users():
-    """Page with listing of users.
-    Can take a 'q' param in querystring to search by that username.
+    """Page with listing of users, newest first.
+    Can take a 'q' param in querystring to search by username or bio,
+    and a 'page' param to page through the results; without one, pages go
+    on from a 'before' user id.
     """
 
-    search = request.args.get('q')
-    if not search:
-        users = User.query.all()
+    search_term = request.args.get('q')
+    if not search_term:
+        page = paginate_by_id(User.active(), User.id, app.config['SEARCH_PER_PAGE'])
     else:
-        users = User.query.filter(User.username.like(f"%{search}%")).all()
-    return render_template('users/index.html', users=users)
+        page = search.search_users(search_term, request.args.get('page', 1, type=int))
+    prime_follow_state(page.items)
+    return render_template('users/index.html', users=page.items, page=page)
 
 
 @app.route('/users/<int:user_id>')
+@replicas.read_only
+@caching.cache_policy(caching.REVALIDATE)
 @login_required
 def users_show(user_id):
     """Show user profile."""
 
-    user = User.query.get_or_404(user_id)
+    user = get_user_or_404(user_id)
+    unchanged = caching.not_modified(
+        user.version, user.messages_version,
+        *[getattr(user, name) for name in counters.COUNTER_COLUMNS],
+        viewer_validators(user))
+    if unchanged:
+        return unchanged
 
-    # snagging messages in order from the database;
-    # user.messages won't be in order by default
-    messages = (Message
-                .query
-                .filter(Message.user_id == user_id)
-                .order_by(Message.timestamp.desc())
-                .limit(100)
-                .all())
-    likes = [msg.id for msg in g.user.likes]
-    return render_template('users/show.html', user=user, messages=messages, likes=likes)
+    page = paginate(Message.query.filter(Message.user_id == user_id),
+                    Message.timestamp, Message.id)
+    return render_template('users/show.html', user=user, messages=page.items, page=page,
+                           likes=like_state(page.items))
 
 @app.route('/users/<int:user_id>/likes')
 @login_required
 def show_likes(user_id):
     """Show list of messages this user likes"""
 
-    user = User.query.get_or_404(user_id)
-    user_like_ids = [msg.id for msg in user.likes]
-    messages = (db.session
-                .query(Message, User)
-                .join(User)
-                .filter(Message.id.in_(user_like_ids))
-                .order_by(Message.timestamp.desc())
-                .all())
-    likes = [msg.id for msg in g.user.likes]
-
-    return render_template('/users/likes.html', user=user, messages=messages, likes=likes)
+    user = get_user_or_404(user_id)
+    page = paginate(db.session
+                    .query(Message, User)
+                    .join(User)
+                    .join(Likes, Likes.message_id == Message.id)
+                    .filter(Likes.user_id == user_id, User.deleted_at.is_(None)),
+                    Message.timestamp, Message.id)
+    return render_template('/users/likes.html', user=user, messages=page.items, page=page,
+                           likes=like_state(page.items))
 
 @app.route('/users/<int:user_id>/following')
+@replicas.read_only
 @login_required
 def show_following(user_id):
     """Show list of people this user is following."""
 
-    user = User.query.get_or_404(user_id)
-    return render_template('users/following.html', user=user)
+    user = get_user_or_404(user_id)
+    page = follow_cards(Follows.user_being_followed_id, Follows.user_following_id, user_id)
+    return render_template('users/following.html', user=user, users=page.items, page=page)
 
 
 @app.route('/users/<int:user_id>/followers')
+@replicas.read_only
 @login_required
 def users_followers(user_id):
     """Show list of followers of this user."""
 
-    user = User.query.get_or_404(user_id)
-    return render_template('users/followers.html', user=user)
+    user = get_user_or_404(user_id)
+    page = follow_cards(Follows.user_following_id, Follows.user_being_followed_id, user_id)
+    return render_template('users/followers.html', user=user, users=page.items, page=page)
+
+@app.route('/users/suggestions')
+@login_required
+def show_suggestions():
+    """Show accounts the logged-in user might want to follow, best first."""
+
+    if suggestions.refresh_if_queued(g.user.id):
+        db.session.commit()
+
+    viewer = aliased(Follows)
+    users = (db.session
+             .query(*CARD_COLUMNS)
+             .select_from(Suggestion)
+             .join(User, User.id == Suggestion.suggested_id)
+             .filter(Suggestion.user_id == g.user.id, User.deleted_at.is_(None))
+             # followed since the suggestions were computed
+             .filter(~exists()
+                     .where(viewer.user_being_followed_id == Suggestion.suggested_id)
+                     .where(viewer.user_following_id == g.user.id))
+             .order_by(Suggestion.rank)
+             .all())
+    g.setdefault('follow_state', {}).update({user.id: False for user in users})
+    return render_template('users/suggestions.html', users=users)
 
 @app.route('/users/inbox')
 @login_required
 def show_inbox():
-    """Show list of direct messages sent to logged in user"""
+    """Show the logged-in user's conversations, latest activity first."""
 
-    return render_template('/users/dms.html', user=g.user, dms=g.user.inbox)
+    page = paginate(dms.inbox_query(g.user.id),
+                    ConversationMember.last_message_at,
+                    ConversationMember.conversation_id,
+                    key=dms.inbox_key)
+    return render_template('users/inbox.html', user=g.user,
+                           conversations=page.items, page=page)
 
 @app.route('/users/outbox')
 @login_required
 def show_outbox():
     """Show list of direct messages sent by logged in user"""
 
-    return render_template('/users/dms.html', user=g.user, dms=g.user.outbox)
+    page = paginate(dms.outbox_query(g.user.id),
+                    DirectMessage.timestamp, DirectMessage.id, key=dms.dm_key)
+    return render_template('users/dms.html', user=g.user, dms=page.items, page=page)
 
 @app.route('/users/profile', methods=["GET", "POST"])
 @login_required
@@ -219,6 +440,7 @@ def profile():
             user.bio = form.bio.data
             db.session.add(user)
             db.session.commit()
+            identity.forget(user.id)
             return redirect(url_for('users_show', user_id=g.user.id))
         except (InvalidRequestError, IntegrityError):
             db.session.rollback()
@@ -243,6 +465,7 @@ def change_password():
             return redirect(url_for('homepage'))
         try:
             db.session.commit()
+            identity.forget(g.user.id)
             flash('Password successfully changed', 'success')
             return redirect(url_for('users_show', user_id=g.user.id))
         except (InvalidRequestError, IntegrityError):
@@ -254,25 +477,43 @@ def change_password():
 @app.route('/users/delete', methods=["POST"])
 @login_required
 def delete_user():
-    """Delete user."""
+    """Delete user: hide the account now, and purge its rows in the background."""
 
-    do_logout()
-    db.session.delete(g.user)
+    deletion.soft_delete(g.user.load())
     db.session.commit()
+    identity.forget(g.user.id)
+    do_logout()
 
-    return redirect(url_for('/signup'))
+    return redirect(url_for('signup'))
 
 ###########################################################################
 # Follow Routes:
 
+def follow_users(user_ids):
+    """Have the logged-in user follow each of `user_ids` not followed yet.
+
+    One keyed insert, plus the counter and timeline upkeep for the follows
+    it added; returns the ids newly followed. The caller commits.
+    """
+
+    followed = Follows.add(g.user.id, user_ids)
+    if followed:
+        connection = db.session.connection()
+        counters.adjust(connection, g.user.id, following_count=len(followed))
+        counters.adjust_many(connection, list(followed), followers_count=1)
+        if timeline.enabled():
+            jobs.enqueue('timeline.backfill', follower_id=g.user.id,
+                         followed_ids=sorted(followed))
+        jobs.enqueue('suggestions.follows_changed', user_id=g.user.id)
+    return followed
+
 @app.route('/users/<int:follow_id>/follow', methods=['POST'])
 @login_required
 def add_follow(follow_id):
     """Add a follow for the currently-logged-in user."""
 
-    followed_user = User.query.get_or_404(follow_id)
-    if followed_user not in g.user.following:
-        g.user.following.append(followed_user)
+    followed_user = get_user_or_404(follow_id)
+    if follow_users([followed_user.id]):
         db.session.commit()
         return jsonify({"message": "Following successful",
             "type": "success",
@@ -283,14 +524,41 @@ def add_follow(follow_id):
         "following_user": g.user.serialize(),
         "followed_user": followed_user.serialize()})
 
+@app.route('/users/follow', methods=['POST'])
+@login_required
+def add_follows():
+    """Follow a batch of users (``user_ids``, as JSON or repeated form
+    fields) in one transaction; returns only the ids newly followed."""
+
+    data = request.get_json(silent=True) or {}
+    try:
+        user_ids = {int(user_id) for user_id in
+                    data.get('user_ids', request.form.getlist('user_ids'))}
+    except (TypeError, ValueError):
+        abort(400)
+    if len(user_ids) > app.config['FOLLOW_BATCH_SIZE']:
+        abort(400)
+
+    followed = follow_users(user_ids) if user_ids else set()
+    db.session.commit()
+    return jsonify({"message": f"Followed {len(followed)} users",
+        "type": "success",
+        "followed_ids": sorted(followed)})
+
 @app.route('/users/<int:follow_id>/unfollow', methods=['POST'])
 @login_required
 def stop_following(follow_id):
     """Have currently-logged-in-user stop following this user."""
 
     followed_user = User.query.get_or_404(follow_id)
-    if followed_user in g.user.following:
-        g.user.following.remove(followed_user)
+    if Follows.remove(g.user.id, followed_user.id):
+        connection = db.session.connection()
+        counters.adjust(connection, g.user.id, following_count=-1)
+        counters.adjust(connection, followed_user.id, followers_count=-1)
+        if timeline.enabled():
+            jobs.enqueue('timeline.prune', follower_id=g.user.id,
+                         followed_id=followed_user.id)
+        jobs.enqueue('suggestions.follows_changed', user_id=g.user.id)
         db.session.commit()
         return jsonify({"message": "Un-following successful", 
             "type": "success", 
@@ -315,18 +583,59 @@ def messages_add():
     form = MessageForm()
 
     if form.validate_on_submit():
-        msg = Message(text=form.text.data)
-        g.user.messages.append(msg)
+        # by id: g.user is the cached identity, so don't load the User
+        msg = Message(user_id=g.user.id, text=form.text.data)
+        db.session.add(msg)
+        if timeline.enabled():
+            db.session.flush()
+            jobs.enqueue('timeline.fan_out', key=f"fan-out:{msg.id}",
+                         message_id=msg.id)
         db.session.commit()
         return redirect(url_for('users_show', user_id=g.user.id))
 
     return render_template('messages/new.html', form=form)
 
+@app.route('/messages/search')
+def messages_search():
+    """Show messages matching the 'q' param, best matches first."""
+
+    search_term = request.args.get('q', '')
+    page_number = request.args.get('page', 1, type=int)
+    page = None
+    if search_term.strip():
+        page = search.search_messages(search_term, page_number)
+    messages = page.items if page else []
+    return render_template('messages/search.html', q=search_term,
+                           messages=messages, page=page, likes=like_state(messages))
+
+@app.route('/messages/trending')
+def messages_trending():
+    """Show the recent messages with the most (recent) likes, best first."""
+
+    ids = trending.top_ids()
+    rows = (db.session
+            .query(Message, User)
+            .join(User)
+            .filter(Message.id.in_(ids), User.deleted_at.is_(None))
+            .all()) if ids else []
+    rank = {message_id: position for position, message_id in enumerate(ids)}
+    messages = sorted(rows, key=lambda row: rank[row.Message.id])
+    return render_template('messages/trending.html', messages=messages,
+                           likes=like_state(messages))
+
 @app.route('/messages/<int:message_id>', methods=["GET"])
+@caching.cache_policy(caching.REVALIDATE)
 def messages_show(message_id):
     """Show a message."""
 
     msg = Message.query.get_or_404(message_id)
+    if msg.user.deleted_at is not None:
+        abort(404)
+    unchanged = caching.not_modified(msg.text, msg.user.version,
+                                     viewer_validators(msg.user))
+    if unchanged:
+        return unchanged
+
     return render_template('messages/show.html', message=msg)
 
 @app.route('/messages/<int:message_id>/delete', methods=["POST"])
@@ -346,11 +655,18 @@ def messages_destroy(message_id):
 @login_required
 def add_like(message_id):
     """Have currently-logged-in-user like this message."""
-    message = Message.query.get_or_404(message_id)
-
-    if message not in g.user.likes:
-        g.user.likes.append(message)
-        db.session.add(g.user)
+    message = Message.query.get(message_id)
+    if message is None or message.user.deleted_at is not None:
+        return jsonify({"message": f"Message {message_id} not found.", "type": "danger"}), 404
+
+    liked_at = datetime.utcnow()
+    if Likes.add(g.user.id, message.id, liked_at):
+        connection = db.session.connection()
+        counters.adjust(connection, g.user.id, likes_count=1, likes_version=1)
+        jobs.enqueue('counters.adjust', user_id=message.user_id, likes_received_count=1,
+                     messages_version=1)
+        jobs.enqueue('trending.record', message_id=message.id,
+                     liked_at=liked_at.isoformat())
         db.session.commit()
         return jsonify({"message":f"Message {message.id} successfully liked!", "type": "success"})
     return jsonify({"message":f"Message {message.id} already liked.", "type": "warning"})
@@ -361,28 +677,59 @@ def remove_like(message_id):
     """Have currently-logged-in-user stop liking this message."""
 
     message = Message.query.get_or_404(message_id)
-    if message in g.user.likes:
-        g.user.likes.remove(message)
-        db.session.add(g.user)
+    # trending takes off what this like added, which depends on its age
+    liked_at = (db.session
+                .query(Likes.timestamp)
+                .filter(Likes.user_id == g.user.id, Likes.message_id == message.id)
+                .scalar())
+    if Likes.remove(g.user.id, message.id):
+        connection = db.session.connection()
+        counters.adjust(connection, g.user.id, likes_count=-1, likes_version=1)
+        jobs.enqueue('counters.adjust', user_id=message.user_id, likes_received_count=-1,
+                     messages_version=1)
+        jobs.enqueue('trending.record', message_id=message.id, sign=-1,
+                     liked_at=liked_at and liked_at.isoformat())
         db.session.commit()
         return jsonify({"message":f"Message {message.id} successfully unliked!", "type": "success"})
     return jsonify({"message":f"Message {message.id} not currently liked.", "type": "warning"})
 
+@app.route('/dm/<int:user_id>')
+@login_required
+def dm_thread(user_id):
+    """Show the logged-in user's conversation with this user, newest first,
+    and mark it read."""
+
+    other = get_user_or_404(user_id)
+    member = dms.conversation_between(g.user.id, user_id).first()
+    if member is None:
+        page = Page([], None)
+    else:
+        dms.mark_read(member)
+        db.session.commit()
+        page = paginate(dms.thread_query(member.conversation_id),
+                        DirectMessage.timestamp, DirectMessage.id, key=dms.dm_key)
+
+    return render_template('messages/thread.html', other=other, dms=page.items,
+                           page=page, form=MessageForm())
+
 @app.route('/dm/<int:user_id>/new', methods=["GET", "POST"])
 @login_required
 def direct_message(user_id):
     """Send a direct message:
-    Show form if GET. If valid, update message and redirect to logged in user's page.
+    Show form if GET. If valid, send it and show the conversation.
     """
-    recipient = User.query.get_or_404(user_id)
+    recipient = get_user_or_404(user_id)
+    if recipient.id == g.user.id:
+        flash("You can't send a message to yourself.", "danger")
+        return redirect(url_for('users_show', user_id=g.user.id))
+
     form = MessageForm()
 
     if form.validate_on_submit():
-        dm = DirectMessage(author_id=g.user.id, recipient_id=user_id, text=form.text.data)
-        db.session.add(dm)
+        dms.send(g.user.id, recipient.id, form.text.data)
         db.session.commit()
 
-        return redirect(url_for('users_show', user_id=g.user.id))
+        return redirect(url_for('dm_thread', user_id=recipient.id))
 
     return render_template('messages/new.html', recipient=recipient, form=form)
 
@@ -391,23 +738,29 @@ def direct_message(user_id):
 
 
 @app.route('/')
+@replicas.read_only
 def homepage():
     """Show homepage:
     - anon users: no messages
-    - logged in: 100 most recent messages of followed_users
+    - logged in: most recent messages of followed_users, a page at a time
     """
 
     if g.user:
-        followed_user_ids = [user.id for user in g.user.following]
-        messages = (db.session
-                    .query(Message, User)
-                    .join(User)
-                    .filter((Message.user_id.in_(followed_user_ids)) | (Message.user_id == g.user.id))
-                    .order_by(Message.timestamp.desc())
-                    .limit(100)
-                    .all())
-        likes = [msg.id for msg in g.user.likes]
-        return render_template('home.html', messages=messages, likes=likes)
+        if timeline.enabled():
+            page = paginate(timeline.timeline_query(g.user.id),
+                            TimelineEntry.timestamp, TimelineEntry.message_id)
+        else:
+            followed_user_ids = (db.session
+                                 .query(Follows.user_being_followed_id)
+                                 .filter(Follows.user_following_id == g.user.id))
+            page = paginate(db.session
+                            .query(Message, User)
+                            .join(User)
+                            .filter((Message.user_id.in_(followed_user_ids)) | (Message.user_id == g.user.id))
+                            .filter(User.deleted_at.is_(None)),
+                            Message.timestamp, Message.id)
+        return render_template('home.html', messages=page.items, page=page,
+                               likes=like_state(page.items))
 
     else:
         return render_template('home-anon.html')
@@ -420,19 +773,131 @@ def not_found_error(error):
 def internal_error(error):
 	db.session.rollback()
 	return render_template('errors/500.html'), 500
+
+@app.errorhandler(passwords.PasswordPoolBusy)
+def password_pool_busy(error):
+    """Too many logins/signups already waiting on bcrypt: shed this one."""
+
+    db.session.rollback()
+    return ("Too many sign-ins right now; please try again in a moment.",
+            503, {'Retry-After': '1'})
+
+@app.route('/_stats')
+def show_stats():
+    """Process-local cache and pool statistics, when EXPOSE_STATS is set."""
+
+    if not app.config['EXPOSE_STATS']:
+        abort(404)
+
+    return jsonify({
+        "current_user_cache": identity.identities.stats(),
+        "fragment_cache": fragments.fragments.stats(),
+        "password_pool": passwords.stats(),
+        "db_pools": replicas.pool_stats(),
+        "jobs": jobs.stats(),
+    })
+
 ##############################################################################
-# Turn off all caching in Flask
-#   (useful for dev; in production, this kind of stuff is typically
-#   handled elsewhere)
-#
-# https://stackoverflow.com/questions/34066804/disabling-caching-in-flask
-
-@app.after_request
-def add_header(req):
-    """Add non-caching headers on every request."""
-
-    req.headers["Cache-Control"] = "no-cache, no-store, must-revalidate"
-    req.headers["Pragma"] = "no-cache"
-    req.headers["Expires"] = "0"
-    req.headers['Cache-Control'] = 'public, max-age=0'
-    return req
\ No newline at end of file
+# Maintenance commands (run with `flask <command>`)
+
+@app.cli.command('db-upgrade')
+def db_upgrade_command():
+    """Create the database, or apply the migrations it hasn't had."""
+
+    applied = migrations.upgrade(db.engine, echo=click.echo)
+    click.echo(f"Database at version {migrations.latest_version()} "
+               f"({len(applied)} migrations applied).")
+
+@app.cli.command('db-version')
+def db_version_command():
+    """Show the database's schema version, and the latest one."""
+
+    with db.engine.connect() as connection:
+        version = migrations.current_version(connection)
+    click.echo(f"Database at version {version}; "
+               f"latest is {migrations.latest_version()}.")
+
+@app.cli.command('explain-routes')
+@click.option('--min-rows', default=explain.MIN_ROWS,
+              help="Smallest table (estimated rows) a sequential scan may not read.")
+def explain_routes_command(min_rows):
+    """EXPLAIN the SQL of the hot routes; fail on sequential scans of big tables."""
+
+    problems = explain.check_routes(app, CURR_USER_KEY, min_rows)
+    for route, table, statement in problems:
+        click.echo(f"{route}: sequential scan of {table}\n    {statement}")
+    if problems:
+        raise SystemExit(1)
+    click.echo("No sequential scans of large tables.")
+
+@app.cli.command('rebuild-timelines')
+def rebuild_timelines_command():
+    """Recompute every materialized home timeline from follows/messages."""
+
+    count = timeline.rebuild_timelines()
+    click.echo(f"Rebuilt home timelines: {count} entries.")
+
+@app.cli.command('reconcile-counters')
+@click.option('--batch-size', default=1000, help="Users repaired per transaction.")
+def reconcile_counters_command(batch_size):
+    """Recompute drifted follower/following/message/like counters."""
+
+    repaired = counters.reconcile_counters(batch_size)
+    click.echo(f"Reconciled counters: {repaired} users corrected.")
+
+@app.cli.command('purge-users')
+@click.option('--batch-size', default=None, type=int,
+              help="Rows deleted per transaction (default USER_PURGE_BATCH).")
+def purge_users_command(batch_size):
+    """Purge deleted accounts now, rather than in background jobs."""
+
+    purged = deletion.purge_deleted(batch_size, echo=click.echo)
+    click.echo(f"Purged {purged} deleted accounts.")
+
+@app.cli.command('refresh-suggestions')
+@click.option('--all', 'everyone', is_flag=True,
+              help="Recompute every user's suggestions, not just the queued ones.")
+def refresh_suggestions_command(everyone):
+    """Recompute who-to-follow suggestions."""
+
+    if everyone:
+        refreshed = suggestions.refresh_all(echo=click.echo)
+    else:
+        refreshed = suggestions.refresh_queued(echo=click.echo)
+    click.echo(f"Refreshed suggestions for {refreshed} users.")
+
+@app.cli.command('rebuild-trending')
+def rebuild_trending_command():
+    """Score recent messages from their likes so far, restarting trending."""
+
+    scored = trending.rebuild()
+    db.session.commit()
+    click.echo(f"Rebuilt trending: {scored} messages scored.")
+
+@app.cli.command('run-jobs')
+@click.option('--workers', default=2, help="Worker threads.")
+@click.option('--drain', is_flag=True, help="Run the jobs due now, then exit.")
+def run_jobs_command(workers, drain):
+    """Run background jobs until interrupted."""
+
+    if drain:
+        click.echo(f"Ran {jobs.run_pending()} jobs.")
+        return
+    click.echo(f"Running jobs with {workers} workers; Ctrl-C to stop.")
+    jobs.serve(app, workers)
+
+@app.cli.command('load-data')
+@click.argument('source', default='generator')
+@click.option('--chunk-size', default=loader.CHUNK_SIZE, help="Rows written per transaction.")
+@click.option('--jobs', default=3, help="Tables loaded at once (PostgreSQL only).")
+@click.option('--resume', is_flag=True,
+              help="Continue a failed load after its last committed chunks, instead of starting over.")
+def load_data_command(source, chunk_size, jobs, resume):
+    """Bulk-load <table>.csv files from SOURCE (default: generator).
+
+    Drops and recreates every table first, unless resuming.
+    """
+
+    loaded = loader.load(source, chunk_size, jobs, resume, echo=click.echo)
+    click.echo("Loaded " + ", ".join(f"{name}: {rows:,} rows"
+                                     for name, rows in loaded.items()) + ".")
@@ -0,0 +1,334 @@
+"""Load-test a running Warbler.
+
+Logs in one synthetic user per concurrent client, taken from the seeded
+users CSV (every seed user's password is "password"). Each client then
+replays a weighted mix of routes against the app for a fixed time.
+Reported per route: requests, errors, and p50/p95/p99 latency. Also
+reported: overall throughput. With ``--compare``, a route whose p95 rose,
+or a throughput that fell, by more than ``--tolerance`` is a regression,
+and the run exits with status 1.
+
+    FLASK_APP=app.py flask run --no-reload &
+    python benchmarks/loadtest.py --concurrency 32 --duration 60 \\
+        --output results/after.json --compare results/before.json
+
+Only the standard library is needed.
+"""
+
+import argparse
+import csv
+import json
+import math
+import re
+import sys
+import threading
+from collections import defaultdict
+from http.cookiejar import CookieJar
+from random import Random
+from time import monotonic
+from urllib.error import HTTPError, URLError
+from urllib.parse import urlencode
+from urllib.request import HTTPCookieProcessor, HTTPRedirectHandler, build_opener
+
+DEFAULT_MIX = 'homepage=50,users_show=25,add_like=15,messages_add=5,add_follow=5'
+
+CSRF_TOKEN = re.compile(r'name="csrf_token"[^>]*value="([^"]+)"')
+
+
+class NoRedirect(HTTPRedirectHandler):
+    """Report redirects as responses instead of following them.
+
+    Every write route redirects when it's done. Following the redirect would
+    add a homepage render to the write's latency.
+    """
+
+    def redirect_request(self, *args, **kwargs):
+        return None
+
+
+class Client:
+    """One logged-in synthetic user."""
+
+    def __init__(self, base_url, timeout):
+        self.base_url = base_url.rstrip('/')
+        self.timeout = timeout
+        self.opener = build_opener(HTTPCookieProcessor(CookieJar()), NoRedirect)
+        self.csrf_token = None
+
+    def request(self, path, data=None):
+        """(status, body) of one request; POSTs if `data` is given."""
+
+        if data is not None:
+            data = urlencode(data).encode('UTF-8')
+        try:
+            with self.opener.open(self.base_url + path, data,
+                                  timeout=self.timeout) as response:
+                return response.status, response.read()
+        except HTTPError as error:
+            return error.code, error.read()
+
+    def login(self, username, password):
+        status, body = self.request('/login')
+        match = CSRF_TOKEN.search(body.decode('UTF-8'))
+        if status != 200 or not match:
+            raise RuntimeError(f"no login form at {self.base_url}/login")
+        # Flask-WTF accepts the same token on every form for the session
+        self.csrf_token = match.group(1)
+
+        status, body = self.request('/login', {
+            'username': username,
+            'password': password,
+            'csrf_token': self.csrf_token,
+        })
+        if status != 302:
+            raise RuntimeError(f"could not log in as {username} ({status})")
+
+
+##############################################################################
+# The route mix: each action makes one request and returns its status.
+
+
+def homepage(client, rng, options):
+    return client.request('/')[0]
+
+
+def users_show(client, rng, options):
+    return client.request(f"/users/{rng.randint(1, options.num_users)}")[0]
+
+
+def messages_add(client, rng, options):
+    return client.request('/messages/new', {
+        'text': f"Load test message {rng.getrandbits(32):08x}",
+        'csrf_token': client.csrf_token,
+    })[0]
+
+
+def add_like(client, rng, options):
+    message_id = rng.randint(1, options.num_messages)
+    return client.request(f"/messages/{message_id}/like", {})[0]
+
+
+def add_follow(client, rng, options):
+    return client.request(f"/users/{rng.randint(1, options.num_users)}/follow", {})[0]
+
+
+ACTIONS = {action.__name__: action
+           for action in (homepage, users_show, messages_add, add_like, add_follow)}
+
+
+def parse_mix(mix):
+    """'homepage=50,add_like=10' -> [('homepage', 50), ('add_like', 10)]."""
+
+    weights = []
+    for part in mix.split(','):
+        name, _, weight = part.partition('=')
+        if name not in ACTIONS:
+            raise argparse.ArgumentTypeError(
+                f"unknown route {name!r}; choose from {', '.join(ACTIONS)}")
+        weights.append((name, float(weight or 1)))
+    return weights
+
+
+##############################################################################
+# Running and reporting
+
+
+def percentile(ordered, fraction):
+    """Nearest-rank percentile of an already sorted list: the smallest value
+    at least `fraction` of them are no greater than."""
+
+    if not ordered:
+        return None
+    rank = math.ceil(fraction * len(ordered))
+    return ordered[min(len(ordered), max(rank, 1)) - 1]
+
+
+def run_client(client, rng, options, deadline, results, lock):
+    names = [name for name, weight in options.mix]
+    weights = [weight for name, weight in options.mix]
+    samples = defaultdict(list)
+    errors = defaultdict(int)
+
+    while monotonic() < deadline:
+        name = rng.choices(names, weights)[0]
+        started = monotonic()
+        try:
+            status = ACTIONS[name](client, rng, options)
+        except (URLError, OSError):
+            status = None
+        samples[name].append(monotonic() - started)
+        if status is None or status >= 400:
+            errors[name] += 1
+
+    with lock:
+        for name, latencies in samples.items():
+            results['latencies'][name].extend(latencies)
+            results['errors'][name] += errors[name]
+
+
+def summarize(results, elapsed):
+    routes = {}
+    total = 0
+    for name, latencies in sorted(results['latencies'].items()):
+        latencies.sort()
+        total += len(latencies)
+        routes[name] = {
+            'requests': len(latencies),
+            'errors': results['errors'][name],
+            'error_rate': results['errors'][name] / len(latencies),
+            'throughput': len(latencies) / elapsed,
+            'p50_ms': percentile(latencies, 0.50) * 1000,
+            'p95_ms': percentile(latencies, 0.95) * 1000,
+            'p99_ms': percentile(latencies, 0.99) * 1000,
+        }
+    return {
+        'requests': total,
+        'errors': sum(route['errors'] for route in routes.values()),
+        'throughput': total / elapsed,
+        'routes': routes,
+    }
+
+
+def relative_change(new, old):
+    """(new - old) / old, or None without an old value to compare to."""
+
+    return (new - old) / old if old else None
+
+
+def regressions(summary, baseline, tolerance):
+    """What got worse than `baseline` by more than `tolerance` (a fraction):
+    {'p95 <route>' or 'throughput': relative change}.
+
+    Routes missing from either run aren't compared.
+    """
+
+    found = {}
+    for name, route in summary['routes'].items():
+        old = baseline.get('routes', {}).get(name)
+        if not old:
+            continue
+        change = relative_change(route['p95_ms'], old['p95_ms'])
+        if change is not None and change > tolerance:
+            found[f"p95 {name}"] = change
+    change = relative_change(summary['throughput'], baseline.get('throughput'))
+    if change is not None and change < -tolerance:
+        found['throughput'] = change
+    return found
+
+
+def print_summary(summary, baseline=None):
+    def change(new, old):
+        ratio = relative_change(new, old)
+        return f" ({ratio:+.0%})" if ratio is not None else ""
+
+    print(f"{'route':<14} {'reqs':>7} {'err%':>6} {'rps':>8} "
+          f"{'p50 ms':>8} {'p95 ms':>8} {'p99 ms':>8}")
+    for name, route in summary['routes'].items():
+        print(f"{name:<14} {route['requests']:>7} {route['error_rate']:>6.1%} "
+              f"{route['throughput']:>8.1f} {route['p50_ms']:>8.1f} "
+              f"{route['p95_ms']:>8.1f} {route['p99_ms']:>8.1f}", end='')
+        old = (baseline or {}).get('routes', {}).get(name)
+        if old:
+            print(f"   p95{change(route['p95_ms'], old['p95_ms'])}", end='')
+        print()
+
+    print(f"total: {summary['requests']} requests, {summary['errors']} errors, "
+          f"{summary['throughput']:.1f} req/s", end='')
+    if baseline:
+        print(change(summary['throughput'], baseline['throughput']), end='')
+    print()
+
+
+def read_usernames(path, count, rng):
+    """`count` usernames from the users CSV, and how many users it holds."""
+
+    with open(path, newline='') as f:
+        usernames = [row['username'] for row in csv.DictReader(f)]
+    return rng.sample(usernames, min(count, len(usernames))), len(usernames)
+
+
+def count_rows(path):
+    with open(path, newline='') as f:
+        return sum(1 for row in csv.reader(f)) - 1
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--url', default='http://localhost:5000')
+    parser.add_argument('--concurrency', type=int, default=16,
+                        help="clients (each a logged-in user) running at once")
+    parser.add_argument('--duration', type=float, default=30,
+                        help="seconds to run for, after logging in")
+    parser.add_argument('--mix', type=parse_mix, default=parse_mix(DEFAULT_MIX),
+                        help=f"weighted routes (default {DEFAULT_MIX})")
+    parser.add_argument('--users-csv', default='generator/users.csv')
+    parser.add_argument('--messages-csv', default='generator/messages.csv')
+    parser.add_argument('--password', default='password')
+    parser.add_argument('--seed', default='loadtest')
+    parser.add_argument('--timeout', type=float, default=30)
+    parser.add_argument('--output', help="write the results here as JSON")
+    parser.add_argument('--compare', help="JSON results of an earlier run")
+    parser.add_argument('--tolerance', type=float, default=0.10,
+                        help="how much worse than --compare counts as a regression "
+                             "(default 0.10, i.e. 10%%)")
+    options = parser.parse_args()
+
+    rng = Random(options.seed)
+    usernames, options.num_users = read_usernames(
+        options.users_csv, options.concurrency, rng)
+    options.num_messages = count_rows(options.messages_csv)
+
+    print(f"logging in {len(usernames)} users at {options.url}")
+    clients = []
+    for username in usernames:
+        client = Client(options.url, options.timeout)
+        client.login(username, options.password)
+        clients.append(client)
+
+    results = {'latencies': defaultdict(list), 'errors': defaultdict(int)}
+    lock = threading.Lock()
+    deadline = monotonic() + options.duration
+    threads = [threading.Thread(target=run_client,
+                                args=(client, Random(f"{options.seed}:{i}"),
+                                      options, deadline, results, lock))
+               for i, client in enumerate(clients)]
+
+    started = monotonic()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    elapsed = monotonic() - started
+
+    summary = summarize(results, elapsed)
+    summary['config'] = {
+        'url': options.url,
+        'concurrency': len(clients),
+        'duration': options.duration,
+        'mix': dict(options.mix),
+        'seed': options.seed,
+    }
+
+    baseline = None
+    if options.compare:
+        with open(options.compare) as f:
+            baseline = json.load(f)
+    print_summary(summary, baseline)
+
+    if options.output:
+        with open(options.output, 'w') as f:
+            json.dump(summary, f, indent=2)
+
+    if summary['requests'] == 0:
+        return 1
+    if baseline:
+        worse = regressions(summary, baseline, options.tolerance)
+        for what, change in worse.items():
+            print(f"regression: {what} {change:+.0%}")
+        if worse:
+            return 1
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,68 @@
+"""Benchmark password checks (logins) through the bcrypt pool.
+
+Runs a burst of concurrent password checks the way login requests would, for
+each pool size given, and reports logins/sec overall and per core used.
+
+Run from the project root, e.g.:
+
+    python benchmarks/logins.py --rounds 12 --workers 1 2 4 --logins 200
+"""
+
+import argparse
+import os
+import sys
+from concurrent.futures import ThreadPoolExecutor
+from time import perf_counter
+from types import SimpleNamespace
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import passwords  # noqa: E402
+
+
+def run(rounds, workers, logins, clients):
+    """Time `logins` checks issued from `clients` threads; logins/sec."""
+
+    passwords.configure(SimpleNamespace(config={
+        'BCRYPT_LOG_ROUNDS': rounds,
+        'PASSWORD_POOL_WORKERS': workers,
+        # the benchmark measures throughput, not shedding
+        'PASSWORD_POOL_QUEUE': logins,
+    }))
+    hashed = passwords.hash_password("benchmark-password")
+
+    with ThreadPoolExecutor(max_workers=clients) as threads:
+        start = perf_counter()
+        results = list(threads.map(
+            lambda _: passwords.check_password(hashed, "benchmark-password"),
+            range(logins)))
+        elapsed = perf_counter() - start
+
+    assert all(results)
+    return logins / elapsed
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--rounds', type=int, default=12,
+                        help="bcrypt cost (default 12)")
+    parser.add_argument('--workers', type=int, nargs='+',
+                        default=[0, os.cpu_count() or 1],
+                        help="pool sizes to try; 0 checks inline")
+    parser.add_argument('--logins', type=int, default=100,
+                        help="password checks per run (default 100)")
+    parser.add_argument('--clients', type=int, default=16,
+                        help="concurrent callers (default 16)")
+    args = parser.parse_args()
+
+    print(f"bcrypt cost {args.rounds}, {args.logins} logins, "
+          f"{args.clients} concurrent callers, {os.cpu_count()} cores")
+    print(f"{'workers':>8} {'logins/s':>10} {'per core':>10}")
+    for workers in args.workers:
+        rate = run(args.rounds, workers, args.logins, args.clients)
+        cores = min(max(workers, 1), os.cpu_count() or 1)
+        print(f"{workers:>8} {rate:>10.1f} {rate / cores:>10.1f}")
+
+
+if __name__ == '__main__':
+    main()
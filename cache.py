@@ -0,0 +1,98 @@
+"""Process-local caches for Warbler."""
+
+import threading
+from collections import OrderedDict
+from time import monotonic
+
+MISSING = object()
+
+
+class LRUCache:
+    """Thread-safe, size-bounded LRU cache with optional per-entry expiry.
+
+    Entries older than `ttl` seconds (if given) are treated as misses. The
+    least recently used entry is evicted once more than `maxsize` are held.
+    Each cache counts its own hits, misses and evictions for :meth:`stats`.
+    """
+
+    def __init__(self, maxsize=1024, ttl=None):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key, default=None, valid=None):
+        """Return the cached value for `key`, or `default` on a miss.
+
+        If `valid` is given, a cached value it rejects is dropped and counted
+        as a miss, as if it had expired.
+        """
+
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                self.misses += 1
+                return default
+
+            value, expires = entry
+            if ((expires is not None and expires <= monotonic())
+                    or (valid is not None and not valid(value))):
+                del self._entries[key]
+                self.misses += 1
+                return default
+
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return value
+
+    def set(self, key, value):
+        """Cache `value` under `key`, evicting the oldest entries if full."""
+
+        expires = monotonic() + self.ttl if self.ttl is not None else None
+        with self._lock:
+            self._entries[key] = (value, expires)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.maxsize:
+                self._entries.popitem(last=False)
+                self.evictions += 1
+
+    def get_or_set(self, key, load):
+        """Return the cached value for `key`, calling `load()` to fill a miss.
+
+        Whatever `load` returns is cached, including None.
+        """
+
+        value = self.get(key, MISSING)
+        if value is MISSING:
+            value = load()
+            self.set(key, value)
+        return value
+
+    def invalidate(self, key):
+        """Forget `key`, if cached."""
+
+        with self._lock:
+            self._entries.pop(key, None)
+
+    def clear(self):
+        """Forget everything (stats are kept)."""
+
+        with self._lock:
+            self._entries.clear()
+
+    def stats(self):
+        """Size and hit/miss counts, for the stats endpoint."""
+
+        lookups = self.hits + self.misses
+        return {
+            'size': len(self._entries),
+            'maxsize': self.maxsize,
+            'ttl': self.ttl,
+            'hits': self.hits,
+            'misses': self.misses,
+            'evictions': self.evictions,
+            'hit_ratio': self.hits / lookups if lookups else None,
+        }
@@ -0,0 +1,131 @@
+"""HTTP caching policy for Warbler's responses.
+
+Each view can declare its Cache-Control with :func:`cache_policy`. Views that
+don't are sent ``no-store``: most pages carry forms, flashed messages or
+other per-request state that must not be reused.
+
+Static files are linked through :func:`static_url`, which appends a digest
+of the file's contents (``?v=...``). A request carrying the current digest
+can be cached for good (``immutable``), since any change to the file changes
+its URL. Other static requests are revalidated, using the ETag and
+Last-Modified that Flask already sends for files.
+
+Pages that can be revalidated call :func:`not_modified` with the versions
+of everything they show. When the client's ETag still matches, the view
+answers 304 before running its page queries or rendering anything.
+"""
+
+import hashlib
+import os
+
+from flask import current_app, g, request, session, url_for
+
+IMMUTABLE = 'public, max-age=31536000, immutable'
+REVALIDATE = 'private, no-cache'
+NO_STORE = 'no-store'
+
+# {filename: (mtime, digest)} of static files linked so far
+_fingerprints = {}
+
+# digest of the templates' source; see template_version
+_template_version = None
+
+
+def init_app(app):
+    """Set each response's caching headers and add ``static_url``."""
+
+    app.add_template_global(static_url)
+    app.after_request(set_cache_headers)
+
+
+def cache_policy(value):
+    """Send `value` as the Cache-Control of the decorated view's responses.
+
+    Put it anywhere below ``@app.route``, which registers the function it is
+    given: the policy is an attribute of that function, and decorators that
+    use ``functools.wraps`` (as ``login_required`` does) copy it onto their
+    wrapper, so their order doesn't matter. Above the route it is too late.
+    """
+
+    def decorate(view):
+        view.cache_control = value
+        return view
+    return decorate
+
+
+def static_url(filename):
+    """URL of a static file, fingerprinted with a digest of its contents."""
+
+    return url_for('static', filename=filename, v=fingerprint(filename))
+
+
+def fingerprint(filename):
+    """Digest of a static file; recomputed when it changes, in debug mode."""
+
+    cached = _fingerprints.get(filename)
+    if cached is None or current_app.debug:
+        path = os.path.join(current_app.static_folder, filename)
+        mtime = os.path.getmtime(path)
+        if cached is None or cached[0] != mtime:
+            with open(path, 'rb') as f:
+                cached = (mtime, hashlib.md5(f.read()).hexdigest()[:12])
+            _fingerprints[filename] = cached
+    return cached[1]
+
+
+def template_version():
+    """Digest of every template, so a deploy that changes them retires
+    the ETags of pages rendered from the old ones."""
+
+    global _template_version
+    if _template_version is None:
+        digest = hashlib.md5()
+        root = os.path.join(current_app.root_path, current_app.template_folder)
+        for directory, subdirectories, filenames in sorted(os.walk(root)):
+            subdirectories.sort()
+            for filename in sorted(filenames):
+                with open(os.path.join(directory, filename), 'rb') as f:
+                    digest.update(f.read())
+        _template_version = digest.hexdigest()
+    return _template_version
+
+
+def not_modified(*validators):
+    """A 304 response if the client's copy of this page is current, else None.
+
+    `validators` are the versions of everything the page shows, apart from
+    its URL. The page's ETag is a digest of them, and goes out on the page
+    or on the 304 response.
+    """
+
+    if session.get('_flashes'):
+        # the page will show a one-off message, so it must be rendered
+        return None
+
+    g.etag = hashlib.sha1(repr(
+        (template_version(), request.full_path) + validators
+    ).encode('UTF-8')).hexdigest()
+
+    if request.if_none_match.contains(g.etag):
+        return current_app.response_class(status=304)
+    return None
+
+
+def set_cache_headers(response):
+    """Cache-Control (and ETag) for `response`, from its view's policy."""
+
+    if request.endpoint == 'static':
+        filename = request.view_args.get('filename')
+        if response.status_code == 200 and request.args.get('v') == fingerprint(filename):
+            response.headers['Cache-Control'] = IMMUTABLE
+        else:
+            response.headers['Cache-Control'] = 'public, no-cache'
+        return response
+
+    view = current_app.view_functions.get(request.endpoint)
+    response.headers['Cache-Control'] = getattr(view, 'cache_control', NO_STORE)
+
+    etag = g.get('etag')
+    if etag is not None and response.status_code in (200, 304):
+        response.set_etag(etag)
+    return response
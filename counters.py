@@ -0,0 +1,226 @@
+"""Denormalized per-user counters for Warbler.
+
+``users.messages_count``, ``followers_count``, ``following_count``,
+``likes_count``, ``likes_received_count`` and ``unread_dm_count`` are
+adjusted in the same transaction as the rows they count: mapper events
+cover ORM inserts and deletes of Message, Follows and Likes, and code that
+writes those tables with set-based statements (and dms.py, for unread DMs)
+calls :func:`adjust` itself. A like's author's ``likes_received_count`` is
+adjusted by a background job instead, so likers don't queue on a popular
+author's row.
+:func:`reconcile_counters` recomputes them from the underlying tables to
+repair any drift (bulk loads, manual SQL, old rows).
+"""
+
+from sqlalchemy import event, func, or_, select
+from sqlalchemy.orm import Session
+
+import jobs
+from models import db, ConversationMember, Follows, Likes, Message, User
+
+COUNTER_COLUMNS = ('messages_count', 'followers_count', 'following_count',
+                   'likes_count', 'likes_received_count', 'unread_dm_count')
+
+
+def adjust(connection, user_id, **deltas):
+    """Add `deltas` (e.g. ``likes_count=-1``) to one user's counters."""
+
+    users = User.__table__
+    connection.execute(
+        users.update()
+        .where(users.c.id == user_id)
+        .values({name: users.c[name] + delta
+                 for name, delta in deltas.items()}))
+
+
+@jobs.handler('counters.adjust')
+def adjust_job(user_id, **deltas):
+    adjust(db.session.connection(), user_id, **deltas)
+
+
+def adjust_many(connection, user_ids, **deltas):
+    """Add `deltas` to the counters of every user in `user_ids`.
+
+    `user_ids` may be a list or a select of ids.
+    """
+
+    users = User.__table__
+    connection.execute(
+        users.update()
+        .where(users.c.id.in_(user_ids))
+        .values({name: users.c[name] + delta
+                 for name, delta in deltas.items()}))
+
+
+##############################################################################
+# ORM write paths
+
+
+@event.listens_for(Message, 'after_insert')
+def message_created(mapper, connection, message):
+    adjust(connection, message.user_id, messages_count=1, messages_version=1)
+
+
+@event.listens_for(Message, 'before_delete')
+def message_deleted(mapper, connection, message):
+    # the database cascades the message's likes away, so take them off the
+    # likers' counts while the rows are still there to find them
+    likes = select([Likes.user_id]).where(Likes.message_id == message.id)
+    adjust_many(connection, likes, likes_count=-1)
+    adjust(connection, message.user_id, messages_count=-1, messages_version=1,
+           likes_received_count=-select([func.count()]).select_from(
+               likes.alias()).as_scalar())
+
+
+@event.listens_for(Follows, 'after_insert')
+def follow_created(mapper, connection, follow):
+    adjust(connection, follow.user_following_id, following_count=1)
+    adjust(connection, follow.user_being_followed_id, followers_count=1)
+
+
+@event.listens_for(Follows, 'after_delete')
+def follow_deleted(mapper, connection, follow):
+    adjust(connection, follow.user_following_id, following_count=-1)
+    adjust(connection, follow.user_being_followed_id, followers_count=-1)
+
+
+@event.listens_for(Likes, 'after_insert')
+def like_created(mapper, connection, like):
+    adjust(connection, like.user_id, likes_count=1, likes_version=1)
+    adjust_many(connection, author_of(like.message_id), likes_received_count=1,
+                messages_version=1)
+
+
+@event.listens_for(Likes, 'after_delete')
+def like_deleted(mapper, connection, like):
+    adjust(connection, like.user_id, likes_count=-1, likes_version=1)
+    adjust_many(connection, author_of(like.message_id), likes_received_count=-1,
+                messages_version=1)
+
+
+def author_of(message_id):
+    """Select of the id of the user who wrote `message_id`."""
+
+    return select([Message.user_id]).where(Message.id == message_id)
+
+
+@event.listens_for(Session, 'before_flush')
+def users_deleted(session, flush_context, instances):
+    # runs before the flush clears the deleted users' follows and likes, so
+    # the rows are still there to say whose counts to update
+    for user in session.deleted:
+        if isinstance(user, User):
+            user_deleted(session.connection(), user)
+
+
+def user_deleted(connection, user):
+    """Update everyone on the other end of `user`'s follows, likes and DMs."""
+
+    adjust_many(connection,
+                select([Follows.user_being_followed_id])
+                .where(Follows.user_following_id == user.id),
+                followers_count=-1)
+    adjust_many(connection,
+                select([Follows.user_following_id])
+                .where(Follows.user_being_followed_id == user.id),
+                following_count=-1)
+
+    users = User.__table__
+    liked_here = (select([func.count()])
+                  .select_from(Likes.__table__.join(Message.__table__))
+                  .where(Likes.user_id == users.c.id)
+                  .where(Message.user_id == user.id)
+                  .as_scalar())
+    connection.execute(
+        users.update()
+        .where(users.c.id.in_(
+            select([Likes.user_id])
+            .select_from(Likes.__table__.join(Message.__table__))
+            .where(Message.user_id == user.id)))
+        .values(likes_count=users.c.likes_count - liked_here))
+
+    liked_by_them = (select([func.count()])
+                     .select_from(Likes.__table__.join(Message.__table__))
+                     .where(Message.user_id == users.c.id)
+                     .where(Likes.user_id == user.id)
+                     .as_scalar())
+    connection.execute(
+        users.update()
+        .where(users.c.id.in_(
+            select([Message.user_id])
+            .select_from(Likes.__table__.join(Message.__table__))
+            .where(Likes.user_id == user.id)))
+        .values(likes_received_count=users.c.likes_received_count - liked_by_them))
+
+    # their conversations go with them, unread messages included
+    members = ConversationMember.__table__
+    unread_from_them = (select([members.c.unread_count])
+                        .where(members.c.user_id == users.c.id)
+                        .where(members.c.other_user_id == user.id)
+                        .as_scalar())
+    connection.execute(
+        users.update()
+        .where(users.c.id.in_(
+            select([members.c.user_id])
+            .where(members.c.other_user_id == user.id)
+            .where(members.c.unread_count > 0)))
+        .values(unread_dm_count=users.c.unread_dm_count - unread_from_them))
+
+
+##############################################################################
+# Repair
+
+
+def true_counts():
+    """Correlated subqueries computing each counter for the outer users row."""
+
+    users = User.__table__
+
+    def count(table, column):
+        return (select([func.count()])
+                .select_from(table)
+                .where(column == users.c.id)
+                .as_scalar())
+
+    return {
+        'messages_count': count(Message.__table__, Message.user_id),
+        'followers_count': count(Follows.__table__,
+                                 Follows.user_being_followed_id),
+        'following_count': count(Follows.__table__, Follows.user_following_id),
+        'likes_count': count(Likes.__table__, Likes.user_id),
+        'likes_received_count': count(
+            Likes.__table__.join(Message.__table__), Message.user_id),
+        'unread_dm_count': (
+            select([func.coalesce(func.sum(ConversationMember.unread_count), 0)])
+            .where(ConversationMember.user_id == users.c.id)
+            .as_scalar()),
+    }
+
+
+def reconcile_counters(batch_size=1000):
+    """Recompute drifted counters from the underlying tables.
+
+    Works through users in id ranges of `batch_size`, committing each range
+    separately so a large repair never holds every users row locked at once.
+    Returns the number of users whose counters were corrected.
+    """
+
+    users = User.__table__
+    low, high = db.session.query(func.min(User.id), func.max(User.id)).one()
+    if low is None:
+        return 0
+
+    counts = true_counts()
+    drifted = or_(*[users.c[name] != counts[name] for name in COUNTER_COLUMNS])
+
+    repaired = 0
+    for start in range(low, high + 1, batch_size):
+        result = db.session.execute(
+            users.update()
+            .where(users.c.id.between(start, start + batch_size - 1))
+            .where(drifted)
+            .values(counts))
+        db.session.commit()
+        repaired += result.rowcount
+
+    return repaired
@@ -0,0 +1,342 @@
+"""Deleting accounts, in two phases.
+
+Deleting a User through the ORM loads the relationships it cascades to. It
+then removes every message, like, follow and conversation of the account in
+the request's one transaction, which for an active account is a long wait
+holding a lot of locks. So deletion is split:
+
+1. :func:`soft_delete` stamps ``users.deleted_at`` in the request. From then
+   on the account can't log in, is left out of user lists, search and
+   feeds, and its pages are 404s.
+2. A ``users.purge`` job deletes the account's rows with set-based DELETEs
+   of at most ``USER_PURGE_BATCH`` rows, never loading them as objects. Each
+   batch is its own job, committed together with the counter updates for
+   the rows it removed, and enqueues the next batch. The stages run in the
+   order of :data:`STAGES`; the users row goes last.
+
+Every batch is logged. ``flask purge-users`` runs the batches in the
+foreground instead, printing each one, and :func:`remaining` counts what
+is left of an account.
+"""
+
+import logging
+from collections import defaultdict
+from datetime import datetime
+
+from flask import current_app
+from sqlalchemy import func, select, tuple_
+
+import counters
+import jobs
+from models import (db, Conversation, ConversationMember, DirectMessage,
+                    Follows, Likes, Message, Suggestion, TimelineEntry,
+                    TrendingMessage, User)
+
+log = logging.getLogger('warbler.deletion')
+
+
+def soft_delete(user):
+    """Hide `user`'s account now, and enqueue the purge of its rows.
+
+    The caller commits.
+    """
+
+    user.deleted_at = datetime.utcnow()
+    # the purge only touches accounts marked deleted, so mark it first
+    db.session.flush()
+    jobs.enqueue('users.purge', key=purge_key(user.id, 1), user_id=user.id)
+
+
+def purge_key(user_id, batch):
+    return f"purge-user:{user_id}:{batch}"
+
+
+@jobs.handler('users.purge')
+def purge_job(user_id, batch=1):
+    progress = purge_batch(user_id)
+    if progress is None:
+        return
+    stage, count = progress
+    log.info("purging user %s, batch %s: deleted %s %s", user_id, batch, count, stage)
+    if stage != 'account':
+        jobs.enqueue('users.purge', key=purge_key(user_id, batch + 1),
+                     user_id=user_id, batch=batch + 1)
+
+
+def purge_batch(user_id, batch_size=None):
+    """Delete the next batch of deleted account `user_id`'s rows.
+
+    Returns (stage, rows deleted), ending with ('account', 1) when the users
+    row itself goes, or None if there is no such deleted account. The
+    caller commits.
+    """
+
+    batch_size = batch_size or current_app.config.get('USER_PURGE_BATCH', 1000)
+    connection = db.session.connection()
+    users = User.__table__
+    deleted = (select([users.c.id])
+               .where(users.c.id == user_id)
+               .where(users.c.deleted_at.isnot(None)))
+    if connection.execute(deleted).first() is None:
+        return None
+
+    for stage, purge in STAGES:
+        count = purge(connection, user_id, batch_size)
+        if count:
+            return stage, count
+
+    connection.execute(users.delete().where(users.c.id == user_id))
+    return 'account', 1
+
+
+def purge_deleted(batch_size=None, echo=print):
+    """Purge every deleted account now, committing after each batch.
+
+    Returns the number of accounts purged.
+    """
+
+    user_ids = [user_id for (user_id,) in (db.session
+                                          .query(User.id)
+                                          .filter(User.deleted_at.isnot(None))
+                                          .order_by(User.id))]
+    for user_id in user_ids:
+        batch = 0
+        while True:
+            progress = purge_batch(user_id, batch_size)
+            db.session.commit()
+            if progress is None:
+                break
+            batch += 1
+            stage, count = progress
+            echo(f"user {user_id}, batch {batch}: deleted {count} {stage}")
+            if stage == 'account':
+                break
+    return len(user_ids)
+
+
+##############################################################################
+# Stages: each deletes up to `limit` of the account's rows of one kind, and
+# returns how many it deleted
+
+
+def subtract(connection, column, amounts):
+    """Take each of `amounts` ({user_id: n}) off that user's `column`,
+    with one UPDATE per distinct amount."""
+
+    by_amount = defaultdict(list)
+    for user_id, amount in amounts.items():
+        if amount:
+            by_amount[amount].append(user_id)
+    for amount, user_ids in by_amount.items():
+        counters.adjust_many(connection, user_ids, **{column: -amount})
+
+
+def tally(user_ids):
+    amounts = defaultdict(int)
+    for user_id in user_ids:
+        amounts[user_id] += 1
+    return amounts
+
+
+def likes_given(connection, user_id, limit):
+    likes, messages = Likes.__table__, Message.__table__
+    rows = connection.execute(
+        select([likes.c.id, messages.c.user_id])
+        .select_from(likes.join(messages))
+        .where(likes.c.user_id == user_id)
+        .limit(limit)
+        .with_for_update(of=likes)).fetchall()
+    if rows:
+        connection.execute(likes.delete().where(likes.c.id.in_([id for id, _ in rows])))
+        authors = tally(author for _, author in rows)
+        subtract(connection, 'likes_received_count', authors)
+        counters.adjust_many(connection, list(authors), messages_version=1)
+    return len(rows)
+
+
+def likes_received(connection, user_id, limit):
+    likes, messages = Likes.__table__, Message.__table__
+    rows = connection.execute(
+        select([likes.c.id, likes.c.user_id])
+        .select_from(likes.join(messages))
+        .where(messages.c.user_id == user_id)
+        .limit(limit)
+        .with_for_update(of=likes)).fetchall()
+    if rows:
+        connection.execute(likes.delete().where(likes.c.id.in_([id for id, _ in rows])))
+        subtract(connection, 'likes_count', tally(liker for _, liker in rows))
+    return len(rows)
+
+
+def fanned_out(connection, user_id, limit):
+    """Their messages' entries in other users' timelines."""
+
+    entries, messages = TimelineEntry.__table__, Message.__table__
+    batch = (select([entries.c.user_id, entries.c.message_id])
+             .select_from(entries.join(messages))
+             .where(messages.c.user_id == user_id)
+             .limit(limit)
+             .correlate(None))
+    return connection.execute(
+        entries.delete()
+        .where(tuple_(entries.c.user_id, entries.c.message_id).in_(batch))).rowcount
+
+
+def trending_scores(connection, user_id, limit):
+    """Their messages' trending scores."""
+
+    scores, messages = TrendingMessage.__table__, Message.__table__
+    batch = (select([scores.c.message_id])
+             .select_from(scores.join(messages))
+             .where(messages.c.user_id == user_id)
+             .limit(limit)
+             .correlate(None))
+    return connection.execute(
+        scores.delete().where(scores.c.message_id.in_(batch))).rowcount
+
+
+def messages_written(connection, user_id, limit):
+    messages = Message.__table__
+    batch = (select([messages.c.id])
+             .where(messages.c.user_id == user_id)
+             .limit(limit)
+             .correlate(None))
+    return connection.execute(messages.delete().where(messages.c.id.in_(batch))).rowcount
+
+
+def follows_out(connection, user_id, limit):
+    follows = Follows.__table__
+    followed = [followed_id for (followed_id,) in connection.execute(
+        select([follows.c.user_being_followed_id])
+        .where(follows.c.user_following_id == user_id)
+        .limit(limit)
+        .with_for_update())]
+    if followed:
+        connection.execute(
+            follows.delete()
+            .where(follows.c.user_following_id == user_id)
+            .where(follows.c.user_being_followed_id.in_(followed)))
+        counters.adjust_many(connection, followed, followers_count=-1)
+    return len(followed)
+
+
+def follows_in(connection, user_id, limit):
+    follows = Follows.__table__
+    followers = [follower_id for (follower_id,) in connection.execute(
+        select([follows.c.user_following_id])
+        .where(follows.c.user_being_followed_id == user_id)
+        .limit(limit)
+        .with_for_update())]
+    if followers:
+        connection.execute(
+            follows.delete()
+            .where(follows.c.user_being_followed_id == user_id)
+            .where(follows.c.user_following_id.in_(followers)))
+        counters.adjust_many(connection, followers, following_count=-1)
+    return len(followers)
+
+
+def own_timeline(connection, user_id, limit):
+    entries = TimelineEntry.__table__
+    batch = (select([entries.c.message_id])
+             .where(entries.c.user_id == user_id)
+             .limit(limit)
+             .correlate(None))
+    return connection.execute(
+        entries.delete()
+        .where(entries.c.user_id == user_id)
+        .where(entries.c.message_id.in_(batch))).rowcount
+
+
+def their_conversations(user_id):
+    members = ConversationMember.__table__
+    return select([members.c.conversation_id]).where(members.c.user_id == user_id)
+
+
+def direct_messages(connection, user_id, limit):
+    """The messages of their conversations, sent either way."""
+
+    dms = DirectMessage.__table__
+    batch = (select([dms.c.id])
+             .where(dms.c.conversation_id.in_(their_conversations(user_id)))
+             .limit(limit)
+             .correlate(None))
+    return connection.execute(dms.delete().where(dms.c.id.in_(batch))).rowcount
+
+
+def conversations(connection, user_id, limit):
+    """Their (by now empty) conversations, and the other sides' unread counts."""
+
+    members, table = ConversationMember.__table__, Conversation.__table__
+    ids = [id for (id,) in connection.execute(
+        their_conversations(user_id).limit(limit).with_for_update())]
+    if ids:
+        unread = connection.execute(
+            select([members.c.user_id, members.c.unread_count])
+            .where(members.c.conversation_id.in_(ids))
+            .where(members.c.user_id != user_id)).fetchall()
+        subtract(connection, 'unread_dm_count', dict(unread))
+        connection.execute(table.delete().where(table.c.id.in_(ids)))
+    return len(ids)
+
+
+def suggested(connection, user_id, limit):
+    """Their place in other users' suggestions."""
+
+    suggestions = Suggestion.__table__
+    batch = (select([suggestions.c.user_id])
+             .where(suggestions.c.suggested_id == user_id)
+             .limit(limit)
+             .correlate(None))
+    return connection.execute(
+        suggestions.delete()
+        .where(suggestions.c.suggested_id == user_id)
+        .where(suggestions.c.user_id.in_(batch))).rowcount
+
+
+# (name, function) in the order they run: the likes of their messages,
+# their timeline entries and trending scores go before the messages, so deleting a
+# message cascades to nothing.
+STAGES = [
+    ('likes', likes_given),
+    ('likes of their messages', likes_received),
+    ('timeline entries of their messages', fanned_out),
+    ('trending scores', trending_scores),
+    ('messages', messages_written),
+    ('follows', follows_out),
+    ('followers', follows_in),
+    ('timeline entries', own_timeline),
+    ('direct messages', direct_messages),
+    ('conversations', conversations),
+    ('suggestions', suggested),
+]
+
+
+def remaining(user_id):
+    """{stage: rows} still to purge for `user_id`, leaving out stages that are done."""
+
+    likes, messages = Likes.__table__, Message.__table__
+    entries, follows = TimelineEntry.__table__, Follows.__table__
+    dms, scores = DirectMessage.__table__, TrendingMessage.__table__
+
+    def count(source, *conditions):
+        query = select([func.count()]).select_from(source)
+        for condition in conditions:
+            query = query.where(condition)
+        return query.as_scalar()
+
+    counts = db.session.execute(select([
+        count(likes, likes.c.user_id == user_id),
+        count(likes.join(messages), messages.c.user_id == user_id),
+        count(entries.join(messages), messages.c.user_id == user_id),
+        count(scores.join(messages), messages.c.user_id == user_id),
+        count(messages, messages.c.user_id == user_id),
+        count(follows, follows.c.user_following_id == user_id),
+        count(follows, follows.c.user_being_followed_id == user_id),
+        count(entries, entries.c.user_id == user_id),
+        count(dms, dms.c.conversation_id.in_(their_conversations(user_id))),
+        count(ConversationMember.__table__,
+              ConversationMember.__table__.c.user_id == user_id),
+        count(Suggestion.__table__, Suggestion.__table__.c.suggested_id == user_id),
+    ])).first()
+    return {stage: rows for (stage, _), rows in zip(STAGES, counts) if rows}
@@ -0,0 +1,157 @@
+"""Direct messages between Warbler users.
+
+Each pair of users shares one Conversation, with a ConversationMember row for
+each of them. The member row records when the thread last had a message and
+how many messages that user hasn't read yet. A user's inbox is then one range
+scan of their member rows on (user_id, last_message_at), each joined to its
+thread's latest message through ``conversations.last_message_id``. No DMs
+are scanned or counted to draw it.
+
+Unread counts change incrementally. Sending adds one to the recipient's
+member row and to their ``users.unread_dm_count``; reading a thread takes
+off what was unread in it. Both happen in the caller's transaction.
+"""
+
+from datetime import datetime
+
+from sqlalchemy import case, select
+
+import counters
+from models import (db, Conversation, ConversationMember, DirectMessage, User,
+                    insert_if_absent)
+
+
+def conversation_between(user_id, other_id):
+    """Query for `user_id`'s member row in their conversation with `other_id`."""
+
+    low, high = sorted((user_id, other_id))
+    return (ConversationMember.query
+            .join(Conversation)
+            .filter(Conversation.user_low_id == low,
+                    Conversation.user_high_id == high,
+                    ConversationMember.user_id == user_id))
+
+
+def start_conversation(author_id, recipient_id, now):
+    """Id of the two users' conversation, created (with its members) if new."""
+
+    low, high = sorted((author_id, recipient_id))
+    conversations = Conversation.__table__
+    insert_if_absent(conversations,
+                     {'user_low_id': low, 'user_high_id': high},
+                     ['user_low_id', 'user_high_id'])
+    conversation_id = db.session.execute(
+        select([conversations.c.id])
+        .where(conversations.c.user_low_id == low)
+        .where(conversations.c.user_high_id == high)).scalar()
+
+    for user_id, other_id in ((author_id, recipient_id), (recipient_id, author_id)):
+        insert_if_absent(ConversationMember.__table__,
+                         {'conversation_id': conversation_id,
+                          'user_id': user_id,
+                          'other_user_id': other_id,
+                          'last_message_at': now},
+                         ['conversation_id', 'user_id'])
+    return conversation_id
+
+
+def send(author_id, recipient_id, text):
+    """Send a DM: store it, move the thread to the top of both inboxes and
+    count it as unread for the recipient. The caller commits."""
+
+    now = datetime.utcnow()
+    member = conversation_between(author_id, recipient_id).first()
+    if member is not None:
+        conversation_id = member.conversation_id
+    else:
+        conversation_id = start_conversation(author_id, recipient_id, now)
+
+    dm = DirectMessage(conversation_id=conversation_id, author_id=author_id,
+                       recipient_id=recipient_id, text=text, timestamp=now)
+    db.session.add(dm)
+    db.session.flush()
+
+    conversations = Conversation.__table__
+    members = ConversationMember.__table__
+    db.session.execute(
+        conversations.update()
+        .where(conversations.c.id == conversation_id)
+        .values(last_message_id=dm.id, last_message_at=now))
+    db.session.execute(
+        members.update()
+        .where(members.c.conversation_id == conversation_id)
+        .values(last_message_at=now,
+                unread_count=case(
+                    [(members.c.user_id == recipient_id, members.c.unread_count + 1)],
+                    else_=members.c.unread_count)))
+    counters.adjust(db.session.connection(), recipient_id, unread_dm_count=1)
+    return dm
+
+
+def mark_read(member):
+    """Mark `member`'s side of a conversation read. The caller commits.
+
+    Subtracts what was unread when `member` was loaded rather than zeroing,
+    so a message arriving meanwhile still counts.
+    """
+
+    unread = member.unread_count
+    if not unread:
+        return
+
+    members = ConversationMember.__table__
+    db.session.execute(
+        members.update()
+        .where(members.c.conversation_id == member.conversation_id)
+        .where(members.c.user_id == member.user_id)
+        .values(unread_count=members.c.unread_count - unread))
+    counters.adjust(db.session.connection(), member.user_id,
+                    unread_dm_count=-unread)
+    db.session.expire(member, ['unread_count'])
+
+
+##############################################################################
+# Reads, for pagination.paginate
+
+
+def inbox_query(user_id):
+    """(ConversationMember, DirectMessage, User) rows: each of `user_id`'s
+    conversations, its latest message and the other participant.
+
+    Unordered: page it on (ConversationMember.last_message_at,
+    ConversationMember.conversation_id) to stay on the inbox index.
+    """
+
+    return (db.session
+            .query(ConversationMember, DirectMessage, User)
+            .join(Conversation,
+                  Conversation.id == ConversationMember.conversation_id)
+            .join(DirectMessage, DirectMessage.id == Conversation.last_message_id)
+            .join(User, User.id == ConversationMember.other_user_id)
+            .filter(ConversationMember.user_id == user_id, User.deleted_at.is_(None)))
+
+
+def outbox_query(user_id):
+    """(DirectMessage, User) rows of the DMs `user_id` sent, with recipients."""
+
+    return (db.session
+            .query(DirectMessage, User)
+            .join(User, User.id == DirectMessage.recipient_id)
+            .filter(DirectMessage.author_id == user_id))
+
+
+def thread_query(conversation_id):
+    """(DirectMessage, User) rows of one conversation, with authors."""
+
+    return (db.session
+            .query(DirectMessage, User)
+            .join(User, User.id == DirectMessage.author_id)
+            .filter(DirectMessage.conversation_id == conversation_id))
+
+
+def inbox_key(row):
+    return row.ConversationMember.last_message_at, row.ConversationMember.conversation_id
+
+
+def dm_key(row):
+    return row.DirectMessage.timestamp, row.DirectMessage.id
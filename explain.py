@@ -0,0 +1,145 @@
+"""Check that the hot routes' SQL is served by indexes.
+
+:func:`check_routes` requests each page in :data:`ROUTES` with the test
+client, as the most-followed user, and records every SELECT it runs. Each
+one is then EXPLAINed with sequential scans discouraged
+(``enable_seqscan = off``). The planner only picks a Seq Scan anyway when
+no index can serve the query. Any such scan of a table estimated at
+``min_rows`` rows or more is reported.
+
+Run it against a loaded database with ``flask explain-routes``. PostgreSQL
+only.
+"""
+
+from contextlib import contextmanager
+
+from sqlalchemy import event
+
+from models import db, Follows, Message, User
+
+# Tables smaller than this (by the planner's estimate) may be scanned.
+MIN_ROWS = 10000
+
+# Pages to check, filled in with the sample user's id, one of their
+# messages' and the id of someone they follow. Search has its own,
+# optional indexes (see search.py), and opening a DM thread marks it read,
+# so neither is requested.
+ROUTES = [
+    "/",
+    "/users",
+    "/users/{user_id}",
+    "/users/{user_id}/likes",
+    "/users/{user_id}/following",
+    "/users/{user_id}/followers",
+    "/users/suggestions",
+    "/users/{followed_id}",
+    "/messages/{message_id}",
+    "/messages/trending",
+    "/users/inbox",
+    "/users/outbox",
+    "/api/v1/timeline",
+    "/api/v1/users/{user_id}",
+    "/api/v1/users/{user_id}/messages",
+    "/api/v1/users/{user_id}/followers",
+    "/api/v1/users/{user_id}/following",
+]
+
+
+@contextmanager
+def capturing(engine):
+    """Collect the (statement, parameters) of each SELECT run in the block."""
+
+    captured = []
+
+    def capture(conn, cursor, statement, parameters, context, executemany):
+        if not executemany and statement.lstrip().upper().startswith(('SELECT', 'WITH')):
+            captured.append((statement, parameters))
+
+    event.listen(engine, 'before_cursor_execute', capture)
+    try:
+        yield captured
+    finally:
+        event.remove(engine, 'before_cursor_execute', capture)
+
+
+def sequential_scans(plan):
+    """Names of the relations `plan` (an EXPLAIN JSON node) scans sequentially."""
+
+    found = []
+    if plan.get('Node Type') == 'Seq Scan':
+        found.append(plan['Relation Name'])
+    for child in plan.get('Plans', ()):
+        found += sequential_scans(child)
+    return found
+
+
+def table_sizes(cursor):
+    """{table name: the planner's row estimate} for the public schema."""
+
+    cursor.execute("SELECT relname, greatest(reltuples, 0) FROM pg_class "
+                   "WHERE relkind = 'r' AND relnamespace = 'public'::regnamespace")
+    return dict(cursor.fetchall())
+
+
+def explain(statements, min_rows=MIN_ROWS):
+    """(table, statement) for each of `statements` that sequentially scans a
+    table of `min_rows` or more rows."""
+
+    problems = []
+    connection = db.engine.raw_connection()
+    try:
+        cursor = connection.cursor()
+        sizes = table_sizes(cursor)
+        cursor.execute("SET enable_seqscan = off")
+        for statement, parameters in statements:
+            cursor.execute("EXPLAIN (FORMAT JSON) " + statement, parameters)
+            plan = cursor.fetchone()[0][0]['Plan']
+            problems += [(table, statement) for table in sequential_scans(plan)
+                         if sizes.get(table, 0) >= min_rows]
+    finally:
+        connection.rollback()
+        connection.close()
+    return problems
+
+
+def check_routes(app, session_key, min_rows=MIN_ROWS):
+    """(route, table, statement) for each sequential scan of a table of
+    `min_rows` or more rows by the SQL of :data:`ROUTES`.
+
+    Logs the test client in by setting `session_key` in its session.
+    Needs a user with a message, following someone.
+    """
+
+    with app.app_context():
+        engine = db.engine
+        if engine.dialect.name != 'postgresql':
+            raise RuntimeError("EXPLAIN checks need PostgreSQL")
+
+        user = User.query.order_by(User.followers_count.desc(), User.id).first()
+        if user is None:
+            raise RuntimeError("no users to request pages as")
+        message = (Message.query
+                   .filter(Message.user_id == user.id)
+                   .order_by(Message.timestamp.desc())
+                   .first())
+        follow = Follows.query.filter_by(user_following_id=user.id).first()
+        if message is None or follow is None:
+            raise RuntimeError(f"{user.username} has no messages or follows no one")
+        ids = {'user_id': user.id, 'message_id': message.id,
+               'followed_id': follow.user_being_followed_id}
+
+        client = app.test_client()
+        with client.session_transaction() as session:
+            session[session_key] = user.id
+
+        problems = []
+        for route in ROUTES:
+            url = route.format(**ids)
+            with capturing(engine) as statements:
+                response = client.get(url)
+                response.get_data()
+            if response.status_code != 200:
+                raise RuntimeError(f"{url} answered {response.status_code}")
+            problems += [(url, table, statement)
+                         for table, statement in explain(statements, min_rows)]
+        return problems
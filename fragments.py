@@ -0,0 +1,83 @@
+"""Rendered HTML fragment cache for Warbler's templates.
+
+A message's list item and a user's card render the same for every viewer
+until the message or its author changes, so templates wrap those parts in
+
+    {% call cache_fragment('message', message.id, author.version) %}
+      ...
+    {% endcall %}
+
+and the rendered HTML is reused, per process, until `version` moves on.
+Viewer-specific parts (like and follow buttons) stay outside the block.
+
+``User.version`` is bumped whenever a column a fragment shows changes, which
+retires that user's card and every message fragment showing them. Messages
+and users deleted or edited through the ORM are dropped from the cache
+directly. An account deleted by deletion.py's purge isn't: its set-based
+DELETEs fire no ORM events. Nothing asks for its fragments again, though,
+since pages leave out a soft-deleted account, so they just age out.
+Up to ``FRAGMENT_CACHE_SIZE`` fragments are kept (0 turns caching off).
+"""
+
+from markupsafe import Markup
+from sqlalchemy import event, inspect
+
+from cache import LRUCache
+from models import Message, User
+
+# User columns that appear in cached fragments.
+DISPLAY_COLUMNS = ('username', 'image_url', 'header_image_url', 'bio',
+                   'location')
+
+fragments = LRUCache()
+
+
+def configure(app):
+    """Size the fragment cache from `app`'s config."""
+
+    fragments.maxsize = app.config.get('FRAGMENT_CACHE_SIZE', 10000)
+    app.add_template_global(cache_fragment)
+
+
+def cache_fragment(kind, id, version, caller):
+    """Rendered body of the ``{% call %}`` block for (kind, id) at `version`."""
+
+    if not fragments.maxsize:
+        return caller()
+
+    key = (kind, id)
+    cached = fragments.get(key, valid=lambda entry: entry[0] == version)
+    if cached is not None:
+        return Markup(cached[1])
+
+    html = caller()
+    fragments.set(key, (version, str(html)))
+    return html
+
+
+def forget(kind, id):
+    """Drop the cached fragment for (kind, id)."""
+
+    fragments.invalidate((kind, id))
+
+
+##############################################################################
+# Invalidation
+
+
+@event.listens_for(User, 'before_update')
+def user_changing(mapper, connection, user):
+    state = inspect(user)
+    if any(state.attrs[name].history.has_changes() for name in DISPLAY_COLUMNS):
+        user.version = (user.version or 0) + 1
+
+
+@event.listens_for(User, 'after_delete')
+def user_deleted(mapper, connection, user):
+    forget('user', user.id)
+
+
+@event.listens_for(Message, 'after_update')
+@event.listens_for(Message, 'after_delete')
+def message_changed(mapper, connection, message):
+    forget('message', message.id)
@@ -2,15 +2,39 @@
 
 Students won't need to run this for the exercise; they will just use the CSV
 files that this generates. You should only need to run this if you wanted to
-tweak the CSV formats or generate fewer/more rows.
+tweak the CSV formats or generate fewer/more rows, e.g. for load testing:
+
+    python generator/create_csvs.py --users 1000000 --follows 100000000 \\
+        --messages 20000000 --workers 8 --out /data/warbler
+
+Rows are streamed straight to disk, so memory use doesn't grow with the
+size of the data set. The output depends only on the options and --seed.
+User ids are split into fixed-size shards, and each shard is generated from
+its own seeded random state, in whichever worker process picks it up. Any
+number of --workers therefore writes byte-identical files.
+
+- Followings are power-law distributed. A few users are followed by a large
+  share of everyone, most by a handful. How many users each person follows
+  is heavy-tailed too.
+- Messages are posted in bursts (see helpers.get_bursty_datetimes), by a
+  heavy-tailed mix of prolific and occasional posters.
+- Nothing is fetched over the network; image URLs are only made up.
+
+Users are numbered by row, 1 to --users, which is how messages.csv and
+follows.csv refer to them (`flask load-data` assigns the same ids).
 """
 
+import argparse
 import csv
-from random import choice, randint, sample
-from itertools import permutations
-import requests
+import os
+import shutil
+from datetime import datetime, timezone
+from math import gcd
+from multiprocessing import Pool
+from random import Random
+
 from faker import Faker
-from helpers import get_random_datetime
+from helpers import get_bursty_datetimes, power_law_rank
 
 MAX_WARBLER_LENGTH = 140
 
@@ -20,11 +44,19 @@ FOLLOWS_CSV_HEADERS = ['user_being_followed_id', 'user_following_id']
 
 NUM_USERS = 300
 NUM_MESSAGES = 1000
-NUM_FOLLWERS = 5000
+NUM_FOLLOWS = 5000
 
-fake = Faker()
+# Default users per unit of work (--shard-size). The output depends on
+# it, but not on --workers.
+SHARD_SIZE = 10000
+
+# bcrypt hash of "password" (cost 12); upgraded on first login if the app's
+# BCRYPT_LOG_ROUNDS differs.
+PASSWORD = '$2b$12$Q1PUFjhN/AWRQ21LbGYvjeLpZZB6lfZ1BPwifHALGO6oIbyC3CmJe'
 
-# Generate random profile image URLs to use for users
+# Shape of the Pareto distributions for follows and messages per user: the
+# smaller, the heavier the tail.
+PARETO_SHAPE = 2.0
 
 image_urls = [
     f"https://randomuser.me/api/portraits/{kind}/{i}.jpg"
@@ -32,46 +64,161 @@ image_urls = [
     for i in range(count)
 ]
 
-# Generate random header image URLs to use for users
+fake = Faker()
 
-header_image_urls = [
-    requests.get(f"http://www.splashbase.co/api/v1/images/{i}").json()['url']
-    for i in range(1, 46)
-]
 
-with open('generator/users.csv', 'w') as users_csv:
-    users_writer = csv.DictWriter(users_csv, fieldnames=USERS_CSV_HEADERS)
-    users_writer.writeheader()
-
-    for i in range(NUM_USERS):
-        users_writer.writerow(dict(
-            email=fake.email(),
-            username=fake.user_name(),
-            image_url=choice(image_urls),
-            password='$2b$12$Q1PUFjhN/AWRQ21LbGYvjeLpZZB6lfZ1BPwifHALGO6oIbyC3CmJe',
-            bio=fake.sentence(),
-            header_image_url=choice(header_image_urls),
-            location=fake.city()
-        ))
-
-with open('generator/messages.csv', 'w') as messages_csv:
-    messages_writer = csv.DictWriter(messages_csv, fieldnames=MESSAGES_CSV_HEADERS)
-    messages_writer.writeheader()
-
-    for i in range(NUM_MESSAGES):
-        messages_writer.writerow(dict(
-            text=fake.paragraph()[:MAX_WARBLER_LENGTH],
-            timestamp=get_random_datetime(),
-            user_id=randint(1, NUM_USERS)
-        ))
-
-# Generate follows.csv from random pairings of users
-
-with open('generator/follows.csv', 'w') as follows_csv:
-    all_pairs = list(permutations(range(1, NUM_USERS + 1), 2))
-
-    users_writer = csv.DictWriter(follows_csv, fieldnames=FOLLOWS_CSV_HEADERS)
-    users_writer.writeheader()
-
-    for followed_user, follower in sample(all_pairs, NUM_FOLLWERS):
-        users_writer.writerow(dict(user_being_followed_id=followed_user, user_following_id=follower))
+def shard_random(seed, table, shard):
+    """The random state for one shard of one table."""
+
+    return Random(f"{seed}:{table}:{shard}")
+
+
+def shard_ids(shard, options):
+    """User ids covered by `shard`."""
+
+    return range(shard * options.shard_size + 1,
+                 min((shard + 1) * options.shard_size, options.users) + 1)
+
+
+def utc_datetime(value):
+    """An ISO date and time, in UTC unless it says otherwise."""
+
+    moment = datetime.fromisoformat(value)
+    return moment if moment.tzinfo else moment.replace(tzinfo=timezone.utc)
+
+
+def heavy_tailed(mean, rng):
+    """A non-negative integer with the given mean and a Pareto tail."""
+
+    scaled = mean * rng.paretovariate(PARETO_SHAPE) * (PARETO_SHAPE - 1) / PARETO_SHAPE
+    return int(scaled + rng.random())
+
+
+def popularity_stride(num_users):
+    """A step coprime with `num_users`, to scatter popularity ranks over ids."""
+
+    stride = int(num_users * 0.618) | 1
+    while gcd(stride, num_users) != 1:
+        stride += 2
+    return stride
+
+
+##############################################################################
+# One shard of each table
+
+
+def write_users(options, rng, writer, ids):
+    for user_id in ids:
+        # suffixed with the id, so usernames and emails are unique
+        username = f"{fake.user_name()}{user_id}"
+        writer.writerow([
+            f"{username}@{fake.free_email_domain()}",
+            username,
+            rng.choice(image_urls),
+            PASSWORD,
+            fake.sentence(),
+            f"https://picsum.photos/seed/warbler{rng.randrange(1000)}/1280/720",
+            fake.city(),
+        ])
+
+
+def write_messages(options, rng, writer, ids):
+    mean = options.messages / options.users
+    for user_id in ids:
+        for timestamp in get_bursty_datetimes(heavy_tailed(mean, rng),
+                                              now=options.end, rng=rng):
+            # the app stores naive UTC
+            writer.writerow([fake.paragraph()[:MAX_WARBLER_LENGTH],
+                             timestamp.replace(tzinfo=None), user_id])
+
+
+def write_follows(options, rng, writer, ids):
+    num_users = options.users
+    mean = options.follows / num_users
+    stride = popularity_stride(num_users)
+
+    for follower in ids:
+        wanted = min(heavy_tailed(mean, rng), num_users - 1)
+        followed = set()
+        # the most popular users get drawn again and again; give up on the
+        # last few rather than search for them forever
+        for _ in range(wanted * 10):
+            if len(followed) >= wanted:
+                break
+            rank = power_law_rank(num_users, options.exponent, rng)
+            user_id = (rank - 1) * stride % num_users + 1
+            if user_id != follower:
+                followed.add(user_id)
+
+        writer.writerows([user_id, follower] for user_id in sorted(followed))
+
+
+TABLES = {
+    'users': (USERS_CSV_HEADERS, write_users),
+    'messages': (MESSAGES_CSV_HEADERS, write_messages),
+    'follows': (FOLLOWS_CSV_HEADERS, write_follows),
+}
+
+
+def part_path(options, table, shard):
+    return os.path.join(options.out, f"{table}.csv.part{shard:06d}")
+
+
+def generate_shard(task):
+    """Write one shard of one table to its own part file."""
+
+    options, table, shard = task
+    rng = shard_random(options.seed, table, shard)
+    fake.seed_instance(rng.getrandbits(64))
+
+    headers, write = TABLES[table]
+    with open(part_path(options, table, shard), 'w', newline='') as part:
+        write(options, rng, csv.writer(part), shard_ids(shard, options))
+    return table, shard
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Generate Warbler CSVs (users, messages, follows).")
+    parser.add_argument('--users', type=int, default=NUM_USERS)
+    parser.add_argument('--messages', type=int, default=NUM_MESSAGES,
+                        help="approximate total")
+    parser.add_argument('--follows', type=int, default=NUM_FOLLOWS,
+                        help="approximate total")
+    parser.add_argument('--seed', default='warbler',
+                        help="same seed and options, same files")
+    parser.add_argument('--exponent', type=float, default=1.1,
+                        help="power-law exponent of user popularity")
+    parser.add_argument('--end', type=utc_datetime,
+                        default=datetime(2020, 1, 1, tzinfo=timezone.utc),
+                        help="latest message time, UTC unless an offset is given "
+                             "(fixed, for repeatable output)")
+    parser.add_argument('--shard-size', type=int, default=SHARD_SIZE,
+                        help="users per unit of work (the output depends on it)")
+    parser.add_argument('--workers', type=int, default=os.cpu_count())
+    parser.add_argument('--out', default='generator',
+                        help="directory to write the CSVs to")
+    options = parser.parse_args()
+
+    os.makedirs(options.out, exist_ok=True)
+    shards = -(-options.users // options.shard_size)
+    tasks = [(options, table, shard) for table in TABLES for shard in range(shards)]
+
+    with Pool(options.workers) as pool:
+        for done, (table, shard) in enumerate(
+                pool.imap_unordered(generate_shard, tasks), 1):
+            print(f"{table}: shard {shard + 1}/{shards} ({done}/{len(tasks)})")
+
+    # stitch each table's parts together, in shard order
+    for table, (headers, write) in TABLES.items():
+        with open(os.path.join(options.out, f"{table}.csv"), 'w', newline='') as out:
+            csv.writer(out).writerow(headers)
+            for shard in range(shards):
+                path = part_path(options, table, shard)
+                with open(path, newline='') as part:
+                    shutil.copyfileobj(part, out)
+                os.remove(path)
+
+
+if __name__ == '__main__':
+    main()
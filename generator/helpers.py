@@ -1,14 +1,56 @@
 """Support functions for CSV generation."""
 
-from datetime import datetime
-from random import uniform
+import random
+from datetime import datetime, timedelta, timezone
 
 
-def get_random_datetime(year_gap=2):
-    """Get a random datetime within the last few years."""
+def get_random_datetime(year_gap=2, now=None, rng=random):
+    """Get a random UTC datetime within the last few years (before `now`,
+    taken as UTC if naive)."""
 
-    now = datetime.now()
+    now = now or datetime.now(timezone.utc)
+    if now.tzinfo is None:
+        now = now.replace(tzinfo=timezone.utc)
     then = now.replace(year=now.year - year_gap)
-    random_timestamp = uniform(then.timestamp(), now.timestamp())
+    random_timestamp = rng.uniform(then.timestamp(), now.timestamp())
 
-    return datetime.fromtimestamp(random_timestamp)
+    # in UTC, not local time, so the same seed gives the same times on any
+    # machine
+    return datetime.fromtimestamp(random_timestamp, timezone.utc)
+
+
+def get_bursty_datetimes(count, year_gap=2, now=None, rng=random,
+                         mean_burst=5, mean_gap_minutes=20):
+    """Get `count` UTC datetimes within the last few years, in bursts, sorted.
+
+    Posting is bursty: a user writes a handful of messages minutes apart,
+    then nothing for weeks. Bursts start at random points in the period and
+    hold `mean_burst` messages on average, spaced by exponentially
+    distributed gaps averaging `mean_gap_minutes`.
+    """
+
+    times = []
+    while len(times) < count:
+        moment = get_random_datetime(year_gap, now, rng)
+        burst = min(count - len(times),
+                    1 + int(rng.expovariate(1 / mean_burst)))
+        for _ in range(burst):
+            times.append(moment)
+            moment += timedelta(minutes=rng.expovariate(1 / mean_gap_minutes))
+
+    return sorted(times)
+
+
+def power_law_rank(n, exponent, rng=random):
+    """A rank in 1..n drawn with probability falling off as rank**-exponent.
+
+    Samples the continuous power law over [1, n + 1) by inverting its CDF,
+    so it takes constant time and memory however large `n` is.
+    """
+
+    if exponent == 1:
+        rank = (n + 1) ** rng.random()
+    else:
+        a = 1 - exponent
+        rank = (((n + 1) ** a - 1) * rng.random() + 1) ** (1 / a)
+    return min(int(rank), n)
@@ -0,0 +1,97 @@
+"""Cached identity of the logged-in user.
+
+Every authenticated request needs to know who the user is, but most don't
+need their full row, let alone their relationships. The few columns the
+layout and the views use on almost every page are cached per process for
+``CURRENT_USER_CACHE_TTL`` seconds; the full User is only loaded, at most
+once per request, when a view asks for something else.
+
+Changes made through profile edits, password changes and deletion
+invalidate this process's entry; other processes pick them up when their
+entry expires.
+"""
+
+from collections import namedtuple
+
+from flask import abort
+
+from cache import LRUCache
+from models import db, User
+
+Identity = namedtuple('Identity', ['id', 'username', 'image_url',
+                                   'header_image_url'])
+
+identities = LRUCache()
+
+
+def configure(app):
+    """Size the identity cache from `app`'s config."""
+
+    identities.maxsize = app.config.get('CURRENT_USER_CACHE_SIZE', 10000)
+    identities.ttl = app.config.get('CURRENT_USER_CACHE_TTL', 60)
+
+
+def load_identity(user_id):
+    """Cached Identity for `user_id`, or None if there is no such user (or
+    their account was deleted)."""
+
+    identity = identities.get(user_id)
+    if identity is None:
+        row = (db.session
+               .query(*[getattr(User, field) for field in Identity._fields])
+               .filter(User.id == user_id, User.deleted_at.is_(None))
+               .first())
+        if row is None:
+            return None
+        identity = Identity(*row)
+        identities.set(user_id, identity)
+    return identity
+
+
+def forget(user_id):
+    """Drop `user_id`'s cached identity after their row changed."""
+
+    identities.invalidate(user_id)
+
+
+class CurrentUser:
+    """The logged-in user, as seen by views and templates.
+
+    The cached identity fields are answered directly; anything else is read
+    from the full User row, loaded on first use.
+    """
+
+    def __init__(self, identity):
+        self._identity = identity
+        self._user = None
+
+    def __getattr__(self, name):
+        if name.startswith('_'):
+            raise AttributeError(name)
+        if name in Identity._fields:
+            return getattr(self._identity, name)
+        return getattr(self.load(), name)
+
+    def load(self):
+        """The full User row (404 if it has gone since it was cached)."""
+
+        if self._user is None:
+            self._user = User.query.get(self._identity.id)
+            if self._user is None:
+                forget(self._identity.id)
+                abort(404)
+        return self._user
+
+    def __eq__(self, other):
+        # by id, so the column-only rows pages query for users (follow_cards)
+        # compare equal to their viewer too, not just Users
+        other_id = getattr(other, 'id', None)
+        if other_id is None:
+            return NotImplemented
+        return other_id == self.id
+
+    def __hash__(self):
+        return hash(self.id)
+
+    def __repr__(self):
+        return f"<CurrentUser #{self.id}: {self.username}>"
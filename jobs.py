@@ -0,0 +1,316 @@
+"""Background jobs: work a request defers until after it has answered.
+
+A route calls :func:`enqueue`, which adds a row to the ``jobs`` table in the
+route's own transaction. The job exists if and only if the write that
+needed it was committed. Worker threads in each app process
+(``JOB_WORKERS``, started on first use) pick jobs up as soon as they are
+committed. ``flask run-jobs`` runs workers on their own, e.g. in separate
+processes beside an app started with ``JOB_WORKERS=0``; those check for
+jobs every ``JOB_POLL_INTERVAL`` seconds.
+
+Workers claim the earliest due job and run its handler. They mark it done
+in the same transaction as the handler's writes, so work in the database
+happens once. A job that raises is retried with exponential backoff
+(``JOB_RETRY_DELAY`` seconds, doubling each attempt, up to
+``JOB_MAX_RETRY_DELAY``). It is marked failed after its ``max_attempts``.
+A job still running ``JOB_TIMEOUT`` seconds after it was claimed (its
+worker died) is claimed again.
+
+A job enqueued with a ``key`` is only enqueued once per key, however often
+the request making it is repeated.
+
+Handlers are registered by kind with :func:`handler`. They are called with
+the job's JSON payload as keyword arguments, in an app context, and must
+not commit. ``JOBS_INLINE`` runs each job in the enqueuing transaction
+instead, e.g. for tests.
+"""
+
+import json
+import logging
+import os
+import random
+import socket
+import threading
+from datetime import datetime, timedelta
+from time import monotonic
+
+from flask import current_app
+from sqlalchemy import event, func, select
+from sqlalchemy.orm import Session
+
+from models import db, Job, insert_if_absent
+
+log = logging.getLogger('warbler.jobs')
+
+handlers = {}
+
+_workers = []
+_workers_pid = None
+_wake = threading.Event()
+_stop = threading.Event()
+_lock = threading.Lock()
+
+# this process's work, for the stats endpoint; lag is how long after
+# falling due a job was started
+totals = {'run': 0, 'retried': 0, 'failed': 0,
+          'lag': 0.0, 'longest_lag': 0.0, 'duration': 0.0}
+
+
+def handler(kind):
+    """Register the decorated function as the handler for jobs of `kind`."""
+
+    def register(fn):
+        handlers[kind] = fn
+        return fn
+    return register
+
+
+def enqueue(kind, key=None, delay=0, max_attempts=None, **payload):
+    """Have `kind`'s handler called with `payload` after the caller commits.
+
+    Skipped if a job with the same `key` was already enqueued. Runs the
+    handler right away, in the caller's transaction, with ``JOBS_INLINE``.
+    """
+
+    if kind not in handlers:
+        raise ValueError(f"no handler for {kind} jobs")
+
+    if current_app.config.get('JOBS_INLINE'):
+        handlers[kind](**payload)
+        return
+
+    now = datetime.utcnow()
+    values = {
+        'kind': kind,
+        'payload': json.dumps(payload),
+        'key': key,
+        'status': 'queued',
+        'attempts': 0,
+        'max_attempts': max_attempts or current_app.config.get('JOB_MAX_ATTEMPTS', 5),
+        'created_at': now,
+        'run_at': now + timedelta(seconds=delay),
+    }
+    if key is None:
+        db.session.execute(Job.__table__.insert().values(values))
+    else:
+        insert_if_absent(Job.__table__, values, ['key'])
+    db.session.info['jobs_enqueued'] = True
+
+
+@event.listens_for(Session, 'after_commit')
+def wake_workers(session):
+    """Once enqueued jobs are committed, start or wake this process's workers."""
+
+    if session.info.pop('jobs_enqueued', False):
+        count = current_app.config.get('JOB_WORKERS', 2)
+        if count:
+            start_workers(current_app._get_current_object(), count)
+        _wake.set()
+
+
+@event.listens_for(Session, 'after_rollback')
+def forget_enqueued(session):
+    session.info.pop('jobs_enqueued', None)
+
+
+##############################################################################
+# Running jobs
+
+
+def retry_delay(attempts):
+    """Seconds before retrying a job that failed `attempts` times: doubling
+    from JOB_RETRY_DELAY, capped, and jittered so retries don't bunch."""
+
+    base = current_app.config.get('JOB_RETRY_DELAY', 5)
+    cap = current_app.config.get('JOB_MAX_RETRY_DELAY', 3600)
+    return min(base * 2 ** (attempts - 1), cap) * random.uniform(0.5, 1)
+
+
+def claim(worker):
+    """Claim the earliest due job for `worker` and commit; None if none are."""
+
+    jobs = Job.__table__
+    now = datetime.utcnow()
+    stale = now - timedelta(seconds=current_app.config.get('JOB_TIMEOUT', 300))
+
+    candidate = db.session.execute(
+        select([jobs.c.id, jobs.c.status, jobs.c.attempts])
+        .where(((jobs.c.status == 'queued') & (jobs.c.run_at <= now))
+               | ((jobs.c.status == 'running') & (jobs.c.locked_at < stale)))
+        .order_by(jobs.c.run_at)
+        .limit(1)
+        .with_for_update(skip_locked=True)).first()
+    if candidate is None:
+        db.session.rollback()
+        return None
+
+    # only if no other worker got there first
+    claimed = db.session.execute(
+        jobs.update()
+        .where(jobs.c.id == candidate.id)
+        .where(jobs.c.status == candidate.status)
+        .where(jobs.c.attempts == candidate.attempts)
+        .values(status='running', locked_by=worker, locked_at=now,
+                attempts=jobs.c.attempts + 1)).rowcount
+    db.session.commit()
+    return Job.query.get(candidate.id) if claimed else None
+
+
+def run(job):
+    """Run a claimed job, then mark it done, or due for a retry, or failed."""
+
+    lag = (datetime.utcnow() - job.run_at).total_seconds()
+    clock = monotonic()
+    try:
+        handlers[job.kind](**json.loads(job.payload))
+        job.status = 'done'
+        job.finished_at = datetime.utcnow()
+        db.session.commit()
+    except Exception as error:
+        db.session.rollback()
+        log.exception("%s job %s failed (attempt %s of %s)",
+                      job.kind, job.id, job.attempts, job.max_attempts)
+        job.last_error = f"{type(error).__name__}: {error}"
+        if job.attempts < job.max_attempts:
+            job.status = 'queued'
+            job.run_at = datetime.utcnow() + timedelta(seconds=retry_delay(job.attempts))
+        else:
+            job.status = 'failed'
+            job.finished_at = datetime.utcnow()
+        db.session.commit()
+
+    with _lock:
+        totals['run'] += 1
+        totals['retried'] += job.status == 'queued'
+        totals['failed'] += job.status == 'failed'
+        totals['lag'] += lag
+        totals['longest_lag'] = max(totals['longest_lag'], lag)
+        totals['duration'] += monotonic() - clock
+    return job.status
+
+
+def run_pending(worker=None, limit=None):
+    """Run due jobs one at a time until none are left (or `limit` have
+    run). Needs an app context. Returns how many ran."""
+
+    worker = worker or f"{socket.gethostname()}:{os.getpid()}"
+    count = 0
+    while limit is None or count < limit:
+        job = claim(worker)
+        if job is None:
+            break
+        run(job)
+        count += 1
+    return count
+
+
+def purge_finished(older_than=None):
+    """Delete jobs done more than `older_than` (JOB_RETENTION) seconds ago."""
+
+    older_than = older_than or current_app.config.get('JOB_RETENTION', 86400)
+    cutoff = datetime.utcnow() - timedelta(seconds=older_than)
+    jobs = Job.__table__
+    deleted = db.session.execute(
+        jobs.delete()
+        .where(jobs.c.status == 'done')
+        .where(jobs.c.finished_at < cutoff)).rowcount
+    db.session.commit()
+    return deleted
+
+
+##############################################################################
+# Workers
+
+
+def work(app, name):
+    """A worker thread's loop: run due jobs, then sleep until woken or
+    JOB_POLL_INTERVAL passes (when retries may have come due)."""
+
+    worker = f"{socket.gethostname()}:{os.getpid()}:{name}"
+    poll = app.config.get('JOB_POLL_INTERVAL', 1)
+    while not _stop.is_set():
+        try:
+            with app.app_context():
+                if not run_pending(worker):
+                    purge_finished()
+        except Exception:
+            log.exception("job worker %s", worker)
+        _wake.wait(poll)
+        _wake.clear()
+
+
+def start_workers(app, count):
+    """Start `count` worker threads in this process, unless running already.
+
+    Per pid, so a server that forks its workers after importing the app
+    gives each worker process threads of its own.
+    """
+
+    global _workers_pid
+
+    with _lock:
+        if _workers and _workers_pid == os.getpid():
+            return
+        _stop.clear()
+        _workers[:] = [threading.Thread(target=work, args=(app, f"worker-{n}"),
+                                        name=f"job-worker-{n}", daemon=True)
+                       for n in range(count)]
+        _workers_pid = os.getpid()
+        for thread in _workers:
+            thread.start()
+
+
+def serve(app, count):
+    """Run `count` workers in the foreground until interrupted."""
+
+    start_workers(app, count)
+    try:
+        while not _stop.wait(1):
+            pass
+    except KeyboardInterrupt:
+        stop_workers()
+
+
+def stop_workers():
+    """Stop this process's worker threads after their current job."""
+
+    _stop.set()
+    _wake.set()
+    with _lock:
+        for thread in _workers:
+            thread.join()
+        _workers.clear()
+
+
+def stats():
+    """Queue depth by status, how overdue the oldest due job is, and this
+    process's counts and timings, for the stats endpoint."""
+
+    jobs = Job.__table__
+    now = datetime.utcnow()
+    depth = dict(db.session.execute(
+        select([jobs.c.status, func.count()])
+        .where(jobs.c.status != 'done')
+        .group_by(jobs.c.status)).fetchall())
+    oldest = db.session.execute(
+        select([func.min(jobs.c.run_at)])
+        .where(jobs.c.status == 'queued')
+        .where(jobs.c.run_at <= now)).scalar()
+
+    with _lock:
+        ran = totals['run']
+        return {
+            "queued": depth.get('queued', 0),
+            "running": depth.get('running', 0),
+            "failed": depth.get('failed', 0),
+            "oldest_due_s": round((now - oldest).total_seconds(), 3) if oldest else 0,
+            "workers": len(_workers),
+            "this_process": {
+                "run": ran,
+                "retried": totals['retried'],
+                "failed": totals['failed'],
+                "mean_lag_ms": round(totals['lag'] * 1000 / ran, 3) if ran else 0,
+                "longest_lag_ms": round(totals['longest_lag'] * 1000, 3),
+                "mean_run_ms": round(totals['duration'] * 1000 / ran, 3) if ran else 0,
+            },
+        }
@@ -0,0 +1,286 @@
+"""Streaming bulk loader for Warbler's tables.
+
+Loads ``<table>.csv`` files (with a header row naming the columns) from a
+directory into the tables of the same name, ``chunk_size`` rows at a time:
+
+- Each chunk is one transaction. It is a ``COPY ... FROM STDIN`` on
+  PostgreSQL and an executemany INSERT elsewhere. No more than one chunk
+  is ever held in memory.
+- Secondary indexes, unique and foreign-key constraints, and the search
+  indexes are dropped for the load and built once at the end.
+- With foreign keys out of the way the tables no longer depend on each
+  other, so up to `jobs` of them load at once. This applies to PostgreSQL
+  only; SQLite allows a single writer.
+- Every committed chunk is recorded in ``load_checkpoints`` in the same
+  transaction. A failed load can be resumed from the chunk after the last
+  one that made it.
+
+A CSV without an ``id`` column gets ids from its row numbers (1, 2, ...).
+That is how the generator's CSVs refer to users. Afterwards, id sequences,
+denormalized counters and materialized timelines are brought up to date.
+"""
+
+import csv
+import io
+import os
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+from itertools import islice
+from time import monotonic
+
+from sqlalchemy import (Column, DateTime, Integer, MetaData, Table, Text,
+                        inspect, select, text)
+from sqlalchemy.schema import (AddConstraint, CreateIndex,
+                               ForeignKeyConstraint, UniqueConstraint)
+
+import counters
+import migrations
+import search
+import timeline
+from models import db
+
+CHUNK_SIZE = 50000
+
+# Progress of the current load. Kept outside db.metadata so that starting a
+# load over (drop_all/create_all) doesn't depend on it.
+checkpoint_metadata = MetaData()
+load_checkpoints = Table(
+    'load_checkpoints', checkpoint_metadata,
+    Column('table_name', Text, primary_key=True),
+    Column('chunks', Integer, nullable=False),
+    Column('rows', Integer, nullable=False),
+)
+
+
+def csv_tables(source):
+    """(table, path) for each table with a CSV in `source`, parents first."""
+
+    found = []
+    for table in db.metadata.sorted_tables:
+        path = os.path.join(source, f"{table.name}.csv")
+        if os.path.exists(path):
+            found.append((table, path))
+    return found
+
+
+def read_chunks(path, table, chunk_size, skip=0):
+    """Yield (columns, rows) for each chunk of the CSV at `path`.
+
+    The first `skip` chunks are read past but not yielded. Rows are lists of
+    strings; if the CSV has no id column but `table` does, each row is given
+    its row number as id.
+    """
+
+    with open(path, newline='') as f:
+        reader = csv.reader(f)
+        columns = next(reader)
+        unknown = set(columns) - set(table.c.keys())
+        if unknown:
+            raise ValueError(f"{path}: no such columns in {table.name}: "
+                             f"{', '.join(sorted(unknown))}")
+
+        number_rows = 'id' in table.c and 'id' not in columns
+        if number_rows:
+            columns = ['id'] + columns
+
+        row_number = 0
+        chunk = 0
+        while True:
+            rows = list(islice(reader, chunk_size))
+            if not rows:
+                return
+            if chunk >= skip:
+                if number_rows:
+                    rows = [[str(row_number + i)] + row
+                            for i, row in enumerate(rows, 1)]
+                yield columns, rows
+            row_number += len(rows)
+            chunk += 1
+
+
+def copy_chunk(connection, table, columns, rows):
+    """Write `rows` with PostgreSQL's COPY, through `connection`'s transaction."""
+
+    buffer = io.StringIO()
+    csv.writer(buffer).writerows(rows)
+    buffer.seek(0)
+
+    quote = connection.dialect.identifier_preparer.quote
+    statement = (f"COPY {quote(table.name)} "
+                 f"({', '.join(quote(name) for name in columns)}) "
+                 f"FROM STDIN WITH (FORMAT csv)")
+    connection.connection.cursor().copy_expert(statement, buffer)
+
+
+def converter(column):
+    """Parse a CSV value for `column`; empty means NULL, as it does for COPY."""
+
+    if isinstance(column.type, DateTime):
+        parse = datetime.fromisoformat
+    elif isinstance(column.type, Integer):
+        parse = int
+    else:
+        parse = str
+    return lambda value: parse(value) if value != '' else None
+
+
+def insert_chunk(connection, table, columns, rows):
+    """Write `rows` with one executemany INSERT."""
+
+    converters = [converter(table.c[name]) for name in columns]
+    connection.execute(table.insert(), [
+        {name: convert(value)
+         for name, convert, value in zip(columns, converters, row)}
+        for row in rows
+    ])
+
+
+def load_table(engine, table, path, chunk_size, echo):
+    """Load `table` from `path`, after its last checkpointed chunk.
+
+    Returns the total number of rows loaded into the table, including
+    those loaded by earlier attempts.
+    """
+
+    checkpoint = load_checkpoints.c.table_name == table.name
+    with engine.begin() as connection:
+        done = connection.execute(
+            select([load_checkpoints.c.chunks, load_checkpoints.c.rows])
+            .where(checkpoint)).first()
+        if done is None:
+            connection.execute(load_checkpoints.insert().values(
+                table_name=table.name, chunks=0, rows=0))
+            done = (0, 0)
+    chunks, rows = done
+
+    if chunks:
+        echo(f"{table.name}: resuming after chunk {chunks} ({rows:,} rows)")
+
+    write = copy_chunk if engine.dialect.name == 'postgresql' else insert_chunk
+    started = monotonic()
+    loaded = 0
+    for columns, chunk in read_chunks(path, table, chunk_size, skip=chunks):
+        with engine.begin() as connection:
+            write(connection, table, columns, chunk)
+            chunks += 1
+            rows += len(chunk)
+            connection.execute(load_checkpoints.update()
+                               .where(checkpoint)
+                               .values(chunks=chunks, rows=rows))
+        loaded += len(chunk)
+        rate = loaded / max(monotonic() - started, 1e-6)
+        echo(f"{table.name}: chunk {chunks}, {rows:,} rows ({rate:,.0f} rows/s)")
+
+    return rows
+
+
+##############################################################################
+# Deferred indexes and constraints
+
+
+def drop_constraints(engine, tables):
+    """Drop `tables`' secondary indexes, and on PostgreSQL their foreign key
+    and unique constraints, whatever their names in the database."""
+
+    inspector = inspect(engine)
+    quote = engine.dialect.identifier_preparer.quote
+    postgres = engine.dialect.name == 'postgresql'
+
+    with engine.begin() as connection:
+        for table in tables:
+            if postgres:
+                reflected = (inspector.get_foreign_keys(table.name)
+                             + inspector.get_unique_constraints(table.name))
+                for constraint in reflected:
+                    connection.execute(text(
+                        f"ALTER TABLE {quote(table.name)} "
+                        f"DROP CONSTRAINT IF EXISTS {quote(constraint['name'])}"))
+            for index in inspector.get_indexes(table.name):
+                connection.execute(text(
+                    f"DROP INDEX IF EXISTS {quote(index['name'])}"))
+
+
+def restore_constraints(engine, tables, echo):
+    """Build `tables`' indexes and constraints as the models define them."""
+
+    # start from nothing, in case an earlier attempt got part way through
+    drop_constraints(engine, tables)
+    postgres = engine.dialect.name == 'postgresql'
+
+    for table in tables:
+        echo(f"{table.name}: building indexes and constraints")
+        with engine.begin() as connection:
+            for index in table.indexes:
+                connection.execute(CreateIndex(index))
+            if postgres:
+                for constraint in table.constraints:
+                    if isinstance(constraint, (UniqueConstraint,
+                                               ForeignKeyConstraint)):
+                        connection.execute(AddConstraint(constraint))
+
+
+def reset_sequences(engine, tables):
+    """Move PostgreSQL id sequences past the ids the load wrote explicitly."""
+
+    if engine.dialect.name != 'postgresql':
+        return
+
+    with engine.begin() as connection:
+        for table in tables:
+            if 'id' in table.c and table.c.id.primary_key:
+                connection.execute(text(
+                    f"SELECT setval(pg_get_serial_sequence('{table.name}', 'id'), "
+                    f"coalesce(max(id), 0) + 1, false) FROM {table.name}"))
+
+
+##############################################################################
+# The whole load
+
+
+def load(source, chunk_size=CHUNK_SIZE, jobs=1, resume=False, echo=print):
+    """Load every ``<table>.csv`` in `source`; see the module docstring.
+
+    Unless `resume` is set, all tables are dropped and recreated first.
+    Needs an app context. Returns {table name: rows loaded}.
+    """
+
+    engine = db.engine
+    found = csv_tables(source)
+    tables = [table for table, path in found]
+    if not found:
+        raise ValueError(f"no table CSVs found in {source}")
+
+    if not resume:
+        db.drop_all()
+        db.create_all()
+        with engine.begin() as connection:
+            migrations.stamp(connection)
+        checkpoint_metadata.drop_all(engine)
+    checkpoint_metadata.create_all(engine)
+
+    search.uninstall(engine)
+    drop_constraints(engine, tables)
+
+    if engine.dialect.name != 'postgresql':
+        jobs = 1
+    with ThreadPoolExecutor(max_workers=jobs) as pool:
+        futures = [(table.name, pool.submit(load_table, engine, table, path,
+                                            chunk_size, echo))
+                   for table, path in found]
+        loaded = {name: future.result() for name, future in futures}
+
+    restore_constraints(engine, tables, echo)
+    reset_sequences(engine, tables)
+
+    echo("building search indexes")
+    search.install(engine, rebuild=True)
+    echo("reconciling counters")
+    counters.reconcile_counters()
+    if timeline.enabled():
+        echo("rebuilding home timelines")
+        timeline.rebuild_timelines()
+
+    with engine.begin() as connection:
+        connection.execute(load_checkpoints.delete())
+
+    return loaded
@@ -0,0 +1,281 @@
+"""Versioned schema migrations for Warbler.
+
+``flask db-upgrade`` brings a database up to date. Which migrations a
+database has had is recorded in ``schema_version``. A brand new database is
+created straight from the models and stamped with the latest version. An
+existing one is taken through each migration it hasn't had, in order, each
+in its own transaction.
+
+Databases made before migrations existed, by the old ``create_all()`` at
+import, have no ``schema_version`` table. They start from migration 1.
+Every migration therefore checks what is already there (columns, tables,
+indexes) and only adds what is missing. That way, a database created at any
+point along the way ends up the same.
+
+To change the schema, change the model and append a migration that makes
+the same change to existing databases.
+"""
+
+from datetime import datetime
+
+from sqlalchemy import (Column, DateTime, Integer, MetaData, Table, Text,
+                        func, inspect, select, text)
+from sqlalchemy.schema import CreateColumn
+
+import counters
+import search
+from models import (db, Conversation, ConversationMember, DirectMessage,
+                    Follows, Job, Likes, Message, Suggestion,
+                    SuggestionRefresh, TimelineEntry, TrendingCheckpoint,
+                    TrendingMessage, User)
+
+# Kept out of db.metadata, so drop_all() (e.g. in a bulk load) leaves the
+# record of what the database has had alone.
+version_metadata = MetaData()
+schema_version = Table(
+    'schema_version', version_metadata,
+    Column('version', Integer, primary_key=True),
+    Column('description', Text, nullable=False),
+    Column('applied_at', DateTime, nullable=False),
+)
+
+MIGRATIONS = []
+
+
+def migration(version, description):
+    """Register the decorated function(connection) as migration `version`."""
+
+    def register(apply):
+        assert version == len(MIGRATIONS) + 1, "migrations must be numbered in order"
+        MIGRATIONS.append((version, description, apply))
+        return apply
+    return register
+
+
+def latest_version():
+    return MIGRATIONS[-1][0]
+
+
+##############################################################################
+# Building blocks: each does nothing if its change is already there
+
+
+def add_column(connection, model, name):
+    table = model.__table__
+    existing = {column['name'] for column in inspect(connection).get_columns(table.name)}
+    if name not in existing:
+        column = CreateColumn(table.c[name]).compile(dialect=connection.dialect)
+        connection.execute(text(f"ALTER TABLE {table.name} ADD COLUMN {column}"))
+
+
+def create_table(connection, model):
+    """Create `model`'s table, with its indexes, if it doesn't exist."""
+
+    model.__table__.create(connection, checkfirst=True)
+
+
+def create_index(connection, model, name):
+    table = model.__table__
+    existing = {index['name'] for index in inspect(connection).get_indexes(table.name)}
+    if name not in existing:
+        index, = [index for index in table.indexes if index.name == name]
+        index.create(connection)
+
+
+def add_unique(connection, model, name):
+    """Add a unique constraint; a unique index on backends that can't ALTER
+    one in (SQLite), which serves inserts ON CONFLICT all the same."""
+
+    table = model.__table__
+    found = inspect(connection)
+    existing = ({constraint['name'] for constraint in found.get_unique_constraints(table.name)}
+                | {index['name'] for index in found.get_indexes(table.name)})
+    if name in existing:
+        return
+
+    constraint, = [constraint for constraint in table.constraints
+                   if constraint.name == name]
+    columns = ', '.join(column.name for column in constraint.columns)
+    # Spelled out rather than AddConstraint(constraint), which would leave
+    # the constraint out of later create_all()s in this process.
+    if connection.dialect.name == 'postgresql':
+        connection.execute(text(
+            f"ALTER TABLE {table.name} ADD CONSTRAINT {name} UNIQUE ({columns})"))
+    else:
+        connection.execute(text(f"CREATE UNIQUE INDEX {name} ON {table.name} ({columns})"))
+
+
+def drop_unique(connection, model, columns):
+    """Drop the unique constraints on exactly `columns`, whatever they're
+    called. PostgreSQL only: SQLite can't drop a table's constraints, and
+    the schemas that had them were only ever created on PostgreSQL."""
+
+    if connection.dialect.name != 'postgresql':
+        return
+    table = model.__table__
+    for constraint in inspect(connection).get_unique_constraints(table.name):
+        if constraint['column_names'] == list(columns):
+            connection.execute(text(
+                f'ALTER TABLE {table.name} DROP CONSTRAINT IF EXISTS "{constraint["name"]}"'))
+
+
+def fill_counters(connection, *names):
+    """Set counter columns from the tables they count."""
+
+    counts = counters.true_counts()
+    connection.execute(User.__table__.update().values(
+        {name: counts[name] for name in names}))
+
+
+##############################################################################
+# The migrations, oldest first
+
+
+@migration(1, "denormalized counters on users")
+def add_counters(connection):
+    names = ('messages_count', 'followers_count', 'following_count', 'likes_count')
+    for name in names:
+        add_column(connection, User, name)
+    fill_counters(connection, *names)
+
+
+@migration(2, "materialized home timelines")
+def add_timelines(connection):
+    create_table(connection, TimelineEntry)
+
+
+@migration(3, "one like per user and message")
+def unique_likes(connection):
+    likes = Likes.__table__
+    first_likes = (select([func.min(likes.c.id)])
+                   .group_by(likes.c.user_id, likes.c.message_id))
+    connection.execute(likes.delete().where(likes.c.id.notin_(first_likes)))
+    add_unique(connection, Likes, 'uq_likes_user_message')
+    create_index(connection, Likes, 'ix_likes_message_id')
+    fill_counters(connection, 'likes_count')
+
+
+@migration(4, "user versions for the fragment cache")
+def add_user_versions(connection):
+    add_column(connection, User, 'version')
+
+
+@migration(5, "likes received counter")
+def add_likes_received(connection):
+    add_column(connection, User, 'likes_received_count')
+    fill_counters(connection, 'likes_received_count')
+
+
+@migration(6, "direct messages")
+def add_direct_messages(connection):
+    for model in (Conversation, ConversationMember, DirectMessage):
+        create_table(connection, model)
+    add_column(connection, User, 'unread_dm_count')
+
+
+@migration(7, "indexes for the hot routes")
+def add_hot_path_indexes(connection):
+    create_index(connection, Message, 'ix_messages_user_timestamp')
+    create_index(connection, Follows, 'ix_follows_following')
+    create_index(connection, TimelineEntry, 'ix_timeline_entries_message')
+
+
+@migration(8, "background job queue")
+def add_jobs(connection):
+    create_table(connection, Job)
+
+
+@migration(9, "soft-deleted accounts")
+def add_deleted_at(connection):
+    add_column(connection, User, 'deleted_at')
+
+
+@migration(10, "follow suggestions")
+def add_suggestions(connection):
+    create_table(connection, Suggestion)
+    create_table(connection, SuggestionRefresh)
+    create_index(connection, User, 'ix_users_followers_count')
+
+
+@migration(11, "trending messages")
+def add_trending(connection):
+    create_table(connection, TrendingMessage)
+    create_table(connection, TrendingCheckpoint)
+
+
+@migration(12, "more than one like per message")
+def drop_unique_message_likes(connection):
+    # the first models.py made message_id unique: one like per message.
+    # Migration 3 didn't drop it, so this does, for every database
+    drop_unique(connection, Likes, ['message_id'])
+
+
+@migration(13, "like timestamps")
+def add_like_timestamps(connection):
+    add_column(connection, Likes, 'timestamp')
+
+
+@migration(14, "like versions for page validators")
+def add_like_versions(connection):
+    add_column(connection, User, 'likes_version')
+
+
+@migration(15, "message versions for profile validators")
+def add_message_versions(connection):
+    add_column(connection, User, 'messages_version')
+
+
+##############################################################################
+# Running them
+
+
+def current_version(connection):
+    """The database's schema version: 0 if it has none recorded."""
+
+    if not connection.dialect.has_table(connection, 'schema_version'):
+        return 0
+    return connection.execute(select([func.max(schema_version.c.version)])).scalar() or 0
+
+
+def stamp(connection, version=None):
+    """Record that the database is at `version` (the latest by default),
+    e.g. after creating it from the models."""
+
+    version_metadata.create_all(connection)
+    connection.execute(schema_version.delete())
+    connection.execute(schema_version.insert().values([
+        {'version': number, 'description': description,
+         'applied_at': datetime.utcnow()}
+        for number, description, apply in MIGRATIONS
+        if number <= (version or latest_version())]))
+
+
+def upgrade(engine, echo=print):
+    """Bring `engine`'s database up to the latest version and (re)install
+    the search indexes. Returns the versions applied."""
+
+    with engine.begin() as connection:
+        fresh = (not connection.dialect.has_table(connection, 'schema_version')
+                 and not connection.dialect.has_table(connection, 'users'))
+        if fresh:
+            echo("creating a new database")
+            db.metadata.create_all(connection)
+            stamp(connection)
+        version_metadata.create_all(connection)
+        version = current_version(connection)
+
+    applied = []
+    for number, description, apply in MIGRATIONS:
+        if number <= version:
+            continue
+        echo(f"{number}: {description}")
+        with engine.begin() as connection:
+            apply(connection)
+            connection.execute(schema_version.insert().values(
+                version=number, description=description,
+                applied_at=datetime.utcnow()))
+        applied.append(number)
+
+    search.install(engine)
+    return applied
+
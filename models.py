@@ -1,12 +1,23 @@
 """SQLAlchemy models for Warbler."""
 
+from collections import namedtuple
 from datetime import datetime
 
-from flask_bcrypt import Bcrypt
-from flask_sqlalchemy import SQLAlchemy
+from sqlalchemy.dialects import postgresql
 
-bcrypt = Bcrypt()
-db = SQLAlchemy()
+import passwords
+from replicas import RoutingSQLAlchemy
+
+db = RoutingSQLAlchemy()
+
+# Like state of a page of messages: the ids the viewer liked, and each
+# message's like count by id (messages nobody liked are missing).
+LikeState = namedtuple('LikeState', ['liked', 'counts'])
+
+# User columns anyone may see, e.g. in JSON responses.
+PUBLIC_USER_FIELDS = ('id', 'username', 'image_url', 'header_image_url', 'bio',
+                      'location', 'messages_count', 'followers_count',
+                      'following_count', 'likes_count')
 
 
 class Follows(db.Model):
@@ -26,11 +37,67 @@ class Follows(db.Model):
         primary_key=True,
     )
 
+    __table_args__ = (
+        # the primary key serves "who follows X"; this serves "who does X
+        # follow" (following lists, the unmaterialized homepage)
+        db.Index('ix_follows_following',
+                 'user_following_id', 'user_being_followed_id'),
+    )
+
+    @classmethod
+    def add(cls, follower_id, user_ids):
+        """Have `follower_id` follow each of `user_ids` they don't yet, in
+        a single statement keyed on the primary key (a statement per id on
+        SQLite).
+
+        Ids of missing or deleted users, and the follower's own, are skipped.
+        Returns the set of ids newly followed. Like other set-based writes,
+        this bypasses the ORM, so the caller adjusts counters and timelines.
+        """
+
+        table = cls.__table__
+        users = User.__table__
+        columns = ['user_being_followed_id', 'user_following_id']
+        candidates = (db.select([users.c.id, db.literal(follower_id)])
+                      .where(users.c.id.in_(user_ids))
+                      .where(users.c.id != follower_id)
+                      .where(users.c.deleted_at.is_(None)))
+
+        if db.session.get_bind().dialect.name == 'postgresql':
+            result = insert_if_absent(table, candidates, columns, columns=columns,
+                                      returning=[table.c.user_being_followed_id])
+            return {user_id for (user_id,) in result}
+
+        # no RETURNING here: a row at a time, each insert's rowcount saying
+        # whether it was new, so two requests adding the same follow can't
+        # both count it
+        added = set()
+        for user_id, _ in db.session.execute(candidates).fetchall():
+            values = {'user_being_followed_id': user_id, 'user_following_id': follower_id}
+            if insert_if_absent(table, values, columns).rowcount == 1:
+                added.add(user_id)
+        return added
+
+    @classmethod
+    def remove(cls, follower_id, user_id):
+        """Unfollow by key. Returns True if a follow was removed."""
+
+        table = cls.__table__
+        return db.session.execute(
+            table.delete()
+            .where(table.c.user_being_followed_id == user_id)
+            .where(table.c.user_following_id == follower_id)
+        ).rowcount == 1
+
 
 class Likes(db.Model):
     """Mapping user likes to warbles."""
 
     __tablename__ = 'likes' 
+    __table_args__ = (
+        db.UniqueConstraint('user_id', 'message_id',
+                            name='uq_likes_user_message'),
+    )
 
     id = db.Column(
         db.Integer,
@@ -45,15 +112,70 @@ class Likes(db.Model):
     message_id = db.Column(
         db.Integer,
         db.ForeignKey('messages.id', ondelete='cascade'),
-        unique=True
+        index=True,
+    )
+
+    # when it was liked; null for likes from before this was recorded
+    timestamp = db.Column(
+        db.DateTime,
+        default=datetime.utcnow,
     )
 
+    @classmethod
+    def add(cls, user_id, message_id, timestamp=None):
+        """Like a message, unless already liked, in a single statement.
+
+        Returns True if a like was added. Like other set-based writes, this
+        bypasses the ORM, so the caller adjusts the liker's and the author's
+        counters.
+        """
+
+        values = {'user_id': user_id, 'message_id': message_id,
+                  'timestamp': timestamp or datetime.utcnow()}
+        return insert_if_absent(cls.__table__, values, ['user_id', 'message_id']).rowcount == 1
+
+    @classmethod
+    def state_for(cls, viewer_id, message_ids):
+        """LikeState of `message_ids` for `viewer_id`, in one GROUP BY query."""
+
+        if not message_ids:
+            return LikeState(set(), {})
+
+        viewer_liked = db.func.max(
+            db.case([(cls.user_id == viewer_id, 1)], else_=0))
+        rows = (db.session
+                .query(cls.message_id, db.func.count(), viewer_liked)
+                .filter(cls.message_id.in_(message_ids))
+                .group_by(cls.message_id))
+
+        liked, counts = set(), {}
+        for message_id, count, mine in rows:
+            counts[message_id] = count
+            if mine:
+                liked.add(message_id)
+        return LikeState(liked, counts)
+
+    @classmethod
+    def remove(cls, user_id, message_id):
+        """Unlike a message by key. Returns True if a like was removed."""
+
+        table = cls.__table__
+        return db.session.execute(
+            table.delete()
+            .where(table.c.user_id == user_id)
+            .where(table.c.message_id == message_id)).rowcount == 1
+
 
 class User(db.Model):
     """User in the system."""
 
     __tablename__ = 'users'
 
+    __table_args__ = (
+        # the most followed accounts, for suggestions (see suggestions.py)
+        db.Index('ix_users_followers_count', 'followers_count', 'id'),
+    )
+
     id = db.Column(
         db.Integer,
         primary_key=True,
@@ -94,6 +216,91 @@ class User(db.Model):
         nullable=False,
     )
 
+    # Denormalized counts, kept up to date by counters.py so profile stats
+    # don't have to load whole relationships just to measure them.
+
+    messages_count = db.Column(
+        db.Integer,
+        nullable=False,
+        default=0,
+        server_default='0',
+    )
+
+    followers_count = db.Column(
+        db.Integer,
+        nullable=False,
+        default=0,
+        server_default='0',
+    )
+
+    following_count = db.Column(
+        db.Integer,
+        nullable=False,
+        default=0,
+        server_default='0',
+    )
+
+    likes_count = db.Column(
+        db.Integer,
+        nullable=False,
+        default=0,
+        server_default='0',
+    )
+
+    likes_received_count = db.Column(
+        db.Integer,
+        nullable=False,
+        default=0,
+        server_default='0',
+    )
+
+    # Sum of the unread_count of this user's conversations (see dms.py).
+
+    unread_dm_count = db.Column(
+        db.Integer,
+        nullable=False,
+        default=0,
+        server_default='0',
+    )
+
+    # Bumped whenever something shown in cached page fragments changes (see
+    # fragments.py).
+
+    version = db.Column(
+        db.Integer,
+        nullable=False,
+        default=1,
+        server_default='1',
+    )
+
+    # Bumped whenever one of their messages is posted or deleted, or gains
+    # or loses a like, so their profile's ETag changes with its message list
+    # (see caching.py).
+
+    messages_version = db.Column(
+        db.Integer,
+        nullable=False,
+        default=0,
+        server_default='0',
+    )
+
+    # Bumped by every like and unlike of theirs, so pages that show which
+    # messages they liked can tell when that changed (see caching.py).
+
+    likes_version = db.Column(
+        db.Integer,
+        nullable=False,
+        default=0,
+        server_default='0',
+    )
+
+    # When the account was deleted. It is hidden from then on, until a
+    # background job purges its rows (see deletion.py).
+
+    deleted_at = db.Column(
+        db.DateTime,
+    )
+
     messages = db.relationship('Message')
 
     followers = db.relationship(
@@ -118,17 +325,41 @@ class User(db.Model):
     def __repr__(self):
         return f"<User #{self.id}: {self.username}, {self.email}>"
 
+    def serialize(self):
+        """Public fields of this user, as a dict for JSON."""
+
+        return {name: getattr(self, name) for name in PUBLIC_USER_FIELDS}
+
     def is_followed_by(self, other_user):
         """Is this user followed by `other_user`?"""
 
-        found_user_list = [user for user in self.followers if user == other_user]
-        return len(found_user_list) == 1
+        return Follows.query.get((self.id, other_user.id)) is not None
 
     def is_following(self, other_user):
-        """Is this user following `other_use`?"""
+        """Is this user following `other_user`?"""
+
+        return Follows.query.get((other_user.id, self.id)) is not None
+
+    def following_among(self, user_ids):
+        """Which of `user_ids` is this user following?
+
+        Answers for a whole page of users in one query; returns a set of ids.
+        """
+
+        if not user_ids:
+            return set()
 
-        found_user_list = [user for user in self.following if user == other_user]
-        return len(found_user_list) == 1
+        rows = (db.session
+                .query(Follows.user_being_followed_id)
+                .filter(Follows.user_following_id == self.id,
+                        Follows.user_being_followed_id.in_(user_ids)))
+        return {user_id for (user_id,) in rows}
+
+    @classmethod
+    def active(cls):
+        """Query of the users whose accounts haven't been deleted."""
+
+        return cls.query.filter(cls.deleted_at.is_(None))
 
     @classmethod
     def signup(cls, username, email, password, image_url):
@@ -137,7 +368,7 @@ class User(db.Model):
         Hashes password and adds user to system.
         """
 
-        hashed_pwd = bcrypt.generate_password_hash(password).decode('UTF-8')
+        hashed_pwd = passwords.hash_password(password)
 
         user = User(
             username=username,
@@ -158,17 +389,38 @@ class User(db.Model):
         and, if it finds such a user, returns that user object.
 
         If can't find matching user (or if password is wrong), returns False.
+
+        A hash made at an outdated cost is replaced with a fresh one on
+        success; the caller commits it along with whatever else it does.
         """
 
-        user = cls.query.filter_by(username=username).first()
+        user = cls.active().filter_by(username=username).first()
 
         if user:
-            is_auth = bcrypt.check_password_hash(user.password, password)
+            is_auth = passwords.check_password(user.password, password)
             if is_auth:
+                if passwords.needs_rehash(user.password):
+                    user.password = passwords.hash_password(password)
                 return user
 
         return False
 
+    @classmethod
+    def change_password(cls, username, old_password, new_password, confirm):
+        """Change `username`'s password, if `old_password` is right.
+
+        Returns the user, with the new hash set but not committed, or False
+        if the old password is wrong or the new ones don't match.
+        """
+
+        if new_password != confirm:
+            return False
+
+        user = cls.authenticate(username, old_password)
+        if user:
+            user.password = passwords.hash_password(new_password)
+        return user
+
 
 class Message(db.Model):
     """An individual message ("warble")."""
@@ -188,7 +440,7 @@ class Message(db.Model):
     timestamp = db.Column(
         db.DateTime,
         nullable=False,
-        default=datetime.utcnow(),
+        default=datetime.utcnow,
     )
 
     user_id = db.Column(
@@ -199,6 +451,391 @@ class Message(db.Model):
 
     user = db.relationship('User')
 
+    __table_args__ = (
+        # profile pages and the unmaterialized homepage: one user's
+        # messages, newest first
+        db.Index('ix_messages_user_timestamp', 'user_id', 'timestamp', 'id'),
+    )
+
+
+class TimelineEntry(db.Model):
+    """A message materialized into one user's home timeline."""
+
+    __tablename__ = 'timeline_entries'
+
+    user_id = db.Column(
+        db.Integer,
+        db.ForeignKey('users.id', ondelete='cascade'),
+        primary_key=True,
+    )
+
+    message_id = db.Column(
+        db.Integer,
+        db.ForeignKey('messages.id', ondelete='cascade'),
+        primary_key=True,
+    )
+
+    author_id = db.Column(
+        db.Integer,
+        db.ForeignKey('users.id', ondelete='cascade'),
+        nullable=False,
+    )
+
+    timestamp = db.Column(
+        db.DateTime,
+        nullable=False,
+    )
+
+    __table_args__ = (
+        # homepage reads: one range scan per reader, newest first
+        db.Index('ix_timeline_entries_user_timestamp',
+                 'user_id', 'timestamp', 'message_id'),
+        # unfollow prunes one author out of one reader's timeline
+        db.Index('ix_timeline_entries_user_author', 'user_id', 'author_id'),
+        # deleting a message cascades to its entries
+        db.Index('ix_timeline_entries_message', 'message_id'),
+    )
+
+
+class Conversation(db.Model):
+    """A private thread between two users.
+
+    The pair is stored lowest id first, so there's one conversation per pair
+    of users whichever of them writes first.
+    """
+
+    __tablename__ = 'conversations'
+
+    id = db.Column(
+        db.Integer,
+        primary_key=True,
+    )
+
+    user_low_id = db.Column(
+        db.Integer,
+        db.ForeignKey('users.id', ondelete='cascade'),
+        nullable=False,
+    )
+
+    user_high_id = db.Column(
+        db.Integer,
+        db.ForeignKey('users.id', ondelete='cascade'),
+        nullable=False,
+    )
+
+    # the thread's newest message, so inbox rows need no scan of the thread
+    last_message_id = db.Column(
+        db.Integer,
+    )
+
+    last_message_at = db.Column(
+        db.DateTime,
+    )
+
+    __table_args__ = (
+        db.UniqueConstraint('user_low_id', 'user_high_id',
+                            name='uq_conversations_participants'),
+        # deleting a user cascades through both columns
+        db.Index('ix_conversations_user_high', 'user_high_id'),
+    )
+
+
+class ConversationMember(db.Model):
+    """One user's side of a conversation: its place in their inbox and how
+    many of its messages they haven't read."""
+
+    __tablename__ = 'conversation_members'
+
+    conversation_id = db.Column(
+        db.Integer,
+        db.ForeignKey('conversations.id', ondelete='cascade'),
+        primary_key=True,
+    )
+
+    user_id = db.Column(
+        db.Integer,
+        db.ForeignKey('users.id', ondelete='cascade'),
+        primary_key=True,
+    )
+
+    other_user_id = db.Column(
+        db.Integer,
+        db.ForeignKey('users.id', ondelete='cascade'),
+        nullable=False,
+    )
+
+    last_message_at = db.Column(
+        db.DateTime,
+        nullable=False,
+    )
+
+    unread_count = db.Column(
+        db.Integer,
+        nullable=False,
+        default=0,
+        server_default='0',
+    )
+
+    other_user = db.relationship('User', foreign_keys=[other_user_id])
+
+    __table_args__ = (
+        # inbox reads: a user's conversations, latest activity first
+        db.Index('ix_conversation_members_inbox',
+                 'user_id', 'last_message_at', 'conversation_id'),
+        db.Index('ix_conversation_members_other_user', 'other_user_id'),
+    )
+
+
+class DirectMessage(db.Model):
+    """A private message from one user to another."""
+
+    __tablename__ = 'direct_messages'
+
+    id = db.Column(
+        db.Integer,
+        primary_key=True,
+    )
+
+    conversation_id = db.Column(
+        db.Integer,
+        db.ForeignKey('conversations.id', ondelete='cascade'),
+        nullable=False,
+    )
+
+    author_id = db.Column(
+        db.Integer,
+        db.ForeignKey('users.id', ondelete='cascade'),
+        nullable=False,
+    )
+
+    recipient_id = db.Column(
+        db.Integer,
+        db.ForeignKey('users.id', ondelete='cascade'),
+        nullable=False,
+    )
+
+    text = db.Column(
+        db.String(140),
+        nullable=False,
+    )
+
+    timestamp = db.Column(
+        db.DateTime,
+        nullable=False,
+        default=datetime.utcnow,
+    )
+
+    author = db.relationship('User', foreign_keys=[author_id])
+
+    recipient = db.relationship('User', foreign_keys=[recipient_id])
+
+    __table_args__ = (
+        # thread reads, newest first
+        db.Index('ix_direct_messages_conversation_timestamp',
+                 'conversation_id', 'timestamp', 'id'),
+        # outbox reads, newest first
+        db.Index('ix_direct_messages_author_timestamp',
+                 'author_id', 'timestamp', 'id'),
+        db.Index('ix_direct_messages_recipient', 'recipient_id'),
+    )
+
+
+class Job(db.Model):
+    """Deferred work for the background workers; see jobs.py."""
+
+    __tablename__ = 'jobs'
+
+    id = db.Column(
+        db.Integer,
+        primary_key=True,
+    )
+
+    kind = db.Column(
+        db.String(100),
+        nullable=False,
+    )
+
+    # JSON keyword arguments for the job's handler
+    payload = db.Column(
+        db.Text,
+        nullable=False,
+        default='{}',
+    )
+
+    # idempotency key: a job with the same key is only enqueued once
+    key = db.Column(
+        db.String(200),
+        unique=True,
+    )
+
+    # queued, running, done or failed
+    status = db.Column(
+        db.String(10),
+        nullable=False,
+        default='queued',
+    )
+
+    attempts = db.Column(
+        db.Integer,
+        nullable=False,
+        default=0,
+    )
+
+    max_attempts = db.Column(
+        db.Integer,
+        nullable=False,
+        default=5,
+    )
+
+    created_at = db.Column(
+        db.DateTime,
+        nullable=False,
+        default=datetime.utcnow,
+    )
+
+    # when it is due: its creation, or its next retry
+    run_at = db.Column(
+        db.DateTime,
+        nullable=False,
+        default=datetime.utcnow,
+    )
+
+    locked_by = db.Column(
+        db.String(200),
+    )
+
+    locked_at = db.Column(
+        db.DateTime,
+    )
+
+    finished_at = db.Column(
+        db.DateTime,
+    )
+
+    last_error = db.Column(
+        db.Text,
+    )
+
+    __table_args__ = (
+        # workers claim the earliest due job
+        db.Index('ix_jobs_status_run_at', 'status', 'run_at'),
+    )
+
+
+class Suggestion(db.Model):
+    """An account suggested to a user to follow (see suggestions.py)."""
+
+    __tablename__ = 'user_suggestions'
+
+    user_id = db.Column(
+        db.Integer,
+        db.ForeignKey('users.id', ondelete='cascade'),
+        primary_key=True,
+    )
+
+    suggested_id = db.Column(
+        db.Integer,
+        db.ForeignKey('users.id', ondelete='cascade'),
+        primary_key=True,
+    )
+
+    # 1 for the best suggestion
+    rank = db.Column(
+        db.Integer,
+        nullable=False,
+    )
+
+    # how many of the accounts the user follows follow this one
+    mutuals = db.Column(
+        db.Integer,
+        nullable=False,
+    )
+
+    __table_args__ = (
+        db.Index('ix_user_suggestions_rank', 'user_id', 'rank'),
+        # deleting an account removes it from everyone's suggestions
+        db.Index('ix_user_suggestions_suggested', 'suggested_id'),
+    )
+
+
+class SuggestionRefresh(db.Model):
+    """A user whose suggestions are out of date, waiting to be recomputed."""
+
+    __tablename__ = 'suggestion_refreshes'
+
+    user_id = db.Column(
+        db.Integer,
+        db.ForeignKey('users.id', ondelete='cascade'),
+        primary_key=True,
+    )
+
+
+class TrendingMessage(db.Model):
+    """A recent message's trending score (see trending.py)."""
+
+    __tablename__ = 'trending_messages'
+
+    message_id = db.Column(
+        db.Integer,
+        db.ForeignKey('messages.id', ondelete='cascade'),
+        primary_key=True,
+    )
+
+    # decayed likes, relative to the checkpoint's epoch
+    score = db.Column(
+        db.Float,
+        nullable=False,
+    )
+
+    # the message's, so the window can be kept without a join
+    timestamp = db.Column(
+        db.DateTime,
+        nullable=False,
+    )
+
+    __table_args__ = (
+        db.Index('ix_trending_messages_score', 'score'),
+        db.Index('ix_trending_messages_timestamp', 'timestamp'),
+    )
+
+
+class TrendingCheckpoint(db.Model):
+    """The time trending scores are relative to; a single row."""
+
+    __tablename__ = 'trending_checkpoint'
+
+    id = db.Column(
+        db.Integer,
+        primary_key=True,
+    )
+
+    epoch = db.Column(
+        db.DateTime,
+        nullable=False,
+    )
+
+
+def insert_if_absent(table, values, keys, columns=None, returning=()):
+    """Insert `values` unless a row with the same `keys` exists: one row's
+    dict, or, with `columns` naming what it selects, the rows of a select.
+
+    Returns the result, whose rowcount is how many rows were inserted.
+    `returning` columns of the inserted rows are returned, on PostgreSQL
+    only.
+    """
+
+    postgres = db.session.get_bind().dialect.name == 'postgresql'
+    statement = postgresql.insert(table) if postgres else table.insert().prefix_with('OR IGNORE')
+    if columns is None:
+        statement = statement.values(values)
+    else:
+        statement = statement.from_select(columns, values)
+    if postgres:
+        statement = statement.on_conflict_do_nothing(index_elements=keys)
+    if returning:
+        statement = statement.returning(*returning)
+    return db.session.execute(statement)
+
 
 def connect_db(app):
     """Connect this database to provided Flask app.
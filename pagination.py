@@ -0,0 +1,118 @@
+"""Pagination for Warbler's lists.
+
+Message lists use keyset (cursor) pagination: pages are ordered newest
+first on (timestamp, id) and continue from an opaque ``?before=`` cursor
+that encodes the last row already shown, so the database seeks straight to
+the next page through the index instead of counting past an OFFSET; page
+500 costs the same as page 1.
+
+Lists of users, all of them or those reached through follows, have no
+timestamp to key on. They are ordered by user id, highest first, and
+continue from that id, so they seek through the primary key or the follows
+indexes the same way.
+
+Ranked lists (search results) have no such key, so they are paged by
+number with a capped depth.
+"""
+
+import binascii
+from base64 import urlsafe_b64decode, urlsafe_b64encode
+from collections import namedtuple
+from datetime import datetime
+
+from flask import abort, current_app, request
+from sqlalchemy import tuple_
+
+Page = namedtuple('Page', ['items', 'next_cursor'])
+
+NumberedPage = namedtuple('NumberedPage', ['items', 'number', 'has_next'])
+
+
+def encode_cursor(timestamp, id):
+    """Opaque cursor pointing just past the row keyed (timestamp, id)."""
+
+    raw = f"{timestamp.isoformat()}|{id}".encode('UTF-8')
+    return urlsafe_b64encode(raw).decode('ascii').rstrip('=')
+
+
+def decode_cursor(cursor):
+    """Turn a cursor back into (timestamp, id); 400 if it was tampered with."""
+
+    padded = cursor + '=' * (-len(cursor) % 4)
+    try:
+        timestamp, id = urlsafe_b64decode(padded).decode('UTF-8').split('|')
+        return datetime.fromisoformat(timestamp), int(id)
+    except (ValueError, UnicodeDecodeError, binascii.Error):
+        abort(400)
+
+
+def message_key(row):
+    """(timestamp, id) of the message in a result row or the message itself."""
+
+    message = getattr(row, 'Message', row)
+    return message.timestamp, message.id
+
+
+def paginate(query, timestamp_col, id_col, key=message_key, per_page=None):
+    """Fetch one page of `query`, newest first, after the ``?before=`` cursor.
+
+    `timestamp_col` and `id_col` are the columns the page is keyed on; `key`
+    pulls the same two values back out of a result row to build the cursor
+    for the next page.
+    """
+
+    per_page = per_page or current_app.config.get('MESSAGES_PER_PAGE', 20)
+
+    before = request.args.get('before')
+    if before:
+        query = query.filter(
+            tuple_(timestamp_col, id_col) < tuple_(*decode_cursor(before)))
+
+    rows = (query
+            .order_by(timestamp_col.desc(), id_col.desc())
+            .limit(per_page + 1)
+            .all())
+
+    next_cursor = None
+    if len(rows) > per_page:
+        rows = rows[:per_page]
+        next_cursor = encode_cursor(*key(rows[-1]))
+
+    return Page(rows, next_cursor)
+
+
+def paginate_by_id(query, id_col, per_page=None):
+    """Fetch one page of `query`, highest `id_col` first, after the
+    ``?before=`` id (400 if it isn't one).
+
+    Each row's ``id`` must be its `id_col` value, e.g. a user's id where
+    `id_col` is the follows column joined to it.
+    """
+
+    per_page = per_page or current_app.config.get('MESSAGES_PER_PAGE', 20)
+
+    before = request.args.get('before')
+    if before:
+        try:
+            query = query.filter(id_col < int(before))
+        except ValueError:
+            abort(400)
+
+    rows = query.order_by(id_col.desc()).limit(per_page + 1).all()
+
+    next_cursor = None
+    if len(rows) > per_page:
+        rows = rows[:per_page]
+        next_cursor = str(rows[-1].id)
+
+    return Page(rows, next_cursor)
+
+
+def numbered_page(query, number, per_page, max_page):
+    """Fetch page `number` (1-based) of an ordered `query`; 400 past `max_page`."""
+
+    if not 1 <= number <= max_page:
+        abort(400)
+
+    rows = query.limit(per_page + 1).offset((number - 1) * per_page).all()
+    return NumberedPage(rows[:per_page], number, len(rows) > per_page)
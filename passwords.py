@@ -0,0 +1,148 @@
+"""Password hashing for Warbler, off the request workers.
+
+bcrypt is deliberately slow: at cost 12 a single hash or check takes a few
+hundred milliseconds of CPU. Run inline, a burst of logins stalls every
+other request queued behind them on the same worker. Instead, hashing and
+checking are handed to a small pool of processes shared by the worker
+(``PASSWORD_POOL_WORKERS``, default one per core). No more than
+``PASSWORD_POOL_QUEUE`` calls may wait for the pool at once. Beyond that,
+:class:`PasswordPoolBusy` is raised immediately, and the app answers 503
+instead of letting the backlog grow.
+
+The cost is ``BCRYPT_LOG_ROUNDS``. Hashes made at any other cost (or with
+an older bcrypt variant) are reported by :func:`needs_rehash` so they can be
+replaced the next time their owner logs in successfully.
+
+``PASSWORD_POOL_WORKERS=0`` hashes inline, e.g. for tests.
+"""
+
+import os
+import threading
+from concurrent.futures import ProcessPoolExecutor
+
+import bcrypt
+
+settings = {
+    'rounds': 12,
+    'workers': os.cpu_count() or 1,
+    'queue': None,
+}
+
+_pool = None
+_pool_pid = None
+_lock = threading.Lock()
+
+# calls currently running in or waiting for the pool, and calls turned away
+load = {'in_flight': 0, 'rejected': 0}
+
+
+class PasswordPoolBusy(Exception):
+    """Raised when too many password operations are already waiting."""
+
+
+def configure(app):
+    """Set bcrypt cost and pool size from `app`'s config."""
+
+    global _pool
+
+    settings['rounds'] = app.config.get('BCRYPT_LOG_ROUNDS', 12)
+    settings['workers'] = app.config.get('PASSWORD_POOL_WORKERS',
+                                         os.cpu_count() or 1)
+    settings['queue'] = app.config.get('PASSWORD_POOL_QUEUE')
+
+    with _lock:
+        if _pool is not None:
+            _pool.shutdown(wait=False)
+        _pool = None
+
+
+##############################################################################
+# Work done in the pool (module-level so it can be sent to other processes)
+
+
+def _hash(password, rounds):
+    return bcrypt.hashpw(password.encode('UTF-8'),
+                         bcrypt.gensalt(rounds)).decode('UTF-8')
+
+
+def _check(hashed, password):
+    try:
+        return bcrypt.checkpw(password.encode('UTF-8'), hashed.encode('UTF-8'))
+    except ValueError:
+        # not a bcrypt hash at all
+        return False
+
+
+##############################################################################
+# Dispatch
+
+
+def capacity():
+    """How many calls may be running in or waiting for the pool at once."""
+
+    queue = settings['queue']
+    if queue is None:
+        queue = settings['workers'] * 4
+    return settings['workers'] + queue
+
+
+def _get_pool():
+    """This process's pool, started on first use.
+
+    Started lazily and per pid, so a server that forks its workers after
+    importing the app gives each worker a pool of its own.
+    """
+
+    global _pool, _pool_pid
+
+    with _lock:
+        if _pool is None or _pool_pid != os.getpid():
+            _pool = ProcessPoolExecutor(max_workers=settings['workers'])
+            _pool_pid = os.getpid()
+        return _pool
+
+
+def _run(fn, *args):
+    """Run `fn(*args)` in the pool and wait for it; inline if there's none."""
+
+    if not settings['workers']:
+        return fn(*args)
+
+    with _lock:
+        if load['in_flight'] >= capacity():
+            load['rejected'] += 1
+            raise PasswordPoolBusy()
+        load['in_flight'] += 1
+    try:
+        return _get_pool().submit(fn, *args).result()
+    finally:
+        with _lock:
+            load['in_flight'] -= 1
+
+
+def hash_password(password):
+    """bcrypt hash of `password` at the configured cost, as text."""
+
+    return _run(_hash, password, settings['rounds'])
+
+
+def check_password(hashed, password):
+    """Does `password` match `hashed`?"""
+
+    return _run(_check, hashed, password)
+
+
+def needs_rehash(hashed):
+    """Was `hashed` made with another cost or variant than we'd use now?"""
+
+    try:
+        _, variant, cost, _ = hashed.split('$', 3)
+        return variant != '2b' or int(cost) != settings['rounds']
+    except ValueError:
+        return True
+
+
+def stats():
+    """Pool size and current load, for the stats endpoint."""
+
+    return dict(settings, capacity=capacity(), **load)
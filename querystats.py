@@ -0,0 +1,199 @@
+"""Per-request SQL statistics and N+1 detection.
+
+While anything is recording, engine events time every statement the app
+runs. They add it to whatever :class:`QueryStats` are recording on the
+current thread: the one a request opens when ``QUERY_STATS`` is on, and
+those tests open around the code they want a query budget for
+(:class:`QueryBudgetMixin`).
+
+Statements are grouped by fingerprint: whitespace collapsed and IN lists
+shortened. Lazy loads in a loop show up as one fingerprint run again and
+again, typically once per row of a page. With ``QUERY_STATS`` on, every
+response carries ``X-Query-Count``, ``X-Query-Time-Ms`` and
+``X-Query-Repeats``. A structured line is logged to ``warbler.sql`` per
+request, at WARNING when some statement ran ``QUERY_REPEAT_THRESHOLD`` times
+or more.
+"""
+
+import json
+import logging
+import re
+import threading
+from collections import Counter
+from contextlib import contextmanager
+from time import perf_counter
+
+from flask import g, request
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+
+log = logging.getLogger('warbler.sql')
+
+IN_LIST = re.compile(r"\(\s*(?:%\(\w+\)s|\?|\d+)(?:\s*,\s*(?:%\(\w+\)s|\?|\d+))+\s*\)")
+WHITESPACE = re.compile(r"\s+")
+
+_recording = threading.local()
+
+
+def fingerprint(statement):
+    """`statement` with whitespace collapsed and IN lists shortened to (...)."""
+
+    return IN_LIST.sub("(...)", WHITESPACE.sub(" ", statement).strip())
+
+
+class QueryStats:
+    """Count, total time and fingerprints of the statements run while recording."""
+
+    def __init__(self):
+        self.count = 0
+        self.duration = 0.0
+        self.fingerprints = Counter()
+
+    def add(self, statement, duration):
+        self.count += 1
+        self.duration += duration
+        self.fingerprints[fingerprint(statement)] += 1
+
+    def repeated(self, threshold=3):
+        """{fingerprint: times run} for statements run `threshold`+ times."""
+
+        return {statement: times
+                for statement, times in self.fingerprints.most_common()
+                if times >= threshold}
+
+    def report(self, threshold=3):
+        """Summary for logs and failed assertions."""
+
+        lines = [f"{self.count} queries in {self.duration * 1000:.1f} ms"]
+        lines += [f"  {times}x {statement}"
+                  for statement, times in self.repeated(threshold).items()]
+        return "\n".join(lines)
+
+
+@contextmanager
+def recording():
+    """Record every statement this thread runs inside the block."""
+
+    stats = QueryStats()
+    listen()
+    start(stats)
+    try:
+        yield stats
+    finally:
+        stop(stats)
+        unlisten()
+
+
+def start(stats):
+    if not hasattr(_recording, 'active'):
+        _recording.active = []
+    _recording.active.append(stats)
+
+
+def stop(stats):
+    _recording.active.remove(stats)
+
+
+def statement_started(conn, cursor, statement, parameters, context, executemany):
+    # kept on the statement's own execution context, so one that raises
+    # leaves nothing behind
+    context.query_started = perf_counter()
+
+
+def statement_finished(conn, cursor, statement, parameters, context, executemany):
+    started = getattr(context, 'query_started', None)
+    if started is None:
+        # began before the listeners were attached
+        return
+    duration = perf_counter() - started
+    for stats in getattr(_recording, 'active', ()):
+        stats.add(statement, duration)
+
+
+# The engine events are only listened for while something is recording, so
+# with QUERY_STATS off, statements outside tests' budgets pay nothing.
+_listeners = 0
+_listeners_lock = threading.Lock()
+
+
+def listen():
+    """Time statements until a matching unlisten()."""
+
+    global _listeners
+    with _listeners_lock:
+        if not _listeners:
+            event.listen(Engine, 'before_cursor_execute', statement_started)
+            event.listen(Engine, 'after_cursor_execute', statement_finished)
+        _listeners += 1
+
+
+def unlisten():
+    global _listeners
+    with _listeners_lock:
+        _listeners -= 1
+        if not _listeners:
+            event.remove(Engine, 'before_cursor_execute', statement_started)
+            event.remove(Engine, 'after_cursor_execute', statement_finished)
+
+
+##############################################################################
+# Flask integration
+
+
+def init_app(app):
+    """Record each request's statements when ``QUERY_STATS`` is on."""
+
+    if not app.config.get('QUERY_STATS'):
+        return
+
+    threshold = app.config.get('QUERY_REPEAT_THRESHOLD', 3)
+    # every request records, so listen for as long as the process runs
+    listen()
+
+    @app.before_request
+    def start_recording():
+        g.query_stats = QueryStats()
+        start(g.query_stats)
+
+    @app.after_request
+    def report_queries(response):
+        stats = g.get('query_stats')
+        if stats is None:
+            return response
+
+        repeated = stats.repeated(threshold)
+        response.headers['X-Query-Count'] = str(stats.count)
+        response.headers['X-Query-Time-Ms'] = f"{stats.duration * 1000:.1f}"
+        response.headers['X-Query-Repeats'] = str(len(repeated))
+
+        log.log(logging.WARNING if repeated else logging.INFO, json.dumps({
+            'endpoint': request.endpoint,
+            'path': request.path,
+            'status': response.status_code,
+            'queries': stats.count,
+            'db_ms': round(stats.duration * 1000, 1),
+            'repeated': repeated,
+        }))
+        return response
+
+    @app.teardown_request
+    def stop_recording(error):
+        stats = g.pop('query_stats', None)
+        if stats is not None:
+            stop(stats)
+
+
+class QueryBudgetMixin:
+    """TestCase mixin: assert how many queries a block of code may run."""
+
+    @contextmanager
+    def assertQueryBudget(self, queries, repeats=3):
+        """Fail if the block runs more than `queries` statements, or any one
+        statement `repeats` times or more (None skips that check)."""
+
+        with recording() as stats:
+            yield stats
+
+        self.assertLessEqual(stats.count, queries, stats.report())
+        if repeats is not None:
+            self.assertEqual(stats.repeated(repeats), {}, stats.report(repeats))
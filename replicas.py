@@ -0,0 +1,172 @@
+"""Read replicas and connection pool statistics.
+
+``REPLICA_URIS`` lists databases replicating the primary. They become
+Flask-SQLAlchemy binds named ``replica-0``, ``replica-1``, ... A GET of a
+view marked :func:`read_only` picks one at random for the request. Its
+SELECTs go there; everything else goes to the primary: flushes, bulk
+writes and textual SQL. Once a request has written, the rest of its reads
+go to the primary too, so it sees its own writes.
+
+A client that POSTs (or makes any other unsafe request) reads from the
+primary for ``REPLICA_STICKY_SECONDS`` afterwards. That covers replication
+lag, so the page they are redirected to shows what they just did. The
+deadline is kept in their session cookie, so it holds across app workers.
+
+Every engine's pool is a :class:`TimedQueuePool` (apart from SQLite without
+a pool size, which doesn't pool). It counts checkouts and times how long
+each took to get a connection. :func:`pool_stats` reports this for
+``/_stats``.
+"""
+
+import random
+import threading
+from time import perf_counter, time
+
+from flask import current_app, g, has_app_context, request, session
+from flask_sqlalchemy import SQLAlchemy, SignallingSession, get_state
+from sqlalchemy import exc, orm
+from sqlalchemy.pool import QueuePool
+from sqlalchemy.sql.selectable import CompoundSelect, Select
+
+SAFE_METHODS = ('GET', 'HEAD', 'OPTIONS')
+
+# Session key holding when this client may read from replicas again.
+STICKY_KEY = '_primary_until'
+
+
+def replica_key(n):
+    return f"replica-{n}"
+
+
+def init_app(app):
+    """Add the REPLICA_URIS as binds and route requests between them."""
+
+    binds = dict(app.config.get('SQLALCHEMY_BINDS') or {})
+    binds.update({replica_key(n): uri
+                  for n, uri in enumerate(app.config.get('REPLICA_URIS', ()))})
+    app.config['SQLALCHEMY_BINDS'] = binds or None
+    app.before_request(choose_database)
+    app.after_request(remember_write)
+
+
+def read_only(view):
+    """Let GETs of `view` read from a replica.
+
+    Put it anywhere below ``@app.route``: like ``caching.cache_policy`` it
+    marks the function the route registers, through any decorators that use
+    ``functools.wraps``.
+    """
+
+    view.read_only = True
+    return view
+
+
+def replica_keys():
+    return [key for key in current_app.config.get('SQLALCHEMY_BINDS') or ()
+            if key.startswith('replica-')]
+
+
+def choose_database():
+    """Pick a replica for this request's reads, if it may use one."""
+
+    g.replica = None
+    view = current_app.view_functions.get(request.endpoint)
+    if (request.method in SAFE_METHODS
+            and getattr(view, 'read_only', False)
+            and session.get(STICKY_KEY, 0) <= time()):
+        keys = replica_keys()
+        if keys:
+            g.replica = random.choice(keys)
+
+
+def remember_write(response):
+    """After an unsafe request, read from the primary for a while."""
+
+    if request.method not in SAFE_METHODS and replica_keys():
+        session[STICKY_KEY] = time() + current_app.config.get('REPLICA_STICKY_SECONDS', 5)
+    return response
+
+
+class RoutingSession(SignallingSession):
+    """Session sending a read-only request's SELECTs to its replica."""
+
+    def get_bind(self, mapper=None, clause=None):
+        replica = g.get('replica') if has_app_context() else None
+        if replica is not None:
+            if self._flushing or not (clause is None
+                                      or isinstance(clause, (Select, CompoundSelect))):
+                # this request writes: it reads from the primary from now on
+                g.replica = None
+            elif clause is not None:
+                return get_state(self.app).db.get_engine(self.app, bind=replica)
+        return super().get_bind(mapper, clause)
+
+
+class RoutingSQLAlchemy(SQLAlchemy):
+    """Flask-SQLAlchemy with replica routing and timed connection pools."""
+
+    def create_session(self, options):
+        return orm.sessionmaker(class_=RoutingSession, db=self, **options)
+
+    def apply_driver_hacks(self, app, info, options):
+        super().apply_driver_hacks(app, info, options)
+        if 'poolclass' not in options:
+            options['poolclass'] = TimedQueuePool
+            if info.drivername == 'sqlite':
+                options.setdefault('connect_args', {})['check_same_thread'] = False
+
+
+##############################################################################
+# Pool statistics
+
+
+class TimedQueuePool(QueuePool):
+    """QueuePool counting checkouts and how long they took, waiting for a
+    free connection or opening a new one."""
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self._stats_lock = threading.Lock()
+        self.checkouts = 0
+        self.timeouts = 0
+        self.wait = 0.0
+        self.longest_wait = 0.0
+
+    def _do_get(self):
+        start = perf_counter()
+        timed_out = False
+        try:
+            return super()._do_get()
+        except exc.TimeoutError:
+            timed_out = True
+            raise
+        finally:
+            waited = perf_counter() - start
+            with self._stats_lock:
+                self.checkouts += 1
+                self.timeouts += timed_out
+                self.wait += waited
+                self.longest_wait = max(self.longest_wait, waited)
+
+    def stats(self):
+        with self._stats_lock:
+            return {
+                "size": self.size(),
+                "checked_out": self.checkedout(),
+                "overflow": self.overflow(),
+                "checkouts": self.checkouts,
+                "timeouts": self.timeouts,
+                "wait_ms": round(self.wait * 1000, 3),
+                "longest_wait_ms": round(self.longest_wait * 1000, 3),
+            }
+
+
+def pool_stats():
+    """{database: pool statistics} for the primary and each replica."""
+
+    db = get_state(current_app).db
+    engines = {'primary': db.engine}
+    engines.update({key: db.get_engine(bind=key) for key in replica_keys()})
+    return {name: (engine.pool.stats() if isinstance(engine.pool, TimedQueuePool)
+                   else {"status": engine.pool.status()})
+            for name, engine in engines.items()}
@@ -0,0 +1,244 @@
+"""Indexed, ranked search over users and messages.
+
+One API, two backends:
+
+- PostgreSQL: usernames and bios are matched with ILIKE backed by pg_trgm
+  GIN indexes and ranked by trigram similarity; message text is matched
+  against a GIN-indexed ``to_tsvector`` and ranked with ``ts_rank``.
+- SQLite (local runs): FTS5 external-content tables over the same columns
+  (trigram tokenizer for users, porter for messages), kept in sync by
+  triggers and ranked by bm25.
+
+Results are paged by number, up to ``SEARCH_MAX_PAGES`` deep: ranked results
+have no stable key to seek on, so depth is capped instead.
+"""
+
+import logging
+
+from flask import current_app
+from sqlalchemy import (Column, Float, Integer, MetaData, Table, func,
+                        literal_column, or_, text)
+from sqlalchemy.exc import DBAPIError
+
+from models import db, Message, User
+from pagination import numbered_page
+
+log = logging.getLogger(__name__)
+
+TS_CONFIG = literal_column("'english'::regconfig")
+
+# The SQLite FTS5 tables, described just enough to join and rank on. They
+# live outside db.metadata so create_all() never tries to create them.
+fts_metadata = MetaData()
+users_fts = Table('users_fts', fts_metadata,
+                  Column('rowid', Integer), Column('rank', Float))
+messages_fts = Table('messages_fts', fts_metadata,
+                     Column('rowid', Integer), Column('rank', Float))
+
+POSTGRES_DDL = [
+    "CREATE INDEX IF NOT EXISTS ix_messages_text_fts ON messages "
+    "USING gin (to_tsvector('english'::regconfig, text))",
+]
+
+POSTGRES_TRIGRAM_DDL = [
+    "CREATE EXTENSION IF NOT EXISTS pg_trgm",
+    "CREATE INDEX IF NOT EXISTS ix_users_username_trgm ON users "
+    "USING gin (username gin_trgm_ops)",
+    "CREATE INDEX IF NOT EXISTS ix_users_bio_trgm ON users "
+    "USING gin (bio gin_trgm_ops)",
+]
+
+SQLITE_DDL = [
+    "CREATE VIRTUAL TABLE IF NOT EXISTS users_fts USING fts5("
+    "username, bio, content='users', content_rowid='id', tokenize='trigram')",
+    "CREATE TRIGGER IF NOT EXISTS users_fts_insert AFTER INSERT ON users BEGIN "
+    "INSERT INTO users_fts(rowid, username, bio) "
+    "VALUES (new.id, new.username, new.bio); END",
+    "CREATE TRIGGER IF NOT EXISTS users_fts_delete AFTER DELETE ON users BEGIN "
+    "INSERT INTO users_fts(users_fts, rowid, username, bio) "
+    "VALUES ('delete', old.id, old.username, old.bio); END",
+    "CREATE TRIGGER IF NOT EXISTS users_fts_update "
+    "AFTER UPDATE OF username, bio ON users BEGIN "
+    "INSERT INTO users_fts(users_fts, rowid, username, bio) "
+    "VALUES ('delete', old.id, old.username, old.bio); "
+    "INSERT INTO users_fts(rowid, username, bio) "
+    "VALUES (new.id, new.username, new.bio); END",
+    "CREATE VIRTUAL TABLE IF NOT EXISTS messages_fts USING fts5("
+    "text, content='messages', content_rowid='id', "
+    "tokenize='porter unicode61')",
+    "CREATE TRIGGER IF NOT EXISTS messages_fts_insert AFTER INSERT ON messages "
+    "BEGIN INSERT INTO messages_fts(rowid, text) VALUES (new.id, new.text); END",
+    "CREATE TRIGGER IF NOT EXISTS messages_fts_delete AFTER DELETE ON messages "
+    "BEGIN INSERT INTO messages_fts(messages_fts, rowid, text) "
+    "VALUES ('delete', old.id, old.text); END",
+    "CREATE TRIGGER IF NOT EXISTS messages_fts_update "
+    "AFTER UPDATE OF text ON messages BEGIN "
+    "INSERT INTO messages_fts(messages_fts, rowid, text) "
+    "VALUES ('delete', old.id, old.text); "
+    "INSERT INTO messages_fts(rowid, text) VALUES (new.id, new.text); END",
+]
+
+POSTGRES_INDEXES = ['ix_messages_text_fts', 'ix_users_username_trgm',
+                    'ix_users_bio_trgm']
+
+SQLITE_TRIGGERS = ['users_fts_insert', 'users_fts_delete', 'users_fts_update',
+                   'messages_fts_insert', 'messages_fts_delete',
+                   'messages_fts_update']
+
+# Filled in by install(): which index-backed features this database has.
+features = {'trigram': False, 'fts5': False}
+
+
+def install(engine, rebuild=False):
+    """Create the search indexes for `engine`'s database, if missing.
+
+    Safe to run on every start. Backends missing an optional piece (pg_trgm,
+    FTS5) fall back to unindexed LIKE matching, with a warning. `rebuild`
+    repopulates the SQLite FTS tables, e.g. after a bulk load.
+    """
+
+    dialect = engine.dialect.name
+
+    if dialect == 'postgresql':
+        with engine.begin() as connection:
+            for statement in POSTGRES_DDL:
+                connection.execute(text(statement))
+        try:
+            with engine.begin() as connection:
+                for statement in POSTGRES_TRIGRAM_DDL:
+                    connection.execute(text(statement))
+            features['trigram'] = True
+        except DBAPIError:
+            log.warning("pg_trgm unavailable; user search will not be indexed")
+
+    elif dialect == 'sqlite':
+        try:
+            with engine.begin() as connection:
+                created = not engine.dialect.has_table(connection, 'users_fts')
+                for statement in SQLITE_DDL:
+                    connection.execute(text(statement))
+                if created or rebuild:
+                    connection.execute(text(
+                        "INSERT INTO users_fts(users_fts) VALUES ('rebuild')"))
+                    connection.execute(text(
+                        "INSERT INTO messages_fts(messages_fts) VALUES ('rebuild')"))
+            features['fts5'] = True
+        except DBAPIError:
+            log.warning("SQLite FTS5 unavailable; search will not be indexed")
+
+
+def detect(engine):
+    """Fill in `features` from the indexes `engine`'s database already has,
+    without creating anything (``flask db-upgrade`` installs them)."""
+
+    dialect = engine.dialect.name
+
+    with engine.connect() as connection:
+        if dialect == 'postgresql':
+            features['trigram'] = connection.execute(
+                text("SELECT 1 FROM pg_indexes WHERE indexname = :name"),
+                name='ix_users_username_trgm').first() is not None
+        elif dialect == 'sqlite':
+            features['fts5'] = engine.dialect.has_table(connection, 'users_fts')
+
+
+def uninstall(engine):
+    """Drop the search indexes and sync triggers (not the FTS tables).
+
+    Bulk loads do this first, so rows aren't indexed one at a time, and run
+    ``install(engine, rebuild=True)`` when they're done.
+    """
+
+    dialect = engine.dialect.name
+    if dialect == 'postgresql':
+        statements = [f"DROP INDEX IF EXISTS {name}" for name in POSTGRES_INDEXES]
+    elif dialect == 'sqlite':
+        statements = [f"DROP TRIGGER IF EXISTS {name}" for name in SQLITE_TRIGGERS]
+    else:
+        return
+
+    with engine.begin() as connection:
+        for statement in statements:
+            connection.execute(text(statement))
+
+
+def dialect():
+    """Name of the database dialect the session is talking to."""
+
+    return db.session.get_bind().dialect.name
+
+
+def like_pattern(q):
+    """`q` as a LIKE substring pattern, with its own wildcards escaped."""
+
+    escaped = q.replace('\\', '\\\\').replace('%', '\\%').replace('_', '\\_')
+    return f"%{escaped}%"
+
+
+def fts5_phrase(q):
+    """`q` quoted as a single FTS5 phrase."""
+
+    return '"' + q.replace('"', '""') + '"'
+
+
+def fts5_terms(q):
+    """Each word of `q` quoted, so FTS5 matches rows containing all of them."""
+
+    return ' '.join(fts5_phrase(word) for word in q.split())
+
+
+def search_users(q, page=1, per_page=None):
+    """Users whose username or bio contains `q`, best matches first."""
+
+    per_page = per_page or current_app.config.get('SEARCH_PER_PAGE', 24)
+    max_page = current_app.config.get('SEARCH_MAX_PAGES', 50)
+    pattern = like_pattern(q)
+    query = User.active()
+
+    if dialect() == 'sqlite' and features['fts5'] and len(q) >= 3:
+        # the trigram tokenizer needs at least three characters to match
+        query = (query
+                 .join(users_fts, users_fts.c.rowid == User.id)
+                 .filter(text("users_fts MATCH :phrase")
+                         .bindparams(phrase=fts5_phrase(q)))
+                 .order_by(users_fts.c.rank, User.id))
+    else:
+        query = query.filter(or_(User.username.ilike(pattern, escape='\\'),
+                                 User.bio.ilike(pattern, escape='\\')))
+        if dialect() == 'postgresql' and features['trigram']:
+            score = func.greatest(func.similarity(User.username, q),
+                                  func.similarity(func.coalesce(User.bio, ''), q))
+            query = query.order_by(score.desc(), User.id)
+        else:
+            query = query.order_by(User.username, User.id)
+
+    return numbered_page(query, page, per_page, max_page)
+
+
+def search_messages(q, page=1, per_page=None):
+    """(Message, User) rows whose text matches `q`, best matches first."""
+
+    per_page = per_page or current_app.config.get('SEARCH_PER_PAGE', 24)
+    max_page = current_app.config.get('SEARCH_MAX_PAGES', 50)
+    query = (db.session.query(Message, User).join(User)
+             .filter(User.deleted_at.is_(None)))
+
+    if dialect() == 'postgresql':
+        vector = func.to_tsvector(TS_CONFIG, Message.text)
+        terms = func.plainto_tsquery(TS_CONFIG, q)
+        query = (query
+                 .filter(vector.op('@@')(terms))
+                 .order_by(func.ts_rank(vector, terms).desc(),
+                           Message.id.desc()))
+    elif dialect() == 'sqlite' and features['fts5']:
+        query = (query
+                 .join(messages_fts, messages_fts.c.rowid == Message.id)
+                 .filter(text("messages_fts MATCH :terms")
+                         .bindparams(terms=fts5_terms(q)))
+                 .order_by(messages_fts.c.rank, Message.id.desc()))
+    else:
+        query = (query
+                 .filter(Message.text.ilike(like_pattern(q), escape='\\'))
+                 .order_by(Message.timestamp.desc(), Message.id.desc()))
+
+    return numbered_page(query, page, per_page, max_page)
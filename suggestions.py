@@ -0,0 +1,163 @@
+"""Who-to-follow suggestions.
+
+Each user's best ``SUGGESTIONS_PER_USER`` accounts to follow are kept in
+``user_suggestions``, so ``/users/suggestions`` is one indexed read.
+
+Candidates are friends of friends: the accounts followed by the accounts a
+user follows, scored by how many such paths lead to each (its mutuals).
+That is the square of the follows adjacency matrix, which the database
+computes as a grouped self-join of ``follows``, for a batch of users per
+statement. Ties, and users with too few candidates, are filled from the
+most followed accounts. Accounts the user already follows, or that were
+deleted, are left out.
+
+Suggestions are refreshed only for users whose neighbourhood changed. A
+follow or unfollow queues the follower's followers in
+``suggestion_refreshes`` (their friends of friends changed) from a
+background job, and recomputes the follower's own suggestions there and
+then. ``flask refresh-suggestions`` works through the queue in batches of
+``SUGGESTIONS_BATCH`` users, e.g. from cron, or recomputes everyone with
+``--all``. A user opening their suggestions while still queued gets theirs
+recomputed first.
+"""
+
+from flask import current_app
+from sqlalchemy import exists, func, literal, select, true, union_all
+
+import jobs
+from models import db, insert_if_absent, Follows, Suggestion, SuggestionRefresh, User
+
+COLUMNS = ['user_id', 'suggested_id', 'rank', 'mutuals']
+
+
+def per_user():
+    return current_app.config.get('SUGGESTIONS_PER_USER', 20)
+
+
+def batch_size():
+    return current_app.config.get('SUGGESTIONS_BATCH', 1000)
+
+
+def compute(user_ids):
+    """Replace the suggestions of each of `user_ids`, and take them off the
+    refresh queue. The caller commits."""
+
+    if not user_ids:
+        return
+
+    users, suggestions = User.__table__, Suggestion.__table__
+    follows = Follows.__table__
+    first, second, mine = follows.alias('first'), follows.alias('second'), follows.alias('mine')
+    limit = per_user()
+
+    friends_of_friends = (
+        select([first.c.user_following_id.label('user_id'),
+                second.c.user_being_followed_id.label('suggested_id'),
+                func.count().label('mutuals')])
+        .select_from(first.join(
+            second, second.c.user_following_id == first.c.user_being_followed_id))
+        .where(first.c.user_following_id.in_(user_ids))
+        .group_by(first.c.user_following_id, second.c.user_being_followed_id))
+
+    # enough of the most followed to fill a list past the ones already followed
+    most_followed = (select([users.c.id])
+                     .where(users.c.deleted_at.is_(None))
+                     .order_by(users.c.followers_count.desc(), users.c.id.desc())
+                     .limit(2 * limit)
+                     .alias('most_followed'))
+    targets = select([users.c.id]).where(users.c.id.in_(user_ids)).alias('targets')
+    popular = select([targets.c.id, most_followed.c.id, literal(0)]).select_from(
+        targets.join(most_followed, true()))
+
+    candidates = union_all(friends_of_friends, popular).alias('candidates')
+    scored = (select([candidates.c.user_id, candidates.c.suggested_id,
+                      func.sum(candidates.c.mutuals).label('mutuals')])
+              .group_by(candidates.c.user_id, candidates.c.suggested_id)
+              .alias('scored'))
+
+    followed = (exists()
+                .where(mine.c.user_following_id == scored.c.user_id)
+                .where(mine.c.user_being_followed_id == scored.c.suggested_id))
+    rank = func.row_number().over(
+        partition_by=scored.c.user_id,
+        order_by=(scored.c.mutuals.desc(), users.c.followers_count.desc(),
+                  scored.c.suggested_id))
+    ranked = (select([scored.c.user_id, scored.c.suggested_id,
+                      rank.label('rank'), scored.c.mutuals])
+              .select_from(scored.join(users, users.c.id == scored.c.suggested_id))
+              .where(users.c.deleted_at.is_(None))
+              .where(scored.c.suggested_id != scored.c.user_id)
+              .where(~followed)
+              .alias('ranked'))
+    best = select([ranked.c[name] for name in COLUMNS]).where(ranked.c.rank <= limit)
+
+    db.session.execute(suggestions.delete().where(suggestions.c.user_id.in_(user_ids)))
+    db.session.execute(suggestions.insert().from_select(COLUMNS, best))
+    refreshes = SuggestionRefresh.__table__
+    db.session.execute(refreshes.delete().where(refreshes.c.user_id.in_(user_ids)))
+
+
+def queue(user_ids):
+    """Queue `user_ids` (a select of ids) for a refresh, in one statement."""
+
+    insert_if_absent(SuggestionRefresh.__table__, user_ids, ['user_id'], columns=['user_id'])
+
+
+@jobs.handler('suggestions.follows_changed')
+def follows_changed_job(user_id):
+    queue(select([Follows.user_following_id])
+          .where(Follows.user_being_followed_id == user_id))
+    compute([user_id])
+
+
+def refresh_if_queued(user_id):
+    """Recompute `user_id`'s suggestions if they're queued or were never
+    computed. Returns whether it did; the caller commits."""
+
+    queued = SuggestionRefresh.query.get(user_id) is not None
+    if queued or not db.session.query(
+            Suggestion.query.filter(Suggestion.user_id == user_id).exists()).scalar():
+        compute([user_id])
+        return True
+    return False
+
+
+def refresh_queued(echo=print):
+    """Recompute the suggestions of every queued user, a committed batch at
+    a time. Returns how many users were refreshed."""
+
+    refreshed = 0
+    while True:
+        user_ids = [user_id for (user_id,) in db.session.execute(
+            select([SuggestionRefresh.user_id])
+            .order_by(SuggestionRefresh.user_id)
+            .limit(batch_size())
+            .with_for_update(skip_locked=True))]
+        if not user_ids:
+            return refreshed
+        compute(user_ids)
+        db.session.commit()
+        refreshed += len(user_ids)
+        echo(f"refreshed {refreshed} users")
+
+
+def refresh_all(echo=print):
+    """Recompute every user's suggestions, in id ranges of SUGGESTIONS_BATCH
+    users, each committed on its own. Returns how many users were refreshed."""
+
+    low, high = db.session.query(func.min(User.id), func.max(User.id)).one()
+    if low is None:
+        return 0
+
+    refreshed = 0
+    for start in range(low, high + 1, batch_size()):
+        end = start + batch_size() - 1
+        user_ids = [user_id for (user_id,) in (db.session
+                                              .query(User.id)
+                                              .filter(User.id.between(start, end),
+                                                      User.deleted_at.is_(None)))]
+        compute(user_ids)
+        db.session.commit()
+        refreshed += len(user_ids)
+        echo(f"refreshed {refreshed} users")
+    return refreshed
@@ -0,0 +1,142 @@
+"""JSON API tests."""
+
+# run these tests like:
+#
+#    FLASK_ENV=production python -m unittest test_api.py
+
+
+import json
+import os
+from datetime import datetime
+from unittest import TestCase
+
+from models import db, Message, User, Likes, Follows
+
+# BEFORE we import our app, let's set an environmental variable
+# to use a different database for tests (we need to do this
+# before we import our app, since that will have already
+# connected to the database
+
+os.environ['DATABASE_URL'] = "postgresql:///warbler-test"
+
+
+# Now we can import app
+
+from app import app, CURR_USER_KEY
+import timeline
+
+db.create_all()
+
+app.config['WTF_CSRF_ENABLED'] = False
+
+
+class APITestCase(TestCase):
+    """Test the JSON API."""
+
+    def setUp(self):
+        """Create a user following two others, with a few messages each."""
+
+        Likes.query.delete()
+        Follows.query.delete()
+        Message.query.delete()
+        User.query.delete()
+
+        users = [User(id=i, username=f"user{i}", email=f"user{i}@test.com",
+                      password="HASHED_PASSWORD")
+                 for i in range(1, 5)]
+        db.session.add_all(users)
+        db.session.commit()
+
+        db.session.add_all([Follows(user_being_followed_id=2, user_following_id=1),
+                            Follows(user_being_followed_id=3, user_following_id=1),
+                            Follows(user_being_followed_id=1, user_following_id=4)])
+        db.session.add_all([Message(id=author * 10 + n, text=f"{author}:{n}",
+                                    timestamp=datetime(2020, 1, n, author),
+                                    user_id=author)
+                            for author in range(1, 5) for n in range(1, 4)])
+        db.session.commit()
+
+        self.client = app.test_client()
+        with self.client.session_transaction() as sess:
+            sess[CURR_USER_KEY] = 1
+
+    def get_json(self, url):
+        resp = self.client.get(url)
+        self.assertEqual(resp.status_code, 200, resp.get_data(as_text=True))
+        self.assertEqual(resp.mimetype, 'application/json')
+        return json.loads(resp.get_data(as_text=True))
+
+    def test_timeline_pages(self):
+        """Does the timeline page through everyone followed, newest first?"""
+
+        ids = []
+        url = "/api/v1/timeline?limit=4"
+        while url:
+            page = self.get_json(url)
+            self.assertLessEqual(len(page['items']), 4)
+            ids += [item['id'] for item in page['items']]
+            url = page['next'] and f"/api/v1/timeline?limit=4&cursor={page['next']}"
+
+        self.assertEqual(ids, [33, 23, 13, 32, 22, 12, 31, 21, 11])
+
+    def test_timeline_leaves_out_deleted_accounts(self):
+        """Are a deleted account's messages gone from the timeline at once?"""
+
+        User.query.get(3).deleted_at = datetime.utcnow()
+        db.session.commit()
+
+        for materialized in (False, True):
+            with self.subTest(materialized=materialized):
+                self.addCleanup(app.config.__setitem__, 'MATERIALIZED_TIMELINES',
+                                app.config['MATERIALIZED_TIMELINES'])
+                app.config['MATERIALIZED_TIMELINES'] = materialized
+                if materialized:
+                    with app.app_context():
+                        timeline.rebuild_timelines()
+
+                page = self.get_json("/api/v1/timeline?fields=id")
+                self.assertEqual([item['id'] for item in page['items']],
+                                 [23, 13, 22, 12, 21, 11])
+
+    def test_fields(self):
+        """Are only the requested fields returned, with author fields nested?"""
+
+        page = self.get_json("/api/v1/users/2/messages?fields=text,user.username&limit=1")
+        self.assertEqual(page['items'], [{"text": "2:3", "user": {"username": "user2"}}])
+
+        resp = self.client.get("/api/v1/users/2/messages?fields=text,password")
+        self.assertEqual(resp.status_code, 400)
+        self.assertIn("password", resp.get_json()['error'])
+
+    def test_follow_lists(self):
+        """Do follower and following lists page by user id?"""
+
+        page = self.get_json("/api/v1/users/1/following?limit=1&fields=id")
+        self.assertEqual(page, {"items": [{"id": 2}], "next": "2"})
+        page = self.get_json("/api/v1/users/1/following?limit=1&fields=id&cursor=2")
+        self.assertEqual(page, {"items": [{"id": 3}], "next": None})
+
+        page = self.get_json("/api/v1/users/1/followers")
+        self.assertEqual([item['username'] for item in page['items']], ["user4"])
+
+    def test_profile(self):
+        """Does a profile show public fields and counters only?"""
+
+        profile = self.get_json("/api/v1/users/1")
+        self.assertEqual(profile['username'], "user1")
+        self.assertEqual(profile['following_count'], 2)
+        self.assertNotIn('password', profile)
+        self.assertNotIn('email', profile)
+
+    def test_errors(self):
+        """Are errors JSON, and is a login required?"""
+
+        self.assertEqual(self.client.get("/api/v1/users/99").status_code, 404)
+        self.assertEqual(self.client.get("/api/v1/timeline?limit=0").status_code, 400)
+        self.assertEqual(self.client.get("/api/v1/timeline?cursor=nonsense").status_code, 400)
+
+        with self.client.session_transaction() as sess:
+            del sess[CURR_USER_KEY]
+        resp = self.client.get("/api/v1/timeline")
+        self.assertEqual(resp.status_code, 401)
+        self.assertIn('error', resp.get_json())
@@ -0,0 +1,123 @@
+"""Direct message tests."""
+
+# run these tests like:
+#
+#    FLASK_ENV=production python -m unittest test_dms.py
+
+
+import os
+from unittest import TestCase
+
+from models import db, User, Conversation, ConversationMember, DirectMessage
+
+# BEFORE we import our app, let's set an environmental variable
+# to use a different database for tests (we need to do this
+# before we import our app, since that will have already
+# connected to the database
+
+os.environ['DATABASE_URL'] = "postgresql:///warbler-test"
+
+
+# Now we can import app
+
+from app import app, CURR_USER_KEY
+import counters
+from querystats import QueryBudgetMixin
+
+db.create_all()
+
+app.config['WTF_CSRF_ENABLED'] = False
+
+
+class DirectMessageTestCase(QueryBudgetMixin, TestCase):
+    """Test sending, listing and reading direct messages."""
+
+    def setUp(self):
+        """Create three users and a test client."""
+
+        DirectMessage.query.delete()
+        ConversationMember.query.delete()
+        Conversation.query.delete()
+        User.query.delete()
+
+        users = [User(id=i, username=f"user{i}", email=f"user{i}@test.com",
+                      password="HASHED_PASSWORD")
+                 for i in range(1, 4)]
+        db.session.add_all(users)
+        db.session.commit()
+
+        self.client = app.test_client()
+
+    def login(self, user_id):
+        with self.client.session_transaction() as sess:
+            sess[CURR_USER_KEY] = user_id
+
+    def send(self, author_id, recipient_id, text):
+        self.login(author_id)
+        resp = self.client.post(f"/dm/{recipient_id}/new", data={"text": text})
+        self.assertEqual(resp.status_code, 302)
+
+    def test_send_and_read(self):
+        """Do sends count as unread, in one conversation, until it is read?"""
+
+        self.send(1, 2, "Hello")
+        self.send(1, 2, "Are you there?")
+        self.send(2, 1, "Yes")
+
+        self.assertEqual(Conversation.query.count(), 1)
+        self.assertEqual(User.query.get(2).unread_dm_count, 2)
+        self.assertEqual(User.query.get(1).unread_dm_count, 1)
+
+        self.login(2)
+        resp = self.client.get("/users/inbox")
+        html = resp.get_data(as_text=True)
+        self.assertIn("@user1", html)
+        self.assertIn("Yes", html)
+        self.assertNotIn("Hello", html)
+
+        resp = self.client.get("/dm/1")
+        html = resp.get_data(as_text=True)
+        self.assertIn("Hello", html)
+        self.assertLess(html.index("Yes"), html.index("Hello"))
+
+        db.session.remove()
+        self.assertEqual(User.query.get(2).unread_dm_count, 0)
+        self.assertEqual(User.query.get(1).unread_dm_count, 1)
+        self.assertEqual(ConversationMember.query.filter_by(user_id=2).one().unread_count, 0)
+
+    def test_inbox_latest_first(self):
+        """Is the inbox ordered by latest message, in a fixed number of queries?"""
+
+        self.send(2, 1, "From two")
+        self.send(3, 1, "From three")
+        self.send(2, 1, "Two again")
+
+        self.login(1)
+        with self.assertQueryBudget(5):
+            html = self.client.get("/users/inbox").get_data(as_text=True)
+        self.assertLess(html.index("Two again"), html.index("From three"))
+        self.assertNotIn("From two", html)
+
+        html = self.client.get("/users/outbox").get_data(as_text=True)
+        self.assertNotIn("From", html)
+        self.login(2)
+        html = self.client.get("/users/outbox").get_data(as_text=True)
+        self.assertIn("Two again", html)
+        self.assertIn("From two", html)
+
+    def test_unread_counts_repaired(self):
+        """Do deleting a sender and reconciling keep unread counts right?"""
+
+        self.send(2, 1, "Hello")
+        self.send(3, 1, "Hello")
+        self.assertEqual(User.query.get(1).unread_dm_count, 2)
+
+        db.session.delete(User.query.get(3))
+        db.session.commit()
+        self.assertEqual(User.query.get(1).unread_dm_count, 1)
+
+        User.query.get(1).unread_dm_count = 5
+        db.session.commit()
+        with app.app_context():
+            counters.reconcile_counters()
+        self.assertEqual(User.query.get(1).unread_dm_count, 1)
@@ -0,0 +1,46 @@
+"""Synthetic data generator tests."""
+
+# run these tests like:
+#
+#    python -m unittest test_generator.py
+
+
+import filecmp
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+from unittest import TestCase
+
+SCRIPT = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                      'generator', 'create_csvs.py')
+
+
+class GeneratorTestCase(TestCase):
+    """Test that the generated CSVs depend only on the options and seed."""
+
+    def generate(self, workers, tz):
+        out = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, out)
+        subprocess.run([sys.executable, SCRIPT, '--users', '50', '--messages', '200',
+                        '--follows', '300', '--shard-size', '7', '--seed', 'test',
+                        '--workers', str(workers), '--out', out],
+                       check=True, stdout=subprocess.DEVNULL,
+                       env=dict(os.environ, TZ=tz))
+        return out
+
+    def test_same_seed_same_files(self):
+        """Do runs with different worker counts, in different time zones,
+        write byte-identical files?"""
+
+        one = self.generate(1, 'UTC')
+        several = self.generate(4, 'America/New_York')
+
+        for name in ('users.csv', 'messages.csv', 'follows.csv'):
+            with self.subTest(name=name):
+                self.assertTrue(filecmp.cmp(os.path.join(one, name),
+                                            os.path.join(several, name),
+                                            shallow=False))
+        self.assertEqual(sorted(os.listdir(several)),
+                         ['follows.csv', 'messages.csv', 'users.csv'])
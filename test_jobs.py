@@ -0,0 +1,135 @@
+"""Background job tests."""
+
+# run these tests like:
+#
+#    FLASK_ENV=production python -m unittest test_jobs.py
+
+
+import os
+from datetime import datetime, timedelta
+from unittest import TestCase
+
+from models import db, Job, Message, User, Follows, TimelineEntry
+
+# BEFORE we import our app, let's set an environmental variable
+# to use a different database for tests (we need to do this
+# before we import our app, since that will have already
+# connected to the database
+
+os.environ['DATABASE_URL'] = "postgresql:///warbler-test"
+
+
+# Now we can import app
+
+from app import app, CURR_USER_KEY
+import jobs
+from testing import make_users, override_config
+
+db.create_all()
+
+app.config['WTF_CSRF_ENABLED'] = False
+
+calls = []
+
+
+@jobs.handler('test.record')
+def record(value):
+    calls.append(value)
+
+
+@jobs.handler('test.flaky')
+def flaky(fail_times):
+    calls.append('attempt')
+    if len(calls) <= fail_times:
+        raise RuntimeError("not yet")
+
+
+class JobTestCase(TestCase):
+    """Test queueing, running and retrying jobs, without worker threads."""
+
+    def setUp(self):
+        Job.query.delete()
+        TimelineEntry.query.delete()
+        Message.query.delete()
+        Follows.query.delete()
+        User.query.delete()
+        db.session.commit()
+        calls.clear()
+
+        override_config(self, app, JOBS_INLINE=False, JOB_WORKERS=0)
+
+    def enqueue(self, kind, **kwargs):
+        with app.app_context():
+            jobs.enqueue(kind, **kwargs)
+            db.session.commit()
+
+    def run_pending(self):
+        with app.app_context():
+            return jobs.run_pending()
+
+    def test_run_once_per_key(self):
+        """Are keyed jobs enqueued once, and run after the enqueuer commits?"""
+
+        self.enqueue('test.record', key="once", value=1)
+        self.enqueue('test.record', key="once", value=2)
+        self.enqueue('test.record', value=3)
+        self.assertEqual(calls, [])
+
+        self.assertEqual(self.run_pending(), 2)
+        self.assertEqual(calls, [1, 3])
+        self.assertEqual({job.status for job in Job.query}, {'done'})
+        self.assertEqual(self.run_pending(), 0)
+
+    def test_retry_with_backoff(self):
+        """Is a failing job retried later, and failed after its attempts?"""
+
+        self.enqueue('test.flaky', max_attempts=2, fail_times=5)
+        self.assertEqual(self.run_pending(), 1)
+
+        job = Job.query.one()
+        self.assertEqual((job.status, job.attempts), ('queued', 1))
+        self.assertGreater(job.run_at, datetime.utcnow())
+        self.assertIn("not yet", job.last_error)
+        self.assertEqual(self.run_pending(), 0)
+
+        Job.query.update({'run_at': datetime.utcnow()})
+        db.session.commit()
+        self.assertEqual(self.run_pending(), 1)
+        job = Job.query.one()
+        self.assertEqual((job.status, job.attempts), ('failed', 2))
+
+    def test_stale_job_reclaimed(self):
+        """Is a job whose worker died claimed again after JOB_TIMEOUT?"""
+
+        self.enqueue('test.record', value=1)
+        job = Job.query.one()
+        job.status = 'running'
+        job.attempts = 1
+        job.locked_at = datetime.utcnow() - timedelta(seconds=app.config['JOB_TIMEOUT'] + 1)
+        db.session.commit()
+
+        self.assertEqual(self.run_pending(), 1)
+        job = Job.query.one()
+        self.assertEqual((job.status, job.attempts, calls), ('done', 2, [1]))
+
+    def test_route_defers_fan_out(self):
+        """Does posting a message return before fan-out, which a job then does?"""
+
+        override_config(self, app, MATERIALIZED_TIMELINES=True)
+        make_users([1, 2])
+        db.session.add(Follows(user_being_followed_id=1, user_following_id=2))
+        db.session.commit()
+
+        client = app.test_client()
+        with client.session_transaction() as sess:
+            sess[CURR_USER_KEY] = 1
+        resp = client.post("/messages/new", data={"text": "Deferred"})
+        self.assertEqual(resp.status_code, 302)
+
+        self.assertEqual(TimelineEntry.query.count(), 0)
+        with app.app_context():
+            stats = jobs.stats()
+        self.assertEqual(stats['queued'], 1)
+
+        self.assertEqual(self.run_pending(), 1)
+        self.assertEqual(sorted(entry.user_id for entry in TimelineEntry.query), [1, 2])
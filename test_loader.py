@@ -0,0 +1,102 @@
+"""Bulk loader tests."""
+
+# run these tests like:
+#
+#    python -m unittest test_loader.py
+
+
+import csv
+import os
+import shutil
+import tempfile
+from unittest import TestCase
+
+from models import db, User, Message, Follows
+
+# BEFORE we import our app, let's set an environmental variable
+# to use a different database for tests (we need to do this
+# before we import our app, since that will have already
+# connected to the database
+
+os.environ['DATABASE_URL'] = "postgresql:///warbler-test"
+
+
+# Now we can import app
+
+from app import app
+import loader
+
+db.create_all()
+
+
+class LoaderTestCase(TestCase):
+    """Test loading CSVs in chunks."""
+
+    def setUp(self):
+        """Make a directory of small CSVs to load."""
+
+        db.session.remove()
+        self.source = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.source)
+
+        self.write_csv('users', ['email', 'username', 'password'],
+                       [[f"{name}@test.com", name, "HASHED_PASSWORD"]
+                        for name in ("ann", "bob", "cat")])
+        self.write_csv('follows', ['user_being_followed_id', 'user_following_id'],
+                       [[1, 2], [1, 3]])
+        self.write_csv('messages', ['text', 'timestamp', 'user_id'],
+                       [[f"Message {i}", f"2019-01-0{i} 10:00:00", i % 3 + 1]
+                        for i in range(1, 6)])
+
+    def write_csv(self, table, columns, rows):
+        with open(os.path.join(self.source, f"{table}.csv"), 'w', newline='') as f:
+            writer = csv.writer(f)
+            writer.writerow(columns)
+            writer.writerows(rows)
+
+    def load(self, **kwargs):
+        with app.app_context():
+            return loader.load(self.source, chunk_size=2, echo=lambda line: None,
+                               **kwargs)
+
+    def test_load(self):
+        """Are rows numbered, counters set and constraints restored?"""
+
+        loaded = self.load()
+        self.assertEqual(loaded, {'users': 3, 'follows': 2, 'messages': 5})
+
+        ann = User.query.filter_by(username="ann").one()
+        self.assertEqual(ann.id, 1)
+        self.assertEqual(ann.followers_count, 2)
+        self.assertEqual(ann.messages_count, 1)
+        self.assertEqual(Message.query.count(), 5)
+
+        # ids carry on after the loaded ones; unique constraints are back
+        u = User.signup("dan", "dan@test.com", "password", None)
+        db.session.commit()
+        self.assertEqual(u.id, 4)
+        db.session.add(User(email="ann@test.com", username="ann2", password="x"))
+        with self.assertRaises(Exception):
+            db.session.commit()
+        db.session.rollback()
+
+    def test_resume(self):
+        """Does a failed load pick up after its last committed chunk?"""
+
+        rows = [[f"Message {i}", f"2019-01-0{i} 10:00:00", 1] for i in range(1, 6)]
+        rows[3][2] = "not a user id"
+        self.write_csv('messages', ['text', 'timestamp', 'user_id'], rows)
+
+        with self.assertRaises(Exception):
+            self.load(jobs=1)
+        db.session.remove()
+        self.assertEqual(Message.query.count(), 2)
+
+        rows[3][2] = 1
+        self.write_csv('messages', ['text', 'timestamp', 'user_id'], rows)
+        loaded = self.load(resume=True)
+
+        self.assertEqual(loaded['messages'], 5)
+        self.assertEqual(sorted(m.id for m in Message.query), [1, 2, 3, 4, 5])
+        self.assertEqual(Follows.query.count(), 2)
+        self.assertEqual(User.query.get(1).messages_count, 5)
@@ -0,0 +1,72 @@
+"""Load test script tests."""
+
+# run these tests like:
+#
+#    python -m unittest test_loadtest.py
+
+
+from unittest import TestCase
+
+from benchmarks.loadtest import percentile, regressions, summarize
+
+
+def run(throughput, **p95s):
+    """Summary of a run with the given throughput and per-route p95s."""
+
+    return {'throughput': throughput,
+            'routes': {name: {'p95_ms': p95} for name, p95 in p95s.items()}}
+
+
+class LoadTestTestCase(TestCase):
+    """Test the latency statistics and the comparison with a baseline."""
+
+    def test_percentile(self):
+        """Is the nearest-rank percentile an actual sample, at the right rank?"""
+
+        ordered = [10, 20, 30, 40]
+        self.assertEqual(percentile(ordered, 0.50), 20)
+        self.assertEqual(percentile(ordered, 0.51), 30)
+        self.assertEqual(percentile(ordered, 0.99), 40)
+        self.assertEqual(percentile(ordered, 1.0), 40)
+        self.assertEqual(percentile(ordered, 0), 10)
+        self.assertEqual(percentile(list(range(1, 101)), 0.95), 95)
+        self.assertEqual(percentile([7], 0.5), 7)
+        self.assertIsNone(percentile([], 0.5))
+
+    def test_summarize(self):
+        """Are latencies summarized per route, in milliseconds?"""
+
+        results = {'latencies': {'homepage': [0.3, 0.1, 0.2, 0.4]},
+                   'errors': {'homepage': 1}}
+        summary = summarize(results, elapsed=2)
+
+        route = summary['routes']['homepage']
+        self.assertEqual((summary['requests'], summary['errors']), (4, 1))
+        self.assertEqual(summary['throughput'], 2)
+        self.assertEqual(route['error_rate'], 0.25)
+        self.assertAlmostEqual(route['p50_ms'], 200)
+        self.assertAlmostEqual(route['p99_ms'], 400)
+
+    def test_regressions(self):
+        """Are only changes for the worse beyond the tolerance regressions?"""
+
+        baseline = run(100, homepage=50, add_like=20, users_show=30)
+
+        self.assertEqual(regressions(run(95, homepage=54, add_like=10, users_show=30),
+                                     baseline, 0.10), {})
+
+        worse = regressions(run(80, homepage=60, add_like=20, users_show=30),
+                            baseline, 0.10)
+        self.assertEqual(set(worse), {'p95 homepage', 'throughput'})
+        self.assertAlmostEqual(worse['p95 homepage'], 0.2)
+        self.assertAlmostEqual(worse['throughput'], -0.2)
+
+        self.assertEqual(set(regressions(run(100, homepage=54), baseline, 0.05)),
+                         {'p95 homepage'})
+
+    def test_regressions_new_routes(self):
+        """Are routes only in one run, and empty baselines, left alone?"""
+
+        self.assertEqual(regressions(run(100, messages_add=500), run(100, homepage=50), 0.1), {})
+        self.assertEqual(regressions(run(100, homepage=50), run(0, homepage=0), 0.1), {})
+        self.assertEqual(regressions(run(100, homepage=50), {}, 0.1), {})
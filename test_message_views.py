@@ -8,6 +8,9 @@
 import os
 from unittest import TestCase
 
+from sqlalchemy import event, exc
+from sqlalchemy.engine import Engine
+
 from models import db, connect_db, Message, User
 
 # BEFORE we import our app, let's set an environmental variable
@@ -21,6 +24,8 @@ os.environ['DATABASE_URL'] = "postgresql:///warbler-test"
 # Now we can import app
 
 from app import app, CURR_USER_KEY
+import querystats
+from querystats import QueryBudgetMixin, fingerprint
 
 # Create our tables (we do this here, so we only create the tables
 # once for all tests --- in each test, we'll delete the data
@@ -33,7 +38,7 @@ db.create_all()
 app.config['WTF_CSRF_ENABLED'] = False
 
 
-class MessageViewTestCase(TestCase):
+class MessageViewTestCase(QueryBudgetMixin, TestCase):
     """Test views for messages."""
 
     def setUp(self):
@@ -169,6 +174,31 @@ class MessageViewTestCase(TestCase):
             self.assertNotIn('Delete', html)
             self.assertIn(f'<a href=/users/{new_user.id}>@{new_user.username}</a>', html)
 
+    def test_show_message_not_modified(self):
+        """Is an unchanged message answered 304, until its author changes?"""
+
+        new_message = Message(text='Hello', user_id=self.testuser.id)
+        db.session.add(new_message)
+        db.session.commit()
+        message_id = new_message.id
+
+        with self.client as c:
+            resp = c.get(f'/messages/{message_id}')
+            self.assertEqual(resp.status_code, 200)
+            etag = resp.headers['ETag']
+
+            with self.assertQueryBudget(2):
+                resp = c.get(f'/messages/{message_id}', headers={'If-None-Match': etag})
+            self.assertEqual(resp.status_code, 304)
+
+            user = User.query.get(self.testuser.id)
+            user.username = 'renamed'
+            db.session.commit()
+
+            resp = c.get(f'/messages/{message_id}', headers={'If-None-Match': etag})
+            self.assertEqual(resp.status_code, 200)
+            self.assertIn('@renamed', resp.get_data(as_text=True))
+
     def test_show_invalid_message(self):
         """Does message show route display correct info an invalid message id?"""
         with self.client as c:
@@ -228,3 +258,62 @@ class MessageViewTestCase(TestCase):
             self.assertIn('Access Denied', html)
             msgs = Message.query.all()
             self.assertEqual(len(msgs), 1)
+
+    def test_search_messages(self):
+        """Does message search return matching messages, ranked and paged?"""
+
+        db.session.add_all([
+            Message(text='Warbling about birds', user_id=self.testuser.id),
+            Message(text='Nothing to see here', user_id=self.testuser.id),
+        ])
+        db.session.commit()
+
+        with self.client as c:
+            resp = c.get('/messages/search?q=birds')
+            html = resp.get_data(as_text=True)
+            self.assertEqual(resp.status_code, 200)
+            self.assertIn('Warbling about birds', html)
+            self.assertNotIn('Nothing to see here', html)
+
+            resp = c.get('/messages/search?q=birds&page=1000')
+            self.assertEqual(resp.status_code, 400)
+
+    def test_add_message_query_budget(self):
+        """Does posting a message run a fixed number of queries?"""
+
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.testuser.id
+
+            # the identity, the insert and the author's counters: the
+            # full User row and its messages aren't loaded
+            with self.assertQueryBudget(3):
+                resp = c.post("/messages/new", data={"text": "Hello"})
+                self.assertEqual(resp.status_code, 302)
+
+    def test_query_fingerprints(self):
+        """Are repeats of a statement recognized whatever its IN list?"""
+
+        self.assertEqual(fingerprint("SELECT *\n  FROM users WHERE id IN (%(id_1)s, %(id_2)s)"),
+                         "SELECT * FROM users WHERE id IN (...)")
+
+        with self.assertRaises(AssertionError):
+            with self.assertQueryBudget(10, repeats=3):
+                for i in range(3):
+                    User.query.get(i)
+                    db.session.expire_all()
+
+
+    def test_query_recording_scope(self):
+        """Does a statement that raises leave recording working, and are
+        the engine events only listened for while recording?"""
+
+        with self.assertQueryBudget(2, repeats=None) as stats:
+            with self.assertRaises(exc.ProgrammingError):
+                db.session.execute("SELECT * FROM no_such_table")
+            db.session.rollback()
+            db.session.execute("SELECT 1")
+        self.assertEqual(stats.count, 1)
+
+        self.assertFalse(event.contains(Engine, 'before_cursor_execute',
+                                        querystats.statement_started))
@@ -0,0 +1,158 @@
+"""Schema migration and query plan tests."""
+
+# run these tests like:
+#
+#    python -m unittest test_migrations.py
+
+
+import os
+from unittest import TestCase
+
+from sqlalchemy import inspect, text
+
+from models import db, User, Message, Follows, Likes
+
+# BEFORE we import our app, let's set an environmental variable
+# to use a different database for tests (we need to do this
+# before we import our app, since that will have already
+# connected to the database
+
+os.environ['DATABASE_URL'] = "postgresql:///warbler-test"
+
+
+# Now we can import app
+
+from app import app, CURR_USER_KEY
+import explain
+import fragments
+import identity
+import migrations
+
+db.create_all()
+
+# The schema as it was before migrations, created by the first models.py.
+LEGACY_SCHEMA = [
+    """CREATE TABLE users (
+        id SERIAL PRIMARY KEY,
+        email TEXT NOT NULL UNIQUE,
+        username TEXT NOT NULL UNIQUE,
+        image_url TEXT,
+        header_image_url TEXT,
+        bio TEXT,
+        location TEXT,
+        password TEXT NOT NULL)""",
+    """CREATE TABLE messages (
+        id SERIAL PRIMARY KEY,
+        text VARCHAR(140) NOT NULL,
+        timestamp TIMESTAMP NOT NULL,
+        user_id INTEGER NOT NULL REFERENCES users ON DELETE CASCADE)""",
+    """CREATE TABLE follows (
+        user_being_followed_id INTEGER REFERENCES users ON DELETE CASCADE,
+        user_following_id INTEGER REFERENCES users ON DELETE CASCADE,
+        PRIMARY KEY (user_being_followed_id, user_following_id))""",
+    """CREATE TABLE likes (
+        id SERIAL PRIMARY KEY,
+        user_id INTEGER REFERENCES users ON DELETE CASCADE,
+        message_id INTEGER UNIQUE REFERENCES messages ON DELETE CASCADE)""",
+]
+
+
+def quiet(line):
+    pass
+
+
+class MigrationTestCase(TestCase):
+    """Test upgrading old and new databases, and the routes' query plans."""
+
+    def setUp(self):
+        db.session.remove()
+        with app.app_context():
+            db.drop_all()
+            migrations.version_metadata.drop_all(db.engine)
+        self.addCleanup(self.restore_schema)
+
+    def restore_schema(self):
+        db.session.remove()
+        with app.app_context():
+            db.drop_all()
+            migrations.version_metadata.drop_all(db.engine)
+            migrations.upgrade(db.engine, echo=quiet)
+        # ids start over in the recreated tables
+        fragments.fragments.clear()
+        identity.identities.clear()
+
+    def test_upgrade_legacy_database(self):
+        """Does a database from before migrations get every change, once?"""
+
+        with app.app_context(), db.engine.begin() as connection:
+            for statement in LEGACY_SCHEMA:
+                connection.execute(text(statement))
+            connection.execute(text(
+                "INSERT INTO users (email, username, password) VALUES "
+                "('a@test.com', 'a', 'x'), ('b@test.com', 'b', 'x')"))
+            connection.execute(text(
+                "INSERT INTO messages (text, timestamp, user_id) VALUES "
+                "('Hello', now(), 1), ('Again', now(), 1)"))
+            connection.execute(text("INSERT INTO follows VALUES (1, 2)"))
+            connection.execute(text(
+                "INSERT INTO likes (user_id, message_id) VALUES (2, 1), (2, 2)"))
+
+        with app.app_context():
+            applied = migrations.upgrade(db.engine, echo=quiet)
+            self.assertEqual(applied, list(range(1, migrations.latest_version() + 1)))
+
+            with db.engine.connect() as connection:
+                self.assertEqual(migrations.current_version(connection),
+                                 migrations.latest_version())
+            self.assertEqual(migrations.upgrade(db.engine, echo=quiet), [])
+
+            found = inspect(db.engine)
+            self.assertIn('ix_messages_user_timestamp',
+                          {index['name'] for index in found.get_indexes('messages')})
+            self.assertIn('ix_follows_following',
+                          {index['name'] for index in found.get_indexes('follows')})
+            self.assertIn('direct_messages', found.get_table_names())
+
+        self.assertEqual(Likes.query.count(), 2)
+        a, b = User.query.order_by(User.id).all()
+        self.assertEqual((a.messages_count, a.followers_count, a.likes_received_count),
+                         (2, 1, 2))
+        self.assertEqual((b.following_count, b.likes_count, b.version), (1, 2, 1))
+
+        # a message liked before can be liked by someone else, once
+        with app.app_context():
+            self.assertTrue(Likes.add(1, 1))
+            self.assertFalse(Likes.add(1, 1))
+            db.session.commit()
+        self.assertEqual(Likes.query.filter_by(message_id=1).count(), 2)
+
+    def test_new_database_stamped(self):
+        """Is a new database created from the models at the latest version?"""
+
+        with app.app_context():
+            self.assertEqual(migrations.upgrade(db.engine, echo=quiet), [])
+            with db.engine.connect() as connection:
+                self.assertEqual(migrations.current_version(connection),
+                                 migrations.latest_version())
+            self.assertIn('timeline_entries', inspect(db.engine).get_table_names())
+
+    def test_routes_use_indexes(self):
+        """Is every hot route's SQL served without sequential scans?"""
+
+        with app.app_context():
+            migrations.upgrade(db.engine, echo=quiet)
+            db.session.add_all([User(id=i, username=f"user{i}", email=f"user{i}@test.com",
+                                     password="HASHED_PASSWORD")
+                                for i in range(1, 4)])
+            db.session.commit()
+            db.session.add_all([Follows(user_being_followed_id=1, user_following_id=2),
+                                Follows(user_being_followed_id=3, user_following_id=1),
+                                Message(text="Hello", user_id=1),
+                                Message(text="Hi", user_id=3)])
+            db.session.commit()
+            db.session.add(Likes(user_id=1, message_id=Message.query.filter_by(user_id=3).one().id))
+            db.session.commit()
+
+        problems = explain.check_routes(app, CURR_USER_KEY, min_rows=0)
+        self.assertEqual(problems, [], "\n".join(f"{route}: {table}\n{statement}"
+                                                 for route, table, statement in problems))
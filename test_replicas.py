@@ -0,0 +1,113 @@
+"""Read replica routing tests."""
+
+# run these tests like:
+#
+#    FLASK_ENV=production python -m unittest test_replicas.py
+
+
+import os
+import shutil
+import tempfile
+from unittest import TestCase
+
+from sqlalchemy import create_engine
+
+from models import db, User, Message, Follows, Likes
+
+# BEFORE we import our app, let's set an environmental variable
+# to use a different database for tests (we need to do this
+# before we import our app, since that will have already
+# connected to the database
+
+os.environ['DATABASE_URL'] = "postgresql:///warbler-test"
+
+
+# Now we can import app
+
+from app import app, CURR_USER_KEY
+import fragments
+import identity
+
+db.create_all()
+
+app.config['WTF_CSRF_ENABLED'] = False
+
+
+class ReplicaTestCase(TestCase):
+    """Test reads going to a replica, and writes and fresh reads to the primary.
+
+    A SQLite file stands in for the replica. It holds the same users under
+    different names, so pages show which database they were read from.
+    """
+
+    def setUp(self):
+        Likes.query.delete()
+        Follows.query.delete()
+        Message.query.delete()
+        User.query.delete()
+        db.session.add_all([User(id=i, username=f"primary{i}", email=f"user{i}@test.com",
+                                 password="HASHED_PASSWORD")
+                            for i in (1, 2)])
+        db.session.commit()
+
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory)
+        uri = f"sqlite:///{directory}/replica.db"
+        replica = create_engine(uri)
+        db.metadata.create_all(replica)
+        replica.execute(User.__table__.insert(),
+                        [{'id': i, 'username': f"replica{i}", 'email': f"user{i}@test.com",
+                          'password': "HASHED_PASSWORD"}
+                         for i in (1, 2)])
+        replica.dispose()
+
+        binds = app.config['SQLALCHEMY_BINDS']
+        app.config['SQLALCHEMY_BINDS'] = {'replica-0': uri}
+        self.addCleanup(app.config.__setitem__, 'SQLALCHEMY_BINDS', binds)
+        self.addCleanup(db.session.remove)
+
+        fragments.fragments.clear()
+        identity.identities.clear()
+        self.client = app.test_client()
+
+    def test_reads_from_replica(self):
+        """Do read-only views read from the replica, and others from the primary?"""
+
+        html = self.client.get("/users").get_data(as_text=True)
+        self.assertIn("@replica2", html)
+        self.assertNotIn("primary", html)
+
+        html = self.client.get("/signup").get_data(as_text=True)
+        self.assertNotIn("replica", html)
+
+    def test_read_your_writes(self):
+        """After a write, does the same client read from the primary?"""
+
+        with self.client.session_transaction() as sess:
+            sess[CURR_USER_KEY] = 1
+        resp = self.client.post("/messages/new", data={"text": "Fresh"})
+        self.assertEqual(resp.status_code, 302)
+        self.assertEqual(Message.query.count(), 1)
+
+        html = self.client.get("/users").get_data(as_text=True)
+        self.assertIn("@primary2", html)
+        self.assertNotIn("replica", html)
+
+        with self.client.session_transaction() as sess:
+            sess['_primary_until'] = 0
+        # user cards cached from the primary would look the same on a real replica
+        fragments.fragments.clear()
+        html = self.client.get("/users").get_data(as_text=True)
+        self.assertIn("@replica2", html)
+
+    def test_pool_stats(self):
+        """Are checkouts counted for the primary and the replica?"""
+
+        self.client.get("/users")
+        app.config['EXPOSE_STATS'] = True
+        self.addCleanup(app.config.__setitem__, 'EXPOSE_STATS', False)
+
+        pools = self.client.get("/_stats").get_json()['db_pools']
+        self.assertGreater(pools['primary']['checkouts'], 0)
+        self.assertIn('wait_ms', pools['primary'])
+        self.assertIn('replica-0', pools)
@@ -0,0 +1,103 @@
+"""Who-to-follow suggestion tests."""
+
+# run these tests like:
+#
+#    FLASK_ENV=production python -m unittest test_suggestions.py
+
+
+import os
+from unittest import TestCase
+
+from models import db, User, Follows, Suggestion, SuggestionRefresh, Job
+
+# BEFORE we import our app, let's set an environmental variable
+# to use a different database for tests (we need to do this
+# before we import our app, since that will have already
+# connected to the database
+
+os.environ['DATABASE_URL'] = "postgresql:///warbler-test"
+
+
+# Now we can import app
+
+from app import app, CURR_USER_KEY
+import suggestions
+from testing import make_users, override_config
+
+db.create_all()
+
+app.config['WTF_CSRF_ENABLED'] = False
+
+# user: the users they follow
+GRAPH = {
+    1: [2, 3],
+    2: [4],
+    3: [4, 5],
+    4: [5],
+    6: [1, 5],
+}
+
+
+class SuggestionTestCase(TestCase):
+    """Test computing, refreshing and showing suggestions."""
+
+    def setUp(self):
+        for model in (Job, SuggestionRefresh, Suggestion, Follows, User):
+            model.query.delete()
+        db.session.commit()
+
+        override_config(self, app, JOBS_INLINE=True, SUGGESTIONS_PER_USER=3)
+        make_users(range(1, 8))
+        db.session.add_all([Follows(user_following_id=follower, user_being_followed_id=followed)
+                            for follower, followed_ids in GRAPH.items()
+                            for followed in followed_ids])
+        db.session.commit()
+
+    def suggested(self, user_id):
+        return [(row.suggested_id, row.mutuals) for row in
+                Suggestion.query.filter_by(user_id=user_id).order_by(Suggestion.rank)]
+
+    def test_friends_of_friends(self):
+        """Are friends of friends ranked by mutuals, then filled by popularity?"""
+
+        with app.app_context():
+            self.assertEqual(suggestions.refresh_all(echo=lambda line: None), 7)
+
+        # 4 is followed by both of user 1's follows, 5 by one; 7 has no
+        # followers but is still the most followed account 1 doesn't follow
+        self.assertEqual(self.suggested(1), [(4, 2), (5, 1), (7, 0)])
+        # user 5 follows nobody: the most followed accounts
+        self.assertEqual(self.suggested(5), [(4, 0), (1, 0), (2, 0)])
+        self.assertEqual(SuggestionRefresh.query.count(), 0)
+
+    def test_follow_refreshes_neighbourhood(self):
+        """Does a follow recompute the follower, and queue their followers?"""
+
+        with app.app_context():
+            suggestions.refresh_all(echo=lambda line: None)
+
+        client = app.test_client()
+        with client.session_transaction() as sess:
+            sess[CURR_USER_KEY] = 1
+        self.assertEqual(client.post("/users/4/follow").status_code, 200)
+
+        self.assertNotIn(4, [user_id for user_id, _ in self.suggested(1)])
+        self.assertEqual([refresh.user_id for refresh in SuggestionRefresh.query], [6])
+
+        with app.app_context():
+            self.assertEqual(suggestions.refresh_queued(echo=lambda line: None), 1)
+        self.assertEqual(SuggestionRefresh.query.count(), 0)
+        self.assertEqual(self.suggested(6)[0], (4, 1))
+
+    def test_suggestions_page(self):
+        """Does the page show the viewer's suggestions, computing them if needed?"""
+
+        client = app.test_client()
+        with client.session_transaction() as sess:
+            sess[CURR_USER_KEY] = 1
+        html = client.get("/users/suggestions").get_data(as_text=True)
+
+        self.assertLess(html.index("@user4"), html.index("@user5"))
+        self.assertNotIn("@user2", html)
+        self.assertIn('action="/users/follow/4"', html)
+        self.assertEqual(len(self.suggested(1)), 3)
@@ -0,0 +1,182 @@
+"""Materialized timeline tests."""
+
+# run these tests like:
+#
+#    FLASK_ENV=production python -m unittest test_timeline.py
+
+
+import os
+from datetime import datetime
+from unittest import TestCase
+
+from models import db, Message, User, Follows, TimelineEntry, Job
+
+# BEFORE we import our app, let's set an environmental variable
+# to use a different database for tests (we need to do this
+# before we import our app, since that will have already
+# connected to the database
+
+os.environ['DATABASE_URL'] = "postgresql:///warbler-test"
+
+
+# Now we can import app
+
+from app import app, CURR_USER_KEY
+import jobs
+import timeline
+
+db.create_all()
+
+app.config['WTF_CSRF_ENABLED'] = False
+
+# run background jobs in the request that enqueues them
+app.config['JOBS_INLINE'] = True
+
+
+class TimelineTestCase(TestCase):
+    """Test fan-out, backfill, pruning and rebuilding of home timelines."""
+
+    def setUp(self):
+        """Create test client, add sample data."""
+
+        TimelineEntry.query.delete()
+        Message.query.delete()
+        Follows.query.delete()
+        User.query.delete()
+
+        app.config['MATERIALIZED_TIMELINES'] = True
+        self.client = app.test_client()
+
+        self.reader = User.signup(username="reader", email="reader@test.com",
+                                  password="password", image_url=None)
+        self.author = User.signup(username="author", email="author@test.com",
+                                  password="password", image_url=None)
+        db.session.commit()
+        self.reader_id = self.reader.id
+        self.author_id = self.author.id
+
+        db.session.add(Follows(user_being_followed_id=self.author_id,
+                               user_following_id=self.reader_id))
+        db.session.commit()
+
+    def tearDown(self):
+        app.config['MATERIALIZED_TIMELINES'] = False
+
+    def entries_for(self, user_id):
+        return [entry.message_id for entry in
+                TimelineEntry.query.filter_by(user_id=user_id).all()]
+
+    def test_new_message_fans_out(self):
+        """Does posting a message reach the author and their followers?"""
+
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.author_id
+
+            c.post("/messages/new", data={"text": "Fanned out"})
+
+        msg = Message.query.one()
+        self.assertEqual(self.entries_for(self.author_id), [msg.id])
+        self.assertEqual(self.entries_for(self.reader_id), [msg.id])
+
+    def test_fan_out_trims(self):
+        """Does fanning out keep each timeline to its newest TIMELINE_LENGTH entries?"""
+
+        self.addCleanup(app.config.__setitem__, 'TIMELINE_LENGTH', app.config['TIMELINE_LENGTH'])
+        app.config['TIMELINE_LENGTH'] = 2
+        messages = [Message(text=f"Message {n}", user_id=self.author_id,
+                            timestamp=datetime(2020, 1, n))
+                    for n in (1, 2, 3)]
+        db.session.add_all(messages)
+        db.session.commit()
+        message_ids = [message.id for message in messages]
+
+        with app.app_context():
+            for message_id in message_ids:
+                timeline.fan_out(Message.query.get(message_id))
+            db.session.commit()
+
+        for user_id in (self.author_id, self.reader_id):
+            self.assertEqual(sorted(self.entries_for(user_id)), message_ids[1:])
+
+    def test_homepage_reads_timeline(self):
+        """Does the homepage render messages from the materialized store?"""
+
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.author_id
+            c.post("/messages/new", data={"text": "Hello from the store"})
+
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.reader_id
+            resp = c.get("/")
+
+            self.assertEqual(resp.status_code, 200)
+            self.assertIn("Hello from the store", resp.get_data(as_text=True))
+
+    def test_backfill_and_prune(self):
+        """Do follow/unfollow add and remove the followed user's messages?"""
+
+        other = User.signup(username="other", email="other@test.com",
+                            password="password", image_url=None)
+        db.session.commit()
+        other_id = other.id
+        msg = Message(text="Older message", user_id=other_id)
+        db.session.add(msg)
+        db.session.commit()
+        msg_id = msg.id
+
+        with app.app_context():
+            timeline.backfill(self.reader_id, [other_id])
+            db.session.commit()
+        self.assertEqual(self.entries_for(self.reader_id), [msg_id])
+
+        with app.app_context():
+            timeline.prune(self.reader_id, other_id)
+            db.session.commit()
+        self.assertEqual(self.entries_for(self.reader_id), [])
+
+    def test_fan_out_and_backfill_overlap(self):
+        """Do a fan-out and a backfill of the same message both succeed?"""
+
+        Job.query.delete()
+        db.session.commit()
+        for name, value in {'JOBS_INLINE': False, 'JOB_WORKERS': 0}.items():
+            self.addCleanup(app.config.__setitem__, name, app.config[name])
+            app.config[name] = value
+
+        other = User.signup(username="other", email="other@test.com",
+                            password="password", image_url=None)
+        db.session.commit()
+        other_id = other.id
+
+        # the message's fan-out is still queued when the reader follows
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = other_id
+            c.post("/messages/new", data={"text": "Posted, then followed"})
+
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.reader_id
+            c.post(f"/users/{other_id}/follow")
+
+        with app.app_context():
+            jobs.run_pending()
+        self.assertEqual({job.status for job in Job.query}, {'done'})
+        self.assertEqual(self.entries_for(self.reader_id), [Message.query.one().id])
+
+    def test_rebuild_timelines(self):
+        """Does a rebuild recompute timelines from follows and messages?"""
+
+        msg = Message(text="Written before the store existed",
+                      user_id=self.author_id)
+        db.session.add(msg)
+        db.session.commit()
+        msg_id = msg.id
+
+        with app.app_context():
+            count = timeline.rebuild_timelines()
+
+        self.assertEqual(count, 2)
+        self.assertEqual(self.entries_for(self.reader_id), [msg_id])
+        self.assertEqual(self.entries_for(self.author_id), [msg_id])
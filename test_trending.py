@@ -0,0 +1,215 @@
+"""Trending messages tests."""
+
+# run these tests like:
+#
+#    FLASK_ENV=production python -m unittest test_trending.py
+
+
+import os
+from datetime import datetime, timedelta
+from unittest import TestCase
+
+from models import db, User, Message, Likes, Job, TrendingMessage, TrendingCheckpoint
+
+# BEFORE we import our app, let's set an environmental variable
+# to use a different database for tests (we need to do this
+# before we import our app, since that will have already
+# connected to the database
+
+os.environ['DATABASE_URL'] = "postgresql:///warbler-test"
+
+
+# Now we can import app
+
+from app import app, CURR_USER_KEY
+import fragments
+import identity
+import jobs
+import trending
+from testing import make_users, override_config
+
+db.create_all()
+
+app.config['WTF_CSRF_ENABLED'] = False
+
+HOUR = timedelta(hours=1)
+
+
+class TrendingTestCase(TestCase):
+    """Test scoring, decaying, checkpointing and showing trending messages."""
+
+    def setUp(self):
+        for model in (Job, TrendingMessage, TrendingCheckpoint, Likes, Message, User):
+            model.query.delete()
+        db.session.commit()
+        fragments.fragments.clear()
+        identity.identities.clear()
+        trending.top.clear()
+
+        override_config(self, app, JOBS_INLINE=True, TRENDING_HALF_LIFE=3600,
+                        TRENDING_CHECKPOINT_INTERVAL=3600, TRENDING_WINDOW=86400)
+        make_users(range(1, 5))
+        db.session.add_all([Message(id=i, text=f"Message {i}", user_id=1) for i in (1, 2, 3)])
+        db.session.commit()
+
+        self.client = app.test_client()
+
+    def like(self, user_id, message_id, action="like"):
+        with self.client.session_transaction() as sess:
+            sess[CURR_USER_KEY] = user_id
+        resp = self.client.post(f"/messages/{message_id}/{action}")
+        self.assertEqual(resp.json["type"], "success")
+
+    def scores(self):
+        return {row.message_id: row.score for row in TrendingMessage.query}
+
+    def age_epoch(self, by):
+        checkpoint = TrendingCheckpoint.query.get(1)
+        checkpoint.epoch -= by
+        db.session.commit()
+
+    def rewind(self, by):
+        """As if everything so far happened `by` earlier."""
+
+        self.age_epoch(by)
+        for model in (Message, Likes, TrendingMessage):
+            model.query.update({model.timestamp: model.timestamp - by},
+                               synchronize_session=False)
+        db.session.commit()
+
+    def test_recent_likes_outweigh_old(self):
+        """Does a like two half-lives later count four times as much, with
+        the epoch then moved up to now?"""
+
+        for user_id in (2, 3, 4):
+            self.like(user_id, 1)
+        self.assertAlmostEqual(self.scores()[1], 3, places=2)
+
+        self.rewind(2 * HOUR)
+        self.like(2, 2)
+
+        scores = self.scores()
+        self.assertAlmostEqual(scores[1], 0.75, places=2)
+        self.assertAlmostEqual(scores[2], 1, places=2)
+        self.assertLess(datetime.utcnow() - TrendingCheckpoint.query.get(1).epoch,
+                        timedelta(minutes=1))
+        with app.test_request_context():
+            self.assertEqual(trending.top_ids(), [2, 1])
+
+    def test_unlike(self):
+        """Does an unlike take off what its like added, however old?"""
+
+        self.like(2, 1)
+        self.like(3, 1)
+        self.rewind(2 * HOUR)
+        self.like(4, 1)
+        self.assertAlmostEqual(self.scores()[1], 1.5, places=2)
+
+        self.like(2, 1, "unlike")
+        self.assertAlmostEqual(self.scores()[1], 1.25, places=2)
+        self.like(4, 1, "unlike")
+        self.assertAlmostEqual(self.scores()[1], 0.25, places=2)
+        self.like(3, 1, "unlike")
+        self.assertAlmostEqual(self.scores()[1], 0, places=6)
+
+    def test_unlike_before_like(self):
+        """Do a like and its unlike cancel out if the unlike's job runs first?"""
+
+        self.like(2, 1)
+        liked_at = datetime.utcnow().isoformat()
+        with app.app_context():
+            trending.record(1, sign=-1, liked_at=liked_at)
+            trending.record(1, liked_at=liked_at)
+            db.session.commit()
+        self.assertAlmostEqual(self.scores()[1], 1, places=2)
+
+    def test_overdue_epoch(self):
+        """Does a like after a long quiet spell move the epoch before adding?"""
+
+        self.like(2, 1)
+        # 2000 half-lives: 2 ** 2000 overflows a float
+        self.age_epoch(2000 * HOUR)
+        self.like(3, 2)
+
+        scores = self.scores()
+        self.assertEqual(scores[1], 0)
+        self.assertAlmostEqual(scores[2], 1, places=2)
+        self.assertLess(datetime.utcnow() - TrendingCheckpoint.query.get(1).epoch,
+                        timedelta(minutes=1))
+
+    def test_checkpoints_scheduled(self):
+        """Does each checkpoint enqueue the next, an interval later?"""
+
+        override_config(self, app, JOBS_INLINE=False, JOB_WORKERS=0)
+
+        self.like(2, 1)
+        with app.app_context():
+            jobs.run_pending()
+            self.assertEqual(jobs.run_pending(), 0)
+
+        pending = Job.query.filter_by(status='queued').one()
+        self.assertEqual(pending.kind, 'trending.checkpoint')
+        self.assertGreater(pending.run_at, datetime.utcnow() + timedelta(minutes=59))
+
+        Job.query.delete()
+        db.session.commit()
+        with app.app_context():
+            trending.checkpoint_job()
+            db.session.commit()
+        self.assertEqual(Job.query.filter_by(status='queued').one().kind,
+                         'trending.checkpoint')
+
+    def test_checkpoint_prunes_old_messages(self):
+        """Does a checkpoint drop messages past the window, keeping the order
+        of the rest?"""
+
+        db.session.add(Message(id=4, text="Message 4", user_id=1,
+                               timestamp=datetime.utcnow() - 25 * HOUR))
+        db.session.commit()
+        self.like(2, 1)
+        self.like(2, 2)
+        self.like(3, 2)
+        db.session.add(TrendingMessage(message_id=4, score=10,
+                                       timestamp=datetime.utcnow() - 25 * HOUR))
+        db.session.commit()
+
+        self.rewind(HOUR)
+        with app.app_context():
+            trending.checkpoint()
+            db.session.commit()
+
+        scores = self.scores()
+        self.assertEqual(set(scores), {1, 2})
+        self.assertAlmostEqual(scores[1], 0.5, places=2)
+        self.assertAlmostEqual(scores[2], 1, places=2)
+
+    def test_trending_page(self):
+        """Does the page list liked messages best first, without deleted authors'?"""
+
+        db.session.add(Message(id=5, text="Message 5", user_id=4))
+        db.session.commit()
+        self.like(2, 2)
+        self.like(3, 2)
+        self.like(2, 5)
+        self.like(3, 5)
+        self.like(4, 3)
+
+        User.query.get(4).deleted_at = datetime.utcnow()
+        db.session.commit()
+
+        html = self.client.get("/messages/trending").get_data(as_text=True)
+        self.assertLess(html.index("Message 2"), html.index("Message 3"))
+        self.assertNotIn("Message 1", html)
+        self.assertNotIn("Message 5", html)
+
+    def test_rebuild(self):
+        """Does a rebuild score recent messages by their likes?"""
+
+        db.session.add_all([Likes(user_id=2, message_id=3), Likes(user_id=3, message_id=3),
+                            Likes(user_id=2, message_id=1)])
+        db.session.commit()
+
+        with app.app_context():
+            self.assertEqual(trending.rebuild(), 2)
+            db.session.commit()
+        self.assertEqual(self.scores(), {1: 1, 3: 2})
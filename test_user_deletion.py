@@ -0,0 +1,148 @@
+"""Account deletion tests."""
+
+# run these tests like:
+#
+#    FLASK_ENV=production python -m unittest test_user_deletion.py
+
+
+import os
+from unittest import TestCase
+
+from models import (db, User, Message, Follows, Likes, TimelineEntry, Job,
+                    Conversation, ConversationMember, DirectMessage)
+
+# BEFORE we import our app, let's set an environmental variable
+# to use a different database for tests (we need to do this
+# before we import our app, since that will have already
+# connected to the database
+
+os.environ['DATABASE_URL'] = "postgresql:///warbler-test"
+
+
+# Now we can import app
+
+from app import app, CURR_USER_KEY
+import counters
+import deletion
+import dms
+import jobs
+import timeline
+from testing import make_users, override_config
+
+db.create_all()
+
+app.config['WTF_CSRF_ENABLED'] = False
+
+
+class UserDeletionTestCase(TestCase):
+    """Test hiding a deleted account, then purging it in batches."""
+
+    def setUp(self):
+        """User 1, about to delete their account, with a bit of everything."""
+
+        for model in (Job, TimelineEntry, DirectMessage, ConversationMember,
+                      Conversation, Likes, Follows, Message, User):
+            model.query.delete()
+        db.session.commit()
+
+        override_config(self, app, JOBS_INLINE=False, JOB_WORKERS=0,
+                        MATERIALIZED_TIMELINES=True)
+        make_users(range(1, 5))
+        db.session.add_all([Message(id=i, text=f"Message {i}", user_id=1) for i in (1, 2, 3)]
+                           + [Message(id=4, text="Message 4", user_id=3)]
+                           + [Follows(user_being_followed_id=1, user_following_id=2),
+                              Follows(user_being_followed_id=1, user_following_id=3),
+                              Follows(user_being_followed_id=2, user_following_id=1)])
+        db.session.commit()
+        db.session.add_all([Likes(user_id=2, message_id=1), Likes(user_id=2, message_id=2),
+                            Likes(user_id=3, message_id=1), Likes(user_id=1, message_id=4)])
+        with app.app_context():
+            dms.send(1, 4, "Hi")
+            dms.send(1, 4, "Still there?")
+            dms.send(4, 1, "Yes")
+            db.session.commit()
+            timeline.rebuild_timelines()
+
+        self.client = app.test_client()
+
+    def delete_account(self):
+        with self.client.session_transaction() as sess:
+            sess[CURR_USER_KEY] = 1
+        resp = self.client.post("/users/delete")
+        self.assertEqual(resp.status_code, 302)
+        self.assertTrue(resp.location.endswith("/signup"))
+
+    def test_deleted_account_hidden(self):
+        """Is the account hidden as soon as it's deleted, with its rows still there?"""
+
+        self.delete_account()
+        self.assertIsNotNone(User.query.get(1).deleted_at)
+        self.assertEqual(Message.query.filter_by(user_id=1).count(), 3)
+        self.assertEqual(Job.query.one().kind, 'users.purge')
+
+        with self.client.session_transaction() as sess:
+            self.assertNotIn(CURR_USER_KEY, sess)
+            sess[CURR_USER_KEY] = 2
+        self.assertEqual(self.client.get("/api/v1/users/1").status_code, 404)
+        self.assertEqual(self.client.get("/api/v1/users/1/messages").status_code, 404)
+        self.assertNotIn("@user1", self.client.get("/users").get_data(as_text=True))
+        self.assertNotIn("Message 1", self.client.get("/").get_data(as_text=True))
+        self.assertFalse(User.authenticate("user1", "HASHED_PASSWORD"))
+
+    def test_no_new_follows_or_likes(self):
+        """Can a deleted account still be followed, or its messages liked?"""
+
+        self.delete_account()
+        with self.client.session_transaction() as sess:
+            sess[CURR_USER_KEY] = 4
+        resp = self.client.post("/users/follow", json={"user_ids": [1, 2]})
+        self.assertEqual(resp.json["followed_ids"], [2])
+        resp = self.client.post("/messages/3/like")
+        self.assertEqual(resp.status_code, 404)
+        self.assertEqual(resp.json["type"], "danger")
+
+        self.assertEqual(Likes.query.filter_by(user_id=4).count(), 0)
+        user4 = User.query.get(4)
+        self.assertEqual((user4.following_count, user4.likes_count), (1, 0))
+
+    def test_purge_in_batches(self):
+        """Do jobs purge the account a batch at a time, leaving counters right?"""
+
+        override_config(self, app, USER_PURGE_BATCH=2)
+        self.delete_account()
+        with app.app_context():
+            ran = jobs.run_pending()
+
+        # batches of two: 1 like, 3 likes received in 2 batches, 9 timeline
+        # entries (3 messages in 3 timelines, the author's own included) in
+        # 5, 3 messages in 2, 1 follow, 2 followers, 3 DMs in 2, 1
+        # conversation, then the account
+        self.assertEqual(ran, 16)
+        self.assertEqual({job.status for job in Job.query}, {'done'})
+        self.assertIsNone(User.query.get(1))
+        self.assertEqual(Message.query.count(), 1)
+        self.assertEqual(Likes.query.count(), 0)
+        self.assertEqual(Follows.query.count(), 0)
+        self.assertEqual(DirectMessage.query.count(), 0)
+        self.assertEqual(TimelineEntry.query.filter(TimelineEntry.author_id == 1).count(), 0)
+
+        user2, user3, user4 = User.query.filter(User.id.in_([2, 3, 4])).order_by(User.id)
+        self.assertEqual((user2.following_count, user2.followers_count, user2.likes_count),
+                         (0, 0, 0))
+        self.assertEqual((user3.likes_count, user3.likes_received_count), (0, 0))
+        self.assertEqual(user4.unread_dm_count, 0)
+        self.assertEqual(counters.reconcile_counters(), 0)
+
+    def test_purge_command(self):
+        """Does purging in the foreground report each batch, and what's left?"""
+
+        self.delete_account()
+        with app.app_context():
+            self.assertEqual(deletion.remaining(1)['messages'], 3)
+            lines = []
+            self.assertEqual(deletion.purge_deleted(batch_size=100, echo=lines.append), 1)
+            self.assertEqual(deletion.remaining(1), {})
+
+        self.assertEqual(lines[0], "user 1, batch 1: deleted 1 likes")
+        self.assertEqual(lines[-1], f"user 1, batch {len(lines)}: deleted 1 account")
+        self.assertIsNone(User.query.get(1))
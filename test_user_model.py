@@ -8,7 +8,7 @@
 import os
 from unittest import TestCase
 
-from models import db, User, Message, Follows
+from models import db, User, Message, Follows, Likes, LikeState
 
 # BEFORE we import our app, let's set an environmental variable
 # to use a different database for tests (we need to do this
@@ -21,6 +21,9 @@ os.environ['DATABASE_URL'] = "postgresql:///warbler-test"
 # Now we can import app
 
 from app import app
+import counters
+import identity
+import passwords
 
 # Create our tables (we do this here, so we only create the tables
 # once for all tests --- in each test, we'll delete the data
@@ -55,4 +58,146 @@ class UserModelTestCase(TestCase):
 
         # User should have no messages & no followers
         self.assertEqual(len(u.messages), 0)
-        self.assertEqual(len(u.followers), 0)
\ No newline at end of file
+        self.assertEqual(len(u.followers), 0)
+
+    def test_counters_track_writes(self):
+        """Do the denormalized counters follow follows, likes and messages?"""
+
+        u1 = User(email="one@test.com", username="one", password="HASHED_PASSWORD")
+        u2 = User(email="two@test.com", username="two", password="HASHED_PASSWORD")
+        db.session.add_all([u1, u2])
+        db.session.commit()
+
+        msg = Message(text="Counted", user_id=u1.id)
+        db.session.add(msg)
+        db.session.add(Follows(user_being_followed_id=u1.id, user_following_id=u2.id))
+        db.session.commit()
+        db.session.add(Likes(user_id=u2.id, message_id=msg.id))
+        db.session.commit()
+
+        self.assertEqual((u1.messages_count, u1.followers_count, u1.following_count), (1, 1, 0))
+        self.assertEqual((u2.following_count, u2.likes_count), (1, 1))
+        self.assertEqual(u1.likes_received_count, 1)
+
+        # deleting the message takes its like off the liker's count too
+        db.session.delete(msg)
+        db.session.commit()
+        self.assertEqual((u1.messages_count, u1.likes_received_count), (0, 0))
+        self.assertEqual(u2.likes_count, 0)
+
+    def test_reconcile_counters(self):
+        """Does reconciling repair counters that drifted from the tables?"""
+
+        u1 = User(email="one@test.com", username="one", password="HASHED_PASSWORD")
+        db.session.add(u1)
+        db.session.commit()
+        db.session.add(Message(text="Counted", user_id=u1.id))
+        db.session.commit()
+
+        u1.messages_count = 42
+        u1.followers_count = 7
+        db.session.commit()
+        user_id = u1.id
+
+        with app.app_context():
+            self.assertEqual(counters.reconcile_counters(), 1)
+            self.assertEqual(counters.reconcile_counters(), 0)
+
+        u1 = User.query.get(user_id)
+        self.assertEqual((u1.messages_count, u1.followers_count), (1, 0))
+
+    def test_follow_checks(self):
+        """Do the follow membership checks hit the follows table correctly?"""
+
+        u1 = User(email="one@test.com", username="one", password="HASHED_PASSWORD")
+        u2 = User(email="two@test.com", username="two", password="HASHED_PASSWORD")
+        u3 = User(email="three@test.com", username="three", password="HASHED_PASSWORD")
+        db.session.add_all([u1, u2, u3])
+        db.session.commit()
+        db.session.add(Follows(user_being_followed_id=u2.id, user_following_id=u1.id))
+        db.session.commit()
+
+        self.assertTrue(u1.is_following(u2))
+        self.assertFalse(u2.is_following(u1))
+        self.assertTrue(u2.is_followed_by(u1))
+        self.assertFalse(u1.is_followed_by(u2))
+        self.assertEqual(u1.following_among([u2.id, u3.id]), {u2.id})
+        self.assertEqual(u1.following_among([]), set())
+
+    def test_identity_cache(self):
+        """Is the logged-in user's identity cached until it is forgotten?"""
+
+        u = User(email="one@test.com", username="one", password="HASHED_PASSWORD")
+        db.session.add(u)
+        db.session.commit()
+        user_id = u.id
+
+        hits = identity.identities.hits
+        self.assertEqual(identity.load_identity(user_id).username, "one")
+        self.assertEqual(identity.load_identity(user_id).username, "one")
+        self.assertEqual(identity.identities.hits, hits + 1)
+
+        User.query.get(user_id).username = "renamed"
+        db.session.commit()
+        self.assertEqual(identity.load_identity(user_id).username, "one")
+
+        identity.forget(user_id)
+        self.assertEqual(identity.load_identity(user_id).username, "renamed")
+        self.assertIsNone(identity.load_identity(-1))
+
+        current = identity.CurrentUser(identity.load_identity(user_id))
+        self.assertEqual(current, User.query.get(user_id))
+        self.assertEqual(current.email, "one@test.com")
+
+    def test_rehash_on_login(self):
+        """Is a hash made at an old cost replaced when its owner logs in?"""
+
+        rounds = passwords.settings['rounds']
+        passwords.settings['rounds'] = 4
+        self.addCleanup(passwords.settings.__setitem__, 'rounds', rounds)
+
+        u = User(email="one@test.com", username="one",
+                 password=passwords._hash("secret", 5))
+        db.session.add(u)
+        db.session.commit()
+
+        self.assertFalse(User.authenticate("one", "wrong"))
+        self.assertTrue(u.password.startswith("$2b$05$"))
+
+        self.assertEqual(User.authenticate("one", "secret"), u)
+        self.assertTrue(u.password.startswith("$2b$04$"))
+        self.assertTrue(passwords.check_password(u.password, "secret"))
+
+    def test_change_password(self):
+        """Does change_password need the old password and a matching confirm?"""
+
+        u = User.signup("one", "one@test.com", "secret", None)
+        db.session.commit()
+
+        self.assertFalse(User.change_password("one", "wrong", "newpass", "newpass"))
+        self.assertFalse(User.change_password("one", "secret", "newpass", "typo"))
+        self.assertEqual(User.change_password("one", "secret", "newpass", "newpass"), u)
+        db.session.commit()
+
+        self.assertTrue(User.authenticate("one", "newpass"))
+        self.assertFalse(User.authenticate("one", "secret"))
+
+    def test_like_state(self):
+        """Does state_for report the viewer's likes and counts for a page?"""
+
+        u1 = User(email="one@test.com", username="one", password="HASHED_PASSWORD")
+        u2 = User(email="two@test.com", username="two", password="HASHED_PASSWORD")
+        db.session.add_all([u1, u2])
+        db.session.commit()
+        m1, m2, m3 = [Message(text=text, user_id=u1.id) for text in "abc"]
+        db.session.add_all([m1, m2, m3])
+        db.session.commit()
+        db.session.add_all([Likes(user_id=u1.id, message_id=m1.id),
+                            Likes(user_id=u2.id, message_id=m1.id),
+                            Likes(user_id=u2.id, message_id=m2.id)])
+        db.session.commit()
+
+        state = Likes.state_for(u1.id, [m1.id, m2.id, m3.id])
+        self.assertEqual(state.liked, {m1.id})
+        self.assertEqual(state.counts, {m1.id: 2, m2.id: 1})
+        self.assertEqual(Likes.state_for(u1.id, []), LikeState(set(), {}))
@@ -6,6 +6,8 @@
 
 
 import os
+import re
+from datetime import datetime
 from unittest import TestCase
 
 from models import db, connect_db, Message, User, Likes, Follows
@@ -21,6 +23,9 @@ os.environ['DATABASE_URL'] = "postgresql:///warbler-test"
 # Now we can import app
 
 from app import app, CURR_USER_KEY
+import fragments
+import passwords
+from querystats import QueryBudgetMixin
 
 # Create our tables (we do this here, so we only create the tables
 # once for all tests --- in each test, we'll delete the data
@@ -31,8 +36,11 @@ db.create_all()
 
 app.config['WTF_CSRF_ENABLED'] = False
 
+# run background jobs in the request that enqueues them
+app.config['JOBS_INLINE'] = True
 
-class UserViewTestCase(TestCase):
+
+class UserViewTestCase(QueryBudgetMixin, TestCase):
     """Test views for messages."""
 
     def setUp(self):
@@ -76,6 +84,45 @@ class UserViewTestCase(TestCase):
             self.assertIn('@danish_man', html)
             self.assertIn('@eggplant_man', html)
 
+    def test_index_users_pages(self):
+        """Does the unfiltered list page on by user id, past the search page cap?"""
+
+        for name, value in {'SEARCH_PER_PAGE': 2, 'SEARCH_MAX_PAGES': 1}.items():
+            self.addCleanup(app.config.__setitem__, name, app.config[name])
+            app.config[name] = value
+
+        with self.client as c:
+            html = c.get('/users').get_data(as_text=True)
+            self.assertIn('@eggplant_man', html)
+            self.assertIn('@danish_man', html)
+            self.assertNotIn('@carrot_girl', html)
+
+            url = re.search(r'href="(/users\?before=\d+)"', html).group(1)
+            html = c.get(url).get_data(as_text=True)
+            self.assertIn('@carrot_girl', html)
+            self.assertIn('@bagel_man', html)
+            self.assertNotIn('@danish_man', html)
+
+            self.assertEqual(c.get('/users?before=x').status_code, 400)
+
+    def test_index_users_follow_state(self):
+        """Does the users list mark who the viewer already follows?"""
+
+        db.session.add(Follows(user_being_followed_id=self.u1.id,
+                               user_following_id=self.testuser.id))
+        db.session.commit()
+        u1_id = self.u1.id
+
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.testuser.id
+
+            resp = c.get('/users')
+            html = resp.get_data(as_text=True)
+            self.assertEqual(resp.status_code, 200)
+            self.assertEqual(html.count('>Unfollow</button>'), 1)
+            self.assertIn(f'action="/users/stop-following/{u1_id}"', html)
+
     def test_search_users(self):
         with self.client as c:
             with c.session_transaction() as sess:
@@ -137,6 +184,38 @@ class UserViewTestCase(TestCase):
             html = resp.get_data(as_text=True)
             self.assertIn('@testuser', html)
             self.assertRegex(html, '<a class=\"messages-display-user\".*2</a>')
+    def test_user_show_pagination(self):
+        """Do profile pages page through messages with ?before= cursors?"""
+
+        for i in range(5):
+            db.session.add(Message(text=f"warble {i}", user_id=self.testuser.id,
+                                   timestamp=datetime(2020, 1, 1, 12, i)))
+        db.session.commit()
+        app.config['MESSAGES_PER_PAGE'] = 2
+
+        try:
+            with self.client as c:
+                with c.session_transaction() as sess:
+                    sess[CURR_USER_KEY] = self.testuser.id
+
+                html = c.get(f'/users/{self.testuser.id}').get_data(as_text=True)
+                self.assertIn('warble 4', html)
+                self.assertIn('warble 3', html)
+                self.assertNotIn('warble 2', html)
+
+                cursor = re.search(r'before=([\w-]+)', html).group(1)
+                resp = c.get(f'/users/{self.testuser.id}?before={cursor}')
+                html = resp.get_data(as_text=True)
+                self.assertEqual(resp.status_code, 200)
+                self.assertNotIn('warble 3', html)
+                self.assertIn('warble 2', html)
+                self.assertIn('warble 1', html)
+
+                resp = c.get(f'/users/{self.testuser.id}?before=garbage')
+                self.assertEqual(resp.status_code, 400)
+        finally:
+            app.config['MESSAGES_PER_PAGE'] = 20
+
     def test_user_show_likes_display(self):
         self.setup_likes()
         with self.client as c:
@@ -166,6 +245,34 @@ class UserViewTestCase(TestCase):
             self.assertEqual(len(likes), 1)
             self.assertEqual(likes[0].user_id, self.testuser.id)
 
+    def test_like_idempotent(self):
+        """Can several users like a message, and is liking twice a no-op?"""
+
+        m = Message(id=1984, text="The earth is round", user_id=self.u1.id)
+        db.session.add(m)
+        db.session.commit()
+        testuser_id, u2_id = self.testuser.id, self.u2.id
+
+        for user_id in (testuser_id, testuser_id, u2_id):
+            with self.client as c:
+                with c.session_transaction() as sess:
+                    sess[CURR_USER_KEY] = user_id
+                c.post("/messages/1984/like")
+
+        self.assertEqual(Likes.query.filter(Likes.message_id==1984).count(), 2)
+        self.assertEqual(User.query.get(testuser_id).likes_count, 1)
+
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = testuser_id
+            resp = c.post("/messages/1984/unlike")
+            self.assertEqual(resp.json["type"], "success")
+            resp = c.post("/messages/1984/unlike")
+            self.assertEqual(resp.json["type"], "warning")
+
+        self.assertEqual(Likes.query.filter(Likes.message_id==1984).count(), 1)
+        self.assertEqual(User.query.get(testuser_id).likes_count, 0)
+
     def test_add_like_no_user(self):
         self.setup_likes()
         with self.client as c:
@@ -229,6 +336,54 @@ class UserViewTestCase(TestCase):
             self.assertIn('@testuser', html)
             self.assertRegex(html, '<a class=\"follower-display\".*2</a>')
 
+    def test_followers_pages(self):
+        """Are followers listed a page at a time, marking who the viewer follows?"""
+
+        self.setup_followers()
+        db.session.add_all([
+            Follows(user_being_followed_id=self.testuser.id, user_following_id=self.u3.id),
+            Follows(user_being_followed_id=self.testuser.id, user_following_id=self.u5.id),
+            Follows(user_being_followed_id=self.u5.id, user_following_id=self.testuser.id)])
+        db.session.commit()
+        user_id, u3_id, u5_id = self.testuser.id, self.u3.id, self.u5.id
+        self.addCleanup(app.config.__setitem__, 'SEARCH_PER_PAGE', app.config['SEARCH_PER_PAGE'])
+        app.config['SEARCH_PER_PAGE'] = 2
+
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = user_id
+
+            html = c.get(f'/users/{user_id}/followers').get_data(as_text=True)
+            self.assertIn('@eggplant_man', html)
+            self.assertIn('@carrot_girl', html)
+            self.assertNotIn('@bagel_man', html)
+            self.assertIn(f'action="/users/stop-following/{u5_id}"', html)
+            self.assertIn(f'action="/users/follow/{u3_id}"', html)
+
+            html = c.get(f'/users/{user_id}/followers?before={u3_id}').get_data(as_text=True)
+            self.assertIn('@bagel_man', html)
+            self.assertIn('@apple_girl', html)
+            self.assertNotIn('@carrot_girl', html)
+            self.assertNotIn('older-link', html)
+
+            self.assertEqual(c.get(f'/users/{user_id}/followers?before=x').status_code, 400)
+
+    def test_followers_own_card(self):
+        """Does the viewer's own card, in someone's followers, go without a
+        follow button?"""
+
+        self.setup_followers()
+        user_id, u4_id = self.testuser.id, self.u4.id
+
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = user_id
+
+            html = c.get(f'/users/{u4_id}/followers').get_data(as_text=True)
+            self.assertIn('@testuser', html)
+            self.assertNotIn(f'/users/follow/{user_id}"', html)
+            self.assertNotIn(f'/users/stop-following/{user_id}"', html)
+
     def test_add_follow(self):
         self.setup_followers()
         with self.client as c:
@@ -260,6 +415,37 @@ class UserViewTestCase(TestCase):
             self.assertEqual(resp.status_code, 404)
             self.assertIn("Page not found", html)
 
+    def test_add_follows_batch(self):
+        """Does a batch follow add only the missing edges, in a few queries?"""
+
+        self.setup_followers()
+        testuser_id, u4_id = self.testuser.id, self.u4.id
+        wanted = [self.u1.id, self.u2.id, self.u3.id, u4_id, testuser_id, 99999999]
+        # count the request's own queries, not those of the jobs it enqueues
+        for name, value in {'JOBS_INLINE': False, 'JOB_WORKERS': 0}.items():
+            self.addCleanup(app.config.__setitem__, name, app.config[name])
+            app.config[name] = value
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = testuser_id
+
+            with self.assertQueryBudget(6):
+                resp = c.post("/users/follow", json={"user_ids": wanted})
+            self.assertEqual(resp.status_code, 200)
+            # already following u4; can't follow yourself or a missing user
+            self.assertEqual(resp.get_json()['followed_ids'], sorted(wanted[:3]))
+
+            resp = c.post("/users/follow", json={"user_ids": wanted})
+            self.assertEqual(resp.get_json()['followed_ids'], [])
+
+            resp = c.post("/users/follow", json={"user_ids": ["nobody"]})
+            self.assertEqual(resp.status_code, 400)
+
+        testuser = User.query.get(testuser_id)
+        self.assertEqual(testuser.following_count, 4)
+        self.assertEqual(len(testuser.following), 4)
+        self.assertEqual(User.query.get(wanted[0]).followers_count, 1)
+
     def test_remove_follow(self):
         self.setup_followers()
         with self.client as c:
@@ -289,4 +475,164 @@ class UserViewTestCase(TestCase):
             resp = c.post("/users/999999999/unfollow", follow_redirects=True)
             html = resp.get_data(as_text=True)
             self.assertEqual(resp.status_code, 404)
-            self.assertIn("Page not found", html)
\ No newline at end of file
+            self.assertIn("Page not found", html)
+    def test_login(self):
+        """Does logging in work, and shed load when bcrypt is saturated?"""
+
+        User.signup("fig_man", "fig@test.com", "figpassword", None)
+        db.session.commit()
+        login = {"username": "fig_man", "password": "figpassword"}
+
+        with self.client as c:
+            resp = c.post('/login', data=login)
+            self.assertEqual(resp.status_code, 302)
+
+        passwords.load['in_flight'] += passwords.capacity()
+        self.addCleanup(passwords.load.__setitem__, 'in_flight', 0)
+        with self.client as c:
+            resp = c.post('/login', data=login)
+            self.assertEqual(resp.status_code, 503)
+            self.assertIn('Retry-After', resp.headers)
+
+    def test_user_show_not_modified(self):
+        """Is an unchanged profile answered 304, until someone likes a message on it?"""
+
+        m = Message(id=1984, text="The earth is round", user_id=self.u1.id)
+        db.session.add(m)
+        db.session.commit()
+        testuser_id, u1_id, u2_id = self.testuser.id, self.u1.id, self.u2.id
+
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = testuser_id
+
+            resp = c.get(f"/users/{u1_id}")
+            self.assertEqual(resp.status_code, 200)
+            self.assertEqual(resp.headers['Cache-Control'], 'private, no-cache')
+            etag = resp.headers['ETag']
+
+            resp = c.get(f"/users/{u1_id}", headers={'If-None-Match': etag})
+            self.assertEqual(resp.status_code, 304)
+            self.assertEqual(resp.get_data(), b"")
+
+            # someone else's like shows up as a new like count on the page
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = u2_id
+            c.post("/messages/1984/like")
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = testuser_id
+
+            resp = c.get(f"/users/{u1_id}", headers={'If-None-Match': etag})
+            self.assertEqual(resp.status_code, 200)
+            self.assertNotEqual(resp.headers['ETag'], etag)
+
+    def test_user_show_viewer_likes_change(self):
+        """Does moving the viewer's like from one message to another change the ETag?"""
+
+        db.session.add_all([Message(id=1984, text="The earth is round", user_id=self.u1.id),
+                            Message(id=1985, text="The earth is flat", user_id=self.u1.id)])
+        db.session.commit()
+        testuser_id, u1_id = self.testuser.id, self.u1.id
+
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = testuser_id
+            c.post("/messages/1984/like")
+            etag = c.get(f"/users/{u1_id}").headers['ETag']
+
+            # same like counts, but different like buttons
+            c.post("/messages/1984/unlike")
+            c.post("/messages/1985/like")
+
+            resp = c.get(f"/users/{u1_id}", headers={'If-None-Match': etag})
+            self.assertEqual(resp.status_code, 200)
+            self.assertNotEqual(resp.headers['ETag'], etag)
+
+    def test_user_show_messages_change(self):
+        """Does swapping one message for another change the ETag, counts and all?"""
+
+        db.session.add(Message(id=1984, text="The earth is round", user_id=self.testuser.id))
+        db.session.commit()
+        testuser_id = self.testuser.id
+
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = testuser_id
+            etag = c.get(f"/users/{testuser_id}").headers['ETag']
+
+            c.post("/messages/1984/delete")
+            c.post("/messages/new", data={"text": "The earth is flat"})
+
+            resp = c.get(f"/users/{testuser_id}", headers={'If-None-Match': etag})
+            self.assertEqual(resp.status_code, 200)
+            self.assertIn("The earth is flat", resp.get_data(as_text=True))
+
+    def test_static_caching(self):
+        """Are fingerprinted static URLs immutable, and other pages not stored?"""
+
+        with self.client as c:
+            html = c.get("/login").get_data(as_text=True)
+            url = re.search(r'href="(/static/stylesheets/style.css\?v=\w+)"', html).group(1)
+
+            resp = c.get(url)
+            self.assertEqual(resp.status_code, 200)
+            self.assertIn('immutable', resp.headers['Cache-Control'])
+
+            resp = c.get("/static/stylesheets/style.css")
+            self.assertEqual(resp.headers['Cache-Control'], 'public, no-cache')
+            resp = c.get("/static/stylesheets/style.css",
+                         headers={'If-None-Match': resp.headers['ETag']})
+            self.assertEqual(resp.status_code, 304)
+
+            self.assertEqual(c.get("/login").headers['Cache-Control'], 'no-store')
+
+    def test_fragment_cache(self):
+        """Are user cards reused until the user's profile changes?"""
+
+        fragments.fragments.clear()
+        u1_id = self.u1.id
+
+        with self.client as c:
+            c.get("/users")
+            hits = fragments.fragments.hits
+            resp = c.get("/users")
+            self.assertEqual(fragments.fragments.hits, hits + User.query.count())
+
+            user = User.query.get(u1_id)
+            version = user.version
+            user.username = "pear_girl"
+            db.session.commit()
+            self.assertEqual(User.query.get(u1_id).version, version + 1)
+
+            resp = c.get("/users")
+            html = resp.get_data(as_text=True)
+            self.assertIn("@pear_girl", html)
+            self.assertNotIn("@apple_girl", html)
+
+    def test_query_budgets(self):
+        """Do the list pages run a fixed number of queries, however long?"""
+
+        self.setup_followers()
+        for author in (self.u1, self.u2, self.u3, self.u4, self.u5):
+            if author is not self.u4:  # already followed
+                db.session.add(Follows(user_being_followed_id=author.id,
+                                       user_following_id=self.testuser.id))
+            for i in range(3):
+                msg = Message(text=f"Warble {i}", user_id=author.id)
+                db.session.add(msg)
+                db.session.flush()
+                db.session.add(Likes(user_id=self.testuser.id, message_id=msg.id))
+        db.session.commit()
+        user_id = self.testuser.id
+
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = user_id
+
+            for path in ['/', f'/users/{user_id}', f'/users/{user_id}/likes',
+                         f'/users/{user_id}/following',
+                         f'/users/{user_id}/followers', '/users']:
+                with self.subTest(path=path), self.assertQueryBudget(5):
+                    resp = c.get(path)
+                    self.assertEqual(resp.status_code, 200)
+
@@ -0,0 +1,24 @@
+"""Helpers shared by the test modules."""
+
+from models import db, User
+
+
+def override_config(testcase, app, **settings):
+    """Set `settings` in `app`'s config until `testcase` is done."""
+
+    for name, value in settings.items():
+        if name in app.config:
+            testcase.addCleanup(app.config.__setitem__, name, app.config[name])
+        else:
+            testcase.addCleanup(app.config.pop, name, None)
+        app.config[name] = value
+
+
+def make_users(ids):
+    """Add and commit a plain user for each of `ids`: "user<id>", whose
+    password is "HASHED_PASSWORD"."""
+
+    db.session.add_all([User(id=i, username=f"user{i}", email=f"user{i}@test.com",
+                             password="HASHED_PASSWORD")
+                        for i in ids])
+    db.session.commit()
@@ -0,0 +1,200 @@
+"""Materialized home timelines for Warbler.
+
+With ``MATERIALIZED_TIMELINES`` switched on, each new message is copied
+("fanned out") into ``timeline_entries`` for its author and every follower
+when it is written, so the homepage reads a user's timeline with one range
+scan over the (user_id, timestamp) index instead of merging the messages of
+everybody they follow on every request. Fan-outs and backfills trim the
+timelines they add to back to their newest ``TIMELINE_LENGTH`` entries, so
+an active author's followers don't collect entries without end.
+
+Fan-out, and the backfill and pruning that follows and unfollows need, run
+as background jobs (see jobs.py), so writes don't wait on them. Each job
+checks the follow is still (or no longer) there when it runs, so a quick
+unfollow and refollow can't leave a timeline wrong.
+"""
+
+from flask import current_app
+from sqlalchemy import func, literal, select, tuple_, union_all
+
+import jobs
+from models import db, insert_if_absent, Follows, Message, TimelineEntry, User
+
+ENTRY_COLUMNS = ['user_id', 'message_id', 'author_id', 'timestamp']
+
+
+def enabled():
+    """Is the materialized timeline store switched on for this app?"""
+
+    return current_app.config.get('MATERIALIZED_TIMELINES', False)
+
+
+def timeline_length():
+    """How many entries backfills and rebuilds keep per user."""
+
+    return current_app.config.get('TIMELINE_LENGTH', 800)
+
+
+def insert_entries(entries):
+    """Add `entries` (a select of ENTRY_COLUMNS), skipping any already
+    there: fan-outs and backfills can each get to the same message first."""
+
+    insert_if_absent(TimelineEntry.__table__, entries, ['user_id', 'message_id'],
+                     columns=ENTRY_COLUMNS)
+
+
+def fan_out(message):
+    """Push `message` into its author's and their followers' timelines.
+
+    `message` must already be flushed so it has an id. Runs in the caller's
+    transaction.
+    """
+
+    author = select([
+        literal(message.user_id),
+        literal(message.id),
+        literal(message.user_id),
+        literal(message.timestamp),
+    ])
+    followers = (select([
+        Follows.user_following_id,
+        literal(message.id),
+        literal(message.user_id),
+        literal(message.timestamp),
+    ]).where(Follows.user_being_followed_id == message.user_id))
+
+    insert_entries(union_all(author, followers))
+    trim(union_all(select([literal(message.user_id)]),
+                   select([Follows.user_following_id])
+                   .where(Follows.user_being_followed_id == message.user_id)))
+
+
+def backfill(follower_id, followed_ids):
+    """Copy the recent messages of each of `followed_ids` into
+    `follower_id`'s timeline, in one statement."""
+
+    position = func.row_number().over(
+        partition_by=Message.user_id,
+        order_by=(Message.timestamp.desc(), Message.id.desc()))
+    ranked = (select([
+        literal(follower_id).label('user_id'),
+        Message.id.label('message_id'),
+        Message.user_id.label('author_id'),
+        Message.timestamp.label('timestamp'),
+        position.label('position'),
+    ])
+        .where(Message.user_id.in_(followed_ids))
+        .alias('ranked'))
+    recent = (select([ranked.c[name] for name in ENTRY_COLUMNS])
+              .where(ranked.c.position <= timeline_length()))
+
+    insert_entries(recent)
+    trim([follower_id])
+
+
+def trim(user_ids):
+    """Cut the timelines of `user_ids` (a list or select) down to their
+    newest ``TIMELINE_LENGTH`` entries, in one statement."""
+
+    entries = TimelineEntry.__table__
+    position = func.row_number().over(
+        partition_by=entries.c.user_id,
+        order_by=(entries.c.timestamp.desc(), entries.c.message_id.desc()))
+    ranked = (select([entries.c.user_id, entries.c.message_id, position.label('position')])
+              .where(entries.c.user_id.in_(user_ids))
+              .correlate(None)
+              .alias('ranked'))
+    excess = (select([ranked.c.user_id, ranked.c.message_id])
+              .where(ranked.c.position > timeline_length())
+              .correlate(None))
+    db.session.execute(entries.delete().where(
+        tuple_(entries.c.user_id, entries.c.message_id).in_(excess)))
+
+
+def prune(follower_id, followed_id):
+    """Drop `followed_id`'s messages from `follower_id`'s timeline."""
+
+    (TimelineEntry
+        .query
+        .filter(TimelineEntry.user_id == follower_id,
+                TimelineEntry.author_id == followed_id)
+        .delete(synchronize_session=False))
+
+
+def still_followed(follower_id, user_ids):
+    return [user_id for (user_id,) in
+            db.session.query(Follows.user_being_followed_id)
+            .filter(Follows.user_following_id == follower_id,
+                    Follows.user_being_followed_id.in_(user_ids))]
+
+
+@jobs.handler('timeline.fan_out')
+def fan_out_job(message_id):
+    message = Message.query.get(message_id)
+    if message is not None:
+        fan_out(message)
+
+
+@jobs.handler('timeline.backfill')
+def backfill_job(follower_id, followed_ids):
+    followed_ids = still_followed(follower_id, followed_ids)
+    if followed_ids:
+        backfill(follower_id, followed_ids)
+
+
+@jobs.handler('timeline.prune')
+def prune_job(follower_id, followed_id):
+    if not still_followed(follower_id, [followed_id]):
+        prune(follower_id, followed_id)
+
+
+def timeline_query(user_id):
+    """(Message, User) rows of `user_id`'s materialized timeline.
+
+    Unordered: page it on (TimelineEntry.timestamp, TimelineEntry.message_id)
+    so the read stays on the timeline index.
+    """
+
+    return (db.session
+            .query(Message, User)
+            .join(TimelineEntry, TimelineEntry.message_id == Message.id)
+            .join(User, User.id == Message.user_id)
+            .filter(TimelineEntry.user_id == user_id, User.deleted_at.is_(None)))
+
+
+def rebuild_timelines():
+    """Recompute every timeline from the follows and messages tables.
+
+    Each user keeps only their newest ``TIMELINE_LENGTH`` entries. Returns the
+    number of entries written.
+    """
+
+    own = select([
+        Message.user_id.label('user_id'),
+        Message.id.label('message_id'),
+        Message.user_id.label('author_id'),
+        Message.timestamp.label('timestamp'),
+    ])
+    followed = (select([
+        Follows.user_following_id,
+        Message.id,
+        Message.user_id,
+        Message.timestamp,
+    ]).where(Follows.user_being_followed_id == Message.user_id))
+    candidates = union_all(own, followed).alias('candidates')
+
+    position = func.row_number().over(
+        partition_by=candidates.c.user_id,
+        order_by=(candidates.c.timestamp.desc(),
+                  candidates.c.message_id.desc()))
+    ranked = select([candidates, position.label('position')]).alias('ranked')
+    newest = (select([ranked.c[name] for name in ENTRY_COLUMNS])
+              .where(ranked.c.position <= timeline_length()))
+
+    entries = TimelineEntry.__table__
+    db.session.execute(entries.delete())
+    result = db.session.execute(entries.insert().from_select(
+        ENTRY_COLUMNS, newest))
+    db.session.commit()
+
+    return result.rowcount
@@ -0,0 +1,198 @@
+"""Trending messages: recent messages ranked by time-decayed likes.
+
+Each like counts 1 when it happens and half as much every
+``TRENDING_HALF_LIFE`` seconds after. Rather than decaying every score as
+time passes, a like at time t adds ``2 ** ((t - epoch) / half_life)`` to
+its message's row in ``trending_messages``: scores are all relative to the
+same epoch, so they order the same as their decayed values, and a like is
+one single-row UPDATE from a background job. ``likes.timestamp`` keeps t,
+so an unlike takes off exactly what its like added, whichever of their
+jobs runs first (a score can be negative in between).
+
+Every ``TRENDING_CHECKPOINT_INTERVAL`` seconds a ``trending.checkpoint``
+job moves the epoch up to the present, scaling every score down to match,
+drops messages older than ``TRENDING_WINDOW`` and enqueues the next one.
+A like that finds the epoch overdue moves it first, so weights stay far
+from overflowing however long things were quiet. Only recent messages have
+rows, so the table stays small, and as the scores live in the database, a
+restarted process has nothing to rebuild.
+
+``/messages/trending`` reads the best ``TRENDING_SIZE`` ids off the score
+index, which each process then keeps for ``TRENDING_CACHE_TTL`` seconds.
+``flask rebuild-trending`` scores recent messages from their likes so far,
+for a database that had likes before this table.
+"""
+
+from datetime import datetime, timedelta
+
+from flask import current_app
+from sqlalchemy import func, select
+
+import jobs
+from cache import LRUCache
+from models import (db, insert_if_absent, Likes, Message, TrendingCheckpoint,
+                    TrendingMessage)
+
+# Scores are rebased well before a like's weight, 2 ** half-lives since the
+# epoch, could reach this many half-lives (and overflow a float at 1024).
+MAX_HALF_LIVES = 64
+
+# The current top ids, under the key None.
+top = LRUCache(maxsize=1)
+
+
+def configure(app):
+    """Set how long the top ids are cached from `app`'s config."""
+
+    top.ttl = app.config.get('TRENDING_CACHE_TTL', 10)
+
+
+def setting(name, default):
+    return current_app.config.get(name, default)
+
+
+def epoch(lock=False):
+    """The checkpoint's epoch, creating it if need be.
+
+    `lock` takes it for update, to move it; otherwise it is share-locked so
+    a checkpoint can't rescale scores between reading it and using it.
+    """
+
+    table = TrendingCheckpoint.__table__
+    query = select([table.c.epoch]).where(table.c.id == 1).with_for_update(read=not lock)
+    since = db.session.execute(query).scalar()
+    if since is None:
+        insert_if_absent(table, {'id': 1, 'epoch': datetime.utcnow()}, ['id'])
+        since = db.session.execute(query).scalar()
+    return since
+
+
+def weight(since, when):
+    """What a like at `when` adds to a score relative to `since`."""
+
+    half_lives = (when - since).total_seconds() / setting('TRENDING_HALF_LIFE', 21600)
+    return 2 ** min(half_lives, MAX_HALF_LIVES)
+
+
+def window_start(now):
+    return now - timedelta(seconds=setting('TRENDING_WINDOW', 172800))
+
+
+def stale(since, now):
+    """Is it time to move the epoch up? At least every checkpoint interval,
+    and well before weights get anywhere near overflowing."""
+
+    half_life = setting('TRENDING_HALF_LIFE', 21600)
+    interval = setting('TRENDING_CHECKPOINT_INTERVAL', 3600)
+    return now - since >= timedelta(seconds=min(interval, MAX_HALF_LIVES / 2 * half_life))
+
+
+@jobs.handler('trending.record')
+def record(message_id, sign=1, liked_at=None):
+    """Add (or, with `sign` -1, take off) what a like of `message_id` at
+    `liked_at` (ISO format; now if not given) is worth.
+
+    Unliking a like of unknown age takes off what it would have added when
+    the message was posted, which is never more than it did add.
+    """
+
+    timestamp = db.session.query(Message.timestamp).filter(
+        Message.id == message_id).scalar()
+    now = datetime.utcnow()
+    if timestamp is None or timestamp < window_start(now):
+        return
+    when = datetime.fromisoformat(liked_at) if liked_at else (now if sign > 0 else timestamp)
+
+    # a checkpoint that's overdue (jobs stopped, or nothing liked in a
+    # while) happens here, before the weight is worked out
+    since = db.session.query(TrendingCheckpoint.epoch).filter(
+        TrendingCheckpoint.id == 1).scalar()
+    if since is None or stale(since, now):
+        checkpoint()
+        schedule_checkpoint()
+    since = epoch()
+
+    table = TrendingMessage.__table__
+    insert_if_absent(table, {'message_id': message_id, 'score': 0.0,
+                             'timestamp': timestamp}, ['message_id'])
+    # not clamped at 0: a like's and its unlike's jobs may run either way
+    # round, and must still cancel out
+    db.session.execute(
+        table.update()
+        .where(table.c.message_id == message_id)
+        .values(score=table.c.score + sign * weight(since, when)))
+
+
+def checkpoint():
+    """Move the epoch to now, rescaling scores, and drop messages too old
+    to trend. The caller commits."""
+
+    since = epoch(lock=True)
+    now = datetime.utcnow()
+    table = TrendingMessage.__table__
+    db.session.execute(table.delete().where(table.c.timestamp < window_start(now)))
+    db.session.execute(table.update().values(score=table.c.score * weight(now, since)))
+    checkpoints = TrendingCheckpoint.__table__
+    db.session.execute(checkpoints.update().where(checkpoints.c.id == 1).values(epoch=now))
+
+
+def schedule_checkpoint():
+    """Enqueue a checkpoint for one interval from now, unless one is already
+    due then.
+
+    Not with ``JOBS_INLINE``, where it would run straight away: there, a
+    like that finds the epoch stale moves it.
+    """
+
+    if current_app.config.get('JOBS_INLINE'):
+        return
+    interval = setting('TRENDING_CHECKPOINT_INTERVAL', 3600)
+    due = datetime.utcnow() + timedelta(seconds=interval)
+    jobs.enqueue('trending.checkpoint', delay=interval,
+                 key=f"trending-checkpoint:{int(due.timestamp() // interval)}")
+
+
+@jobs.handler('trending.checkpoint')
+def checkpoint_job():
+    checkpoint()
+    schedule_checkpoint()
+
+
+def top_ids():
+    """Ids of the highest scoring recent messages, best first."""
+
+    ids = top.get(None)
+    if ids is None:
+        cutoff = window_start(datetime.utcnow())
+        ids = [message_id for (message_id,) in (db.session
+                                                .query(TrendingMessage.message_id)
+                                                .filter(TrendingMessage.score > 0,
+                                                        TrendingMessage.timestamp >= cutoff)
+                                                .order_by(TrendingMessage.score.desc(),
+                                                          TrendingMessage.message_id.desc())
+                                                .limit(setting('TRENDING_SIZE', 50)))]
+        top.set(None, ids)
+    return ids
+
+
+def rebuild():
+    """Score every recent message by its likes so far, as though they all
+    happened now, restarting the epoch. Returns how many messages were
+    scored; the caller commits."""
+
+    now = datetime.utcnow()
+    cutoff = window_start(now)
+    table, checkpoints = TrendingMessage.__table__, TrendingCheckpoint.__table__
+    likes, messages = Likes.__table__, Message.__table__
+
+    epoch(lock=True)
+    db.session.execute(checkpoints.update().where(checkpoints.c.id == 1).values(epoch=now))
+    db.session.execute(table.delete())
+    scored = (select([messages.c.id, func.count().label('score'), messages.c.timestamp])
+              .select_from(messages.join(likes))
+              .where(messages.c.timestamp >= cutoff)
+              .group_by(messages.c.id, messages.c.timestamp))
+    db.session.execute(table.insert().from_select(['message_id', 'score', 'timestamp'], scored))
+    schedule_checkpoint()
+    top.clear()
+    return db.session.query(TrendingMessage).count()